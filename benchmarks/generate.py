@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# benchmarks/generate.py
+"""
+Deterministic generator of large synthetic snippet stores for benchmarking.
+
+The same size and seed always produce the same users, collections and snippets. Languages
+follow a skewed popularity distribution, code sizes a log-normal one with a long tail (so
+some bodies are large enough to be stored compressed), and a few percent of snippets reuse
+a common body (license headers, boilerplate) so that deduplication has work to do. Tags follow
+a Zipf-like distribution: the most common one is on 40% of snippets, the rarest on 2%. Snippets
+are loaded through the same batched import path as the import command.
+
+Usage:
+    python benchmarks/generate.py [--size small|medium|large | --snippets N] [--seed S] [--output FILE] [--force]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, "lib")
+DATA = os.path.join(ROOT, "benchmarks", "data")
+
+SIZES = {
+    "small": 10_000,
+    "medium": 1_000_000,
+    "large": 5_000_000,
+}
+DEFAULT_SEED = 42
+
+# (language, weight, line templates). '{a}' and '{b}' are replaced by identifiers, '{n}' by a number.
+LANGUAGES = [
+    ("python", 30, ["def {a}({b}):", "    return {b} + {n}", "{a} = [{b} for {b} in range({n})]",
+        "import {a}", "    if {b} is None:", "        raise ValueError('{a}')", "class {a}:"]),
+    ("javascript", 22, ["function {a}({b}) {{", "  return {b} * {n};", "}}", "const {a} = require('{b}');",
+        "  if (!{b}) throw new Error('{a}');", "export default {a};"]),
+    ("typescript", 12, ["export function {a}({b}: number): number {{", "  return {b} + {n};", "}}",
+        "interface {a} {{ {b}: string; }}", "const {a}: {b}[] = [];"]),
+    ("java", 9, ["public class {a} {{", "    private int {b} = {n};", "    public int {a}() {{ return {b}; }}",
+        "}}", "import java.util.{a};"]),
+    ("go", 7, ["func {a}({b} int) int {{", "\treturn {b} + {n}", "}}", "import \"{a}\"",
+        "if err != nil {{ return {b} }}"]),
+    ("sql", 6, ["SELECT {a}, {b} FROM {a}s WHERE id = {n};", "CREATE INDEX ix_{a}_{b} ON {a}s ({b});",
+        "UPDATE {a}s SET {b} = {n};"]),
+    ("bash", 5, ["for {a} in $(seq {n}); do", "  echo \"${a}\" >> {b}.log", "done", "export {a}={b}"]),
+    ("rust", 4, ["fn {a}({b}: u32) -> u32 {{", "    {b} + {n}", "}}", "use std::{a}::{b};"]),
+    ("c", 3, ["int {a}(int {b}) {{", "    return {b} + {n};", "}}", "#include <{a}.h>"]),
+    ("ruby", 2, ["def {a}({b})", "  {b} + {n}", "end", "require '{a}'"]),
+]
+
+WORDS = ["parse", "config", "cache", "retry", "debounce", "merge", "sort", "stream", "token", "buffer",
+    "queue", "worker", "client", "server", "request", "response", "format", "render", "encode", "decode",
+    "hash", "index", "search", "filter", "batch", "upload", "download", "connect", "session", "logger",
+    "metrics", "schema", "migrate", "validate", "serialize", "flatten", "chunk", "throttle", "pool", "lock"]
+
+# Bodies shared verbatim by many snippets.
+COMMON_BODIES = [
+    "# Licensed under the MIT License.\n# See LICENSE for details.\n",
+    "if __name__ == '__main__':\n    main()\n",
+    "#!/usr/bin/env bash\nset -euo pipefail\n",
+    "'use strict';\n\nmodule.exports = {};\n",
+    "SELECT 1;\n",
+]
+DUPLICATE_RATE = 0.03
+
+# Tag i is put on a snippet with probability TAG_RATE / (i + 1), about 1.4 tags per snippet.
+TAGS = ["web", "cli", "async", "testing", "database", "security", "legacy", "perf", "io", "parsing",
+    "networking", "config", "logging", "crypto", "math", "ui", "concurrency", "cache", "auth", "deprecated"]
+TAG_RATE = 0.4
+
+# Code length in lines: log-normal with a median of about 12 lines.
+LINES_MU = math.log(12)
+LINES_SIGMA = 1.0
+MAX_LINES = 3000
+
+def store_shape(snippets):
+    """
+    Returns the number of users and collections generated for a store of the given size.
+
+    Args:
+        snippets (int): The number of snippets.
+
+    Returns:
+        tuple: The number of users and of collections.
+    """
+    return max(5, min(snippets // 1000, 5000)), max(10, min(snippets // 200, 25000))
+
+def user_name(index):
+    return f"user{index:05d}"
+
+def collection_name(index):
+    return f"{WORDS[index % len(WORDS)]}_{WORDS[(index * 7) % len(WORDS)]}_{index}"
+
+def generate_code(rng, templates):
+    lines = min(MAX_LINES, max(1, int(rng.lognormvariate(LINES_MU, LINES_SIGMA))))
+    return "\n".join(
+        rng.choice(templates).format(a=rng.choice(WORDS), b=rng.choice(WORDS) + str(rng.randrange(100)),
+            n=rng.randrange(10000))
+        for _ in range(lines)) + "\n"
+
+def generate_records(snippets, seed=DEFAULT_SEED):
+    """
+    Yields the snippet records of a synthetic store.
+
+    Args:
+        snippets (int): The number of snippets.
+        seed (int): The random seed (default: DEFAULT_SEED).
+
+    Yields:
+        tuple: ('generated:<n>', record) pairs in the format read by importer.import_snippets.
+    """
+    rng = random.Random(seed)
+    users, collections = store_shape(snippets)
+    names = [language for language, _, _ in LANGUAGES]
+    weights = [weight for _, weight, _ in LANGUAGES]
+    templates = {language: lines for language, _, lines in LANGUAGES}
+    for index in range(snippets):
+        language = rng.choices(names, weights)[0]
+        if rng.random() < DUPLICATE_RATE:
+            code = rng.choice(COMMON_BODIES)
+        else:
+            code = generate_code(rng, templates[language])
+        yield f"generated:{index + 1}", {
+            "title": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {index + 1}",
+            "description": f"How to {rng.choice(WORDS)} a {rng.choice(WORDS)}" if rng.random() < 0.6 else None,
+            "language": language,
+            "code": code,
+            # Skewed towards low indexes, so some users and collections are much larger than others.
+            "collection": collection_name(int(collections * rng.random() ** 2)),
+            "user": user_name(int(users * rng.random() ** 2)),
+        }
+
+def generate_tags(snippets, seed=DEFAULT_SEED):
+    """
+    Yields the tags of the snippets of a synthetic store.
+
+    Args:
+        snippets (int): The number of snippets.
+        seed (int): The random seed (default: DEFAULT_SEED).
+
+    Yields:
+        tuple: (snippet ID, tag ID) pairs, where the tag with ID i is TAGS[i - 1].
+    """
+    rng = random.Random(seed + 1)
+    for snippet_id in range(1, snippets + 1):
+        for index in range(len(TAGS)):
+            if rng.random() < TAG_RATE / (index + 1):
+                yield snippet_id, index + 1
+
+def default_path(snippets, seed):
+    size = next((name for name, count in SIZES.items() if count == snippets), str(snippets))
+    return os.path.join(DATA, f"{size}-{seed}.db")
+
+def generate(path, snippets, seed=DEFAULT_SEED, quiet=False):
+    """
+    Creates a database at path holding a synthetic store.
+
+    Must be called before anything else imports the application modules, since the database
+    URL is read when they are first imported.
+
+    Args:
+        path (str): The database file to create. It must not exist yet.
+        snippets (int): The number of snippets.
+        seed (int): The random seed (default: DEFAULT_SEED).
+        quiet (bool): Do not print progress (default: False).
+
+    Returns:
+        dict: A description of the generated store, including the import throughput.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    sys.path.insert(0, LIB)
+    from sqlalchemy import insert
+    from database import Session, create_tables, close_database
+    from importer import import_snippets
+    from models import User, Tag, SnippetTag
+
+    def on_progress(imported, rejected, elapsed):
+        if not quiet:
+            print(f"  {imported} snippets ({imported / elapsed if elapsed else 0:.0f}/s)", file=sys.stderr)
+
+    create_tables()
+    session = Session()
+    try:
+        users, collections = store_shape(snippets)
+        session.execute(insert(User.__table__), [{"username": user_name(i)} for i in range(users)])
+        session.commit()
+        start = time.perf_counter()
+        imported, rejected = import_snippets(session, generate_records(snippets, seed), on_progress=on_progress)
+        elapsed = time.perf_counter() - start
+        session.execute(insert(Tag.__table__), [{"id": index + 1, "name": name, "revision": 0}
+            for index, name in enumerate(TAGS)])
+        tagged = 0
+        batch = []
+        for snippet_id, tag_id in generate_tags(snippets, seed):
+            batch.append({"snippet_id": snippet_id, "tag_id": tag_id})
+            if len(batch) == 10000:
+                session.execute(insert(SnippetTag.__table__), batch)
+                tagged += len(batch)
+                batch = []
+        if batch:
+            session.execute(insert(SnippetTag.__table__), batch)
+            tagged += len(batch)
+        session.commit()
+    finally:
+        session.close()
+        close_database()
+    return {
+        "path": path,
+        "snippets": imported,
+        "rejected": rejected,
+        "users": users,
+        "collections": collections,
+        "tagged": tagged,
+        "seed": seed,
+        "import_seconds": round(elapsed, 3),
+        "import_rate": round(imported / elapsed if elapsed else 0),
+        "file_bytes": os.path.getsize(path),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--size", choices=SIZES, default="small", help="store size preset (default: small)")
+    group.add_argument("--snippets", type=int, help="number of snippets, instead of a preset")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"random seed (default: {DEFAULT_SEED})")
+    parser.add_argument("--output", help="database file (default: benchmarks/data/<size>-<seed>.db)")
+    parser.add_argument("--force", action="store_true", help="replace the database if it exists")
+    options = parser.parse_args()
+
+    snippets = options.snippets or SIZES[options.size]
+    path = options.output or default_path(snippets, options.seed)
+    if os.path.exists(path):
+        if not options.force:
+            print(f"{path} already exists. Use --force to regenerate it.", file=sys.stderr)
+            return 1
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    print(json.dumps(generate(path, snippets, options.seed), indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# benchmarks/loadtest.py
+"""
+Load test for the HTTP/JSON API started by 'main.py serve'.
+
+Opens a number of keep-alive connections and sends a read-heavy mix of requests (view,
+list page, filtered list page, full-text search) on all of them at once for a fixed time,
+then reports requests per second and latency percentiles. With --spawn, a server is started
+on a free port against the given database and stopped afterwards.
+
+Usage:
+    python benchmarks/loadtest.py [--url http://127.0.0.1:8080] [--spawn DB] [--workers N]
+        [--connections N] [--duration SECONDS] [--writes PCT] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, "lib")
+
+SEARCH_TERMS = ["debounce", "config", "parse", "cache", "retry", "stream", "token"]
+LANGUAGES = ["python", "javascript", "typescript", "go", "rust"]
+
+class Connection:
+    """
+    A minimal keep-alive HTTP/1.1 client connection.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.writer.write((f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n").encode("latin-1") + data)
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        headers = head.decode("latin-1").lower()
+        match = re.search(r"content-length: (\d+)", headers)
+        if match:
+            await self.reader.readexactly(int(match.group(1)))
+        elif "transfer-encoding: chunked" in headers:
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).strip(), 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        return status
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+def next_request(rng, max_id, writes):
+    """
+    Picks the next request of the mix as (kind, method, path, body).
+    """
+    if rng.random() * 100 < writes:
+        return ("update", "PATCH", f"/snippets/{rng.randint(1, max_id)}",
+            {"description": f"load test {rng.randrange(1_000_000)}"})
+    roll = rng.random()
+    if roll < 0.5:
+        return "view", "GET", f"/snippets/{rng.randint(1, max_id)}", None
+    if roll < 0.7:
+        return "list", "GET", f"/snippets?limit=50&after={rng.randint(0, max_id)}", None
+    if roll < 0.85:
+        return "filter", "GET", f"/snippets?limit=50&language={rng.choice(LANGUAGES)}", None
+    return "search", "GET", f"/search?q={rng.choice(SEARCH_TERMS)}&limit=20", None
+
+async def client(index, host, port, deadline, max_id, writes, latencies, statuses):
+    rng = random.Random(index)
+    connection = Connection(host, port)
+    await connection.open()
+    try:
+        while time.perf_counter() < deadline:
+            kind, method, path, body = next_request(rng, max_id, writes)
+            start = time.perf_counter()
+            status = await connection.request(method, path, body)
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        await connection.close()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run(host, port, connections, duration, writes):
+    probe = Connection(host, port)
+    await probe.open()
+    await probe.request("GET", "/health")
+    await probe.close()
+    max_id = await highest_id(host, port)
+    latencies = {}
+    statuses = {}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(client(i, host, port, deadline, max_id, writes, latencies, statuses)
+        for i in range(connections)))
+    elapsed = time.perf_counter() - start
+    every = [latency for values in latencies.values() for latency in values]
+    summary = {
+        "connections": connections,
+        "duration_s": round(elapsed, 2),
+        "requests": len(every),
+        "requests_per_s": round(len(every) / elapsed, 1),
+        "p50_ms": round(percentile(every, 0.50) * 1000, 2) if every else None,
+        "p99_ms": round(percentile(every, 0.99) * 1000, 2) if every else None,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "by_kind": {kind: {
+            "requests": len(values),
+            "mean_ms": round(statistics.mean(values) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        } for kind, values in sorted(latencies.items())},
+    }
+    return summary
+
+async def highest_id(host, port):
+    """
+    Finds the highest snippet ID with a binary search on the 'after' parameter of the listing.
+    """
+    connection = Connection(host, port)
+    await connection.open()
+    try:
+        async def any_after(after):
+            connection.writer.write(f"GET /snippets?limit=1&after={after} HTTP/1.1\r\nHost: {host}\r\n\r\n"
+                .encode("latin-1"))
+            await connection.writer.drain()
+            head = await connection.reader.readuntil(b"\r\n\r\n")
+            body = b""
+            if b"chunked" in head.lower():
+                while True:
+                    size = int((await connection.reader.readuntil(b"\r\n")).strip(), 16)
+                    body += (await connection.reader.readexactly(size + 2))[:-2]
+                    if size == 0:
+                        break
+            return bool(json.loads(body)["snippets"])
+
+        low, high = 0, 1
+        while await any_after(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if await any_after(middle):
+                low = middle
+            else:
+                high = middle
+        return max(high, 1)
+    finally:
+        await connection.close()
+
+def spawn_server(database, workers):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.abspath(database)}")
+    process = subprocess.Popen([sys.executable, "main.py", "serve", "--port", str(port), "--workers", str(workers)],
+        cwd=LIB, env=env, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if "Serving" not in line:
+        process.kill()
+        raise RuntimeError(f"The server did not start: {line.strip()}")
+    return process, port
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="server to test (default: http://127.0.0.1:8080)")
+    parser.add_argument("--spawn", metavar="DB", help="start a server against this database for the test")
+    parser.add_argument("--workers", type=int, default=8, help="database workers of a spawned server (default: 8)")
+    parser.add_argument("--connections", type=int, default=200, help="concurrent connections (default: 200)")
+    parser.add_argument("--duration", type=float, default=10, help="test duration in seconds (default: 10)")
+    parser.add_argument("--writes", type=float, default=0, help="percent of requests that update a snippet (default: 0)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args()
+
+    process = None
+    url = urlsplit(options.url)
+    host, port = url.hostname, url.port or 80
+    if options.spawn:
+        process, port = spawn_server(options.spawn, options.workers)
+        host = "127.0.0.1"
+    try:
+        summary = asyncio.run(run(host, port, options.connections, options.duration, options.writes))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    print(f"{summary['requests']} requests in {summary['duration_s']}s over {summary['connections']} connections")
+    print(f"  {summary['requests_per_s']} requests/s, p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms")
+    print(f"  statuses: {summary['statuses']}")
+    for kind, stats in summary["by_kind"].items():
+        print(f"  {kind:8} {stats['requests']:8} requests  mean {stats['mean_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms")
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+    return 0 if all(status.startswith("2") for status in summary["statuses"]) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# benchmarks/startup.py
+"""
+Startup-time benchmark for one-shot invocations of lib/main.py.
+
+Runs each command several times in a fresh interpreter against a small temporary database
+and fails if the median wall time of any command exceeds its budget.
+
+Usage:
+    python benchmarks/startup.py [--runs N] [--budget-ms MS] [--help-budget-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, "lib")
+MAIN = os.path.join(LIB, "main.py")
+
+# Commands that touch the database, and those that must not even import SQLAlchemy.
+DATABASE_COMMANDS = [
+    ["view", "1"],
+    ["list", "snippets", "--limit", "10"],
+    ["search", "language", "python", "--limit", "10"],
+    ["find", "debounce"],
+]
+OFFLINE_COMMANDS = [
+    ["help"],
+]
+
+def run(argv, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, MAIN] + argv, cwd=LIB, env=env, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+def prepare_database(directory, env):
+    records = os.path.join(directory, "records.jsonl")
+    with open(records, "w", encoding="utf-8") as file:
+        for i in range(100):
+            file.write(json.dumps({"title": f"debounce helper {i}", "language": "python",
+                "code": f"def debounce_{i}(fn):\n    return fn\n", "collection": "bench"}) + "\n")
+    run(["user", "bench"], env)
+    run(["import", records, "--user", "bench"], env)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=7, help="runs per command (default: 7)")
+    parser.add_argument("--budget-ms", type=float, default=450,
+        help="median budget for database commands in milliseconds (default: 450)")
+    parser.add_argument("--help-budget-ms", type=float, default=100,
+        help="median budget for commands that do not touch the database (default: 100)")
+    options = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        prepare_database(directory, env)
+        for commands, budget in [(OFFLINE_COMMANDS, options.help_budget_ms), (DATABASE_COMMANDS, options.budget_ms)]:
+            for argv in commands:
+                timings = [run(argv, env) for _ in range(options.runs)]
+                median = statistics.median(timings)
+                status = "ok" if median <= budget else "OVER BUDGET"
+                failed = failed or median > budget
+                print(f"{' '.join(argv):45} median {median:7.1f} ms  max {max(timings):7.1f} ms  "
+                    f"budget {budget:.0f} ms  {status}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
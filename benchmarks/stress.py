@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# benchmarks/stress.py
+"""
+Multi-process write stress test.
+
+Starts a number of processes that all write to the same SQLite database at once for a fixed
+time: they add snippets to collections that none of them has created yet, so that every new
+collection is raced for, and update snippets they added earlier. Every write goes through
+database.write_with_retry. Reports the sustained write throughput, how often a write had to
+start over because the database was locked, and how many writes failed for good. Run with
+--retries 0 to see how many writes fail without the retrying write path, and with a short
+--busy-timeout to make SQLite give up waiting for the lock sooner, as it does under heavier load.
+With --shards, every process writes as a user of its own in the sharded layout, so processes
+only share the catalog, when they create collections.
+
+Usage:
+    python benchmarks/stress.py [--db FILE] [--processes N] [--duration SECONDS]
+        [--retries N] [--busy-timeout MS] [--updates PCT] [--per-collection N] [--shards]
+        [--output FILE]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, "lib")
+
+USERNAME = "stress_user"
+LANGUAGES = ["python", "javascript", "go", "rust"]
+
+def use_database(path, busy_timeout=None, shards=False):
+    """
+    Points the application modules at the database, and its shard directory if shards is set;
+    must run before they are imported.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    if shards:
+        os.environ["SHARD_DIRECTORY"] = os.path.abspath(path) + ".shards"
+    if LIB not in sys.path:
+        sys.path.insert(0, LIB)
+    if busy_timeout is not None:
+        import config
+        config.DATABASE_PROFILES[config.DATABASE_PROFILE]["pragmas"]["busy_timeout"] = busy_timeout
+
+def worker(index, path, start_at, duration, retries, busy_timeout, updates, per_collection, shards, results):
+    use_database(path, busy_timeout, shards)
+    from database import write_with_retry, close_database
+    from store import create_snippet, get_or_create_user, update_snippet
+    from shards import route_user
+
+    rng = random.Random(index)
+    counts = {"writes": 0, "creates": 0, "updates": 0, "retries": 0, "failures": 0}
+    errors = {}
+    own = []
+    username = f"{USERNAME}_{index}" if shards else USERNAME
+    routes = {}
+
+    def on_retry(attempt, error):
+        counts["retries"] += 1
+
+    def add(session, number):
+        snippet = create_snippet(session, f"Stress {index} {number}", None, rng.choice(LANGUAGES),
+            f"def stress_{index}_{number}():\n    return {number}\n",
+            collection_name(number), username)
+        session.flush()
+        return snippet.id
+
+    def change(session, snippet_id, number):
+        update_snippet(session, snippet_id, description=f"Updated {number}")
+
+    def collection_name(number):
+        # Every process moves on to the next collection at about the same time.
+        return f"stress {number // per_collection}"
+
+    def sessions_for(number):
+        # The collection goes into the catalog and the user's shard once, before its first snippet.
+        name = collection_name(number)
+        if name not in routes:
+            routes[name] = route_user(username, [name])
+        return routes[name]
+
+    write_with_retry(lambda session: get_or_create_user(session, username), retries=max(retries, 10))
+    time.sleep(max(0, start_at - time.time()))
+    deadline = time.time() + duration
+    number = 0
+    while time.time() < deadline:
+        number += 1
+        try:
+            if own and rng.random() * 100 < updates:
+                write_with_retry(lambda session: change(session, rng.choice(own), number), retries=retries,
+                    on_retry=on_retry, session_factory=sessions_for(0))
+                counts["updates"] += 1
+            else:
+                own.append(write_with_retry(lambda session: add(session, number), retries=retries,
+                    on_retry=on_retry, session_factory=sessions_for(number)))
+                counts["creates"] += 1
+            counts["writes"] += 1
+        except Exception as e:
+            counts["failures"] += 1
+            message = str(e).splitlines()[0][:120]
+            errors[message] = errors.get(message, 0) + 1
+    close_database()
+    results.put((counts, errors))
+
+def prepare(path, shards=False):
+    use_database(path, shards=shards)
+    from database import create_tables, close_database
+    create_tables()
+    close_database()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database to write to (default: a new temporary database)")
+    parser.add_argument("--processes", type=int, default=8, help="concurrent writer processes (default: 8)")
+    parser.add_argument("--duration", type=float, default=10, help="test duration in seconds (default: 10)")
+    parser.add_argument("--retries", type=int, help="retries per write (default: WRITE_RETRIES)")
+    parser.add_argument("--busy-timeout", type=int, metavar="MS",
+        help="how long SQLite waits for the lock (default: the profile's busy_timeout)")
+    parser.add_argument("--updates", type=float, default=20, help="percent of writes that update a snippet (default: 20)")
+    parser.add_argument("--per-collection", type=int, default=25,
+        help="snippets each process adds before all move on to a new collection (default: 25)")
+    parser.add_argument("--shards", action="store_true", help="give every process a user and a shard of its own")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args()
+
+    directory = None
+    path = options.db
+    if path is None:
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "stress.db")
+    prepare(path, options.shards)
+    from config import WRITE_RETRIES
+    retries = WRITE_RETRIES if options.retries is None else options.retries
+
+    # Fresh interpreters, so that no process inherits another's connections.
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_at = time.time() + 1 + 0.1 * options.processes
+    processes = [context.Process(target=worker, args=(index, path, start_at, options.duration, retries,
+        options.busy_timeout, options.updates, options.per_collection, options.shards, results))
+        for index in range(options.processes)]
+    for process in processes:
+        process.start()
+    totals = {"writes": 0, "creates": 0, "updates": 0, "retries": 0, "failures": 0}
+    errors = {}
+    for _ in processes:
+        counts, process_errors = results.get()
+        for key, value in counts.items():
+            totals[key] += value
+        for message, count in process_errors.items():
+            errors[message] = errors.get(message, 0) + count
+    for process in processes:
+        process.join()
+    if directory:
+        directory.cleanup()
+
+    summary = dict(totals, processes=options.processes, shards=options.shards, duration_s=options.duration,
+        retry_limit=retries,
+        busy_timeout_ms=options.busy_timeout,
+        writes_per_s=round(totals["writes"] / options.duration, 1), errors=errors)
+    print(f"{totals['writes']} writes in {options.duration}s from {options.processes} processes "
+        f"({totals['creates']} creates, {totals['updates']} updates)")
+    print(f"  {summary['writes_per_s']} writes/s sustained, {totals['retries']} retries, "
+        f"{totals['failures']} failed writes (retry limit {retries})")
+    for message, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"  {count:6}  {message}")
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+    return 0 if totals["failures"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
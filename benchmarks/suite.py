@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# benchmarks/suite.py
+"""
+Command benchmark suite against a generated snippet store.
+
+Each command in lib/commands.py is timed cold (right after the engine is disposed and the
+snippet cache cleared, so connections, pragmas and SQLite's page cache start empty) and warm
+(repeated runs on the same connection). The operating system's file cache is not dropped, so
+a cold run still reads the file from memory. Peak Python memory of each command is measured
+in a separate run under tracemalloc. Results are written as JSON and can be compared against
+an earlier run.
+
+The store is generated with benchmarks/generate.py on first use and reused afterwards.
+
+Usage:
+    python benchmarks/suite.py [--size small|medium|large] [--seed S] [--db FILE] [--runs N]
+        [--only NAME ...] [--output FILE] [--compare BASELINE.json] [--tolerance PCT]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generate
+
+# Heavy cases stream the whole store (or a large part of it); they get at most this many warm runs.
+HEAVY_RUNS = 2
+
+def build_cases(commands, sample, scratch):
+    """
+    Returns the benchmark cases as (name, heavy, callable) tuples.
+
+    Args:
+        commands (module): The commands module.
+        sample (dict): Values taken from the store: 'id', 'language', 'collection', 'user', 'terms'.
+        scratch (str): A directory for files written by the commands.
+    """
+    export_path = os.path.join(scratch, "export.jsonl")
+    return [
+        ("view", False, lambda: commands.view_snippet_command(sample["id"])),
+        ("history", False, lambda: commands.history_command(sample["id"])),
+        ("list_page", False, lambda: commands.list_snippets_command(100, None)),
+        ("list_page_deep", False, lambda: commands.list_snippets_command(100, sample["id"])),
+        ("list_all", True, lambda: commands.list_snippets_command(None, None)),
+        ("list_all_jsonl", True, lambda: commands.list_snippets_command(None, None, "jsonl")),
+        ("search_language", False, lambda: commands.search_snippets_command(sample["language"], None, None, 100, None)),
+        ("search_collection", False,
+            lambda: commands.search_snippets_command(None, sample["collection"], None, 100, None)),
+        ("search_user", False, lambda: commands.search_snippets_command(None, None, sample["user"], 100, None)),
+        ("search_tags", False,
+            lambda: commands.search_snippets_command(None, None, None, 100, None, None, ["web", "async"], ["legacy"])),
+        ("search_tags_language", False, lambda: commands.search_snippets_command(sample["language"], None, None,
+            100, None, None, ["testing", "security"])),
+        ("find", False, lambda: commands.find_snippets_command(sample["terms"], 20)),
+        ("related", False, lambda: commands.related_command("debounce an input handler", 20)),
+        ("grep", False, lambda: commands.grep_snippets_command(r"raise ValueError\('(chunk|cache)'\)")),
+        ("list_collections", False, commands.list_collections_command),
+        ("dupes", False, lambda: commands.dupes_command(20)),
+        ("similar", False, lambda: commands.similar_command(sample["id"])),
+        ("cluster", True, lambda: commands.cluster_command()),
+        ("stats", False, lambda: commands.stats_command()),
+        ("stats_rebuild", True, lambda: commands.stats_command(rebuild=True)),
+        ("sync_export", True, lambda: commands.sync_export_command(os.path.join(scratch, "changes.jsonl"), 0)),
+        ("compact", True, lambda: commands.compact_command(False)),
+        ("export_language", True, lambda: commands.export_snippets_command(export_path, "jsonl", "ruby", None, None)),
+        ("update", False, lambda: commands.update_snippet_command(sample["id"], title=f"benchmark {time.time_ns()}")),
+        ("view_version", False, lambda: commands.view_version_command(sample["id"], 1)),
+        # add and delete run the same number of times, so they leave the store as they found it.
+        ("add", False, lambda: commands.create_snippet_command("benchmark snippet", None, "python",
+            f"print({time.time_ns()})", sample["collection"], sample["user"])),
+        ("delete", False, lambda: commands.delete_snippet_command(sample["last_id"]())),
+    ]
+
+def store_sample(session_factory):
+    """
+    Picks the snippet, language, collection, user and search terms the cases work on.
+    """
+    from sqlalchemy import func
+    from models import Snippet, Collection, User
+    session = session_factory()
+    top_id = session.query(func.max(Snippet.id)).scalar()
+    middle = session.query(Snippet).filter(Snippet.id >= top_id // 2).order_by(Snippet.id).first()
+    return {
+        "id": middle.id,
+        "language": "python",
+        "collection": session.query(Collection.name).filter(Collection.id == middle.collection_id).scalar(),
+        "user": session.query(User.username).filter(User.id == middle.user_id).scalar(),
+        "terms": ["debounce", "config"],
+        "last_id": lambda: session_factory().query(func.max(Snippet.id)).scalar(),
+    }
+
+def measure(case, runs, reset):
+    """
+    Times one case cold and warm, then measures its peak memory.
+
+    Returns:
+        dict: Cold and warm timings in milliseconds and the peak traced memory in KiB.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        reset()
+        start = time.perf_counter()
+        case()
+        cold = (time.perf_counter() - start) * 1000
+        warm = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            case()
+            warm.append((time.perf_counter() - start) * 1000)
+        tracemalloc.start()
+        try:
+            case()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        "cold_ms": round(cold, 3),
+        "warm_median_ms": round(statistics.median(warm), 3) if warm else None,
+        "warm_min_ms": round(min(warm), 3) if warm else None,
+        "warm_max_ms": round(max(warm), 3) if warm else None,
+        "warm_runs": len(warm),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=generate.ROOT, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance, min_delta):
+    """
+    Prints the change of every case against a baseline and returns the regressed case names.
+
+    A case regresses when its warm median (or its cold time, for cases without warm runs) is
+    more than tolerance percent and more than min_delta milliseconds slower than in the
+    baseline. The absolute floor keeps timer noise on sub-millisecond cases from failing a run.
+    """
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('revision')} ({baseline['meta'].get('timestamp')}):")
+    for name, result in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if not before:
+            print(f"  {name:20} new")
+            continue
+        key = "warm_median_ms" if result["warm_median_ms"] is not None and before.get("warm_median_ms") else "cold_ms"
+        change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        regressed = change > tolerance and result[key] - before[key] > min_delta
+        if regressed:
+            regressions.append(name)
+        print(f"  {name:20} {before[key]:10.2f} -> {result[key]:10.2f} ms  {change:+6.1f}%"
+            f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=generate.SIZES, default="small", help="store size preset (default: small)")
+    parser.add_argument("--seed", type=int, default=generate.DEFAULT_SEED,
+        help=f"generator seed (default: {generate.DEFAULT_SEED})")
+    parser.add_argument("--db", help="benchmark this database instead of a generated one")
+    parser.add_argument("--runs", type=int, default=5, help="warm runs per case (default: 5)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only run these cases")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<size>-<timestamp>.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare with an earlier results file")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+        help="percent slowdown that counts as a regression (default: 10)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+        help="smaller slowdowns never count as a regression (default: 0.5)")
+    options = parser.parse_args()
+
+    path = options.db or generate.default_path(generate.SIZES[options.size], options.seed)
+    store = None
+    if not os.path.exists(path):
+        print(f"Generating {path}...", file=sys.stderr)
+        store = generate.generate(path, generate.SIZES[options.size], options.seed)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    if generate.LIB not in sys.path:
+        sys.path.insert(0, generate.LIB)
+    import commands
+    from cache import snippet_cache
+    from database import Session, create_tables, close_database
+
+    def reset():
+        close_database()
+        snippet_cache.clear()
+
+    create_tables()
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    results = {
+        "meta": {
+            "timestamp": timestamp,
+            "revision": git_revision(),
+            "database": path,
+            "size": None if options.db else options.size,
+            "seed": None if options.db else options.seed,
+            "snippets": None,
+            "store": store,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": options.runs,
+        },
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as scratch:
+        sample = store_sample(Session)
+        results["meta"]["snippets"] = sample["last_id"]()
+        for name, heavy, case in build_cases(commands, sample, scratch):
+            if options.only and name not in options.only:
+                continue
+            runs = min(options.runs, HEAVY_RUNS) if heavy else options.runs
+            result = measure(case, runs, reset)
+            results["cases"][name] = result
+            warm = f"{result['warm_median_ms']:10.2f}" if result["warm_median_ms"] is not None else f"{'-':>10}"
+            print(f"{name:20} cold {result['cold_ms']:10.2f} ms  warm {warm} ms  peak {result['peak_kib']:10.1f} KiB")
+        close_database()
+        results["meta"]["max_rss_kib"] = _max_rss_kib()
+
+    output = options.output or os.path.join(generate.ROOT, "benchmarks", "results",
+        f"{results['meta']['size'] or 'custom'}-{timestamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), options.tolerance, options.min_delta_ms)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed by more than {options.tolerance:g}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+def _max_rss_kib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# lib/batch.py
+import time
+from config import BATCH_FLUSH_SIZE
+from store import create_user, create_snippet, update_snippet, delete_snippet
+
+def read_script(file):
+    """
+    Reads the commands of a batch script, skipping blank lines and '#' comments.
+
+    Args:
+        file (file): The open script.
+
+    Yields:
+        tuple: The line number and the command.
+    """
+    for line_number, line in enumerate(file, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line_number, line
+
+def _create_user(session, users, collections, username):
+    users[username] = create_user(session, username)
+
+def _create_snippet(session, users, collections, title, description, language, code, collection_name, username):
+    create_snippet(session, title, description, language, code, collection_name, username, users, collections)
+
+def _update_snippet(session, users, collections, snippet_id, title=None, description=None, language=None, code=None):
+    update_snippet(session, snippet_id, title, description, language, code)
+
+def _delete_snippet(session, users, collections, snippet_id):
+    delete_snippet(session, snippet_id)
+
+# The commands a batch can run, by the name of their command function.
+BATCH_OPERATIONS = {
+    'create_user_command': _create_user,
+    'create_snippet_command': _create_snippet,
+    'update_snippet_command': _update_snippet,
+    'delete_snippet_command': _delete_snippet,
+}
+
+def run_batch(session, commands, parse, commit_every=0, on_error=None, group_size=BATCH_FLUSH_SIZE):
+    """
+    Runs a script of write commands in one session.
+
+    Lines run in groups of group_size inside a savepoint and are flushed together. If anything
+    in a group fails, the savepoint is rolled back and the group is replayed one line per
+    savepoint, so only the failing lines are rejected and the rest of the batch carries on.
+    Everything is committed once at the end, or every commit_every successful lines. Users and
+    collections are looked up once per batch and kept, so lines that share them do not query
+    them again.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        commands (iterable): (line number, command) pairs, as yielded by read_script.
+        parse (callable): Turns a command into a (command function, arguments) pair.
+        commit_every (int): Commit after this many successful lines; 0 commits once at the end
+            (default: 0).
+        on_error (callable, optional): Called as on_error(line_number, command, error) for
+            every line that fails.
+        group_size (int): The number of lines flushed together (default: BATCH_FLUSH_SIZE).
+
+    Returns:
+        tuple: The number of lines that succeeded and failed, the number of commits, and the
+        elapsed time in seconds.
+    """
+    session.expire_on_commit = False
+    users = {}
+    collections = {}
+    counts = {'succeeded': 0, 'failed': 0, 'commits': 0, 'pending': 0}
+    if commit_every:
+        group_size = min(group_size, commit_every)
+    start = time.perf_counter()
+
+    def fail(line_number, command, error):
+        counts['failed'] += 1
+        if on_error:
+            on_error(line_number, command, error)
+
+    def run_line(operation, args):
+        # Runs one line in its own savepoint; returns the error that made it fail, if any.
+        try:
+            with session.begin_nested():
+                operation(session, users, collections, *args)
+                session.flush()
+        except Exception as e:
+            _forget_cached(users, collections)
+            return e
+        return None
+
+    def run_group(group):
+        try:
+            with session.begin_nested():
+                for _, _, operation, args in group:
+                    if operation:
+                        operation(session, users, collections, *args)
+                session.flush()
+        except Exception:
+            _forget_cached(users, collections)
+            group = [(line_number, command, operation, args) if not operation
+                else (line_number, command, None, run_line(operation, args))
+                for line_number, command, operation, args in group]
+        succeeded = 0
+        for line_number, command, operation, result in group:
+            if isinstance(result, Exception):
+                fail(line_number, command, result)
+            else:
+                succeeded += 1
+        counts['succeeded'] += succeeded
+        counts['pending'] += succeeded
+        if commit_every and counts['pending'] >= commit_every:
+            session.commit()
+            counts['commits'] += 1
+            counts['pending'] = 0
+
+    group = []
+    for line_number, command in commands:
+        try:
+            func, args = parse(command)
+            operation = BATCH_OPERATIONS.get(getattr(func, '__name__', None))
+            if operation is None:
+                raise ValueError(f"'{command.split()[0]}' cannot be used in a batch. "
+                    "Only user, add, update and delete can.")
+            group.append((line_number, command, operation, args))
+        except ValueError as e:
+            # Kept in the group, so that errors are reported in line order.
+            group.append((line_number, command, None, e))
+        if len(group) >= group_size:
+            run_group(group)
+            group = []
+    if group:
+        run_group(group)
+    if counts['pending']:
+        session.commit()
+        counts['commits'] += 1
+    return counts['succeeded'], counts['failed'], counts['commits'], time.perf_counter() - start
+
+def _forget_cached(users, collections):
+    """
+    Drops the cached users and collections after a savepoint is rolled back.
+
+    A user or collection created by an upsert is loaded by a query, so it stays in the session
+    even when the savepoint that inserted it is rolled back; the caches cannot tell it apart.
+    """
+    users.clear()
+    collections.clear()
@@ -0,0 +1,264 @@
+# lib/blobs.py
+from sqlalchemy import LargeBinary, cast, column, event, func, insert, inspect, table, text, update
+from config import CODE_COMPRESSION, CODE_COMPRESSION_THRESHOLD
+from models import CodeBlob, Snippet, hash_code
+from compression import compress_code
+
+# A blob no snippet refers to.
+ORPHANED = "NOT EXISTS (SELECT 1 FROM snippets WHERE snippets.code_hash = code_blobs.hash)"
+
+def register_blob_events(session_factory):
+    """
+    Registers the flush hooks that keep code blobs shared and free of orphans.
+
+    Args:
+        session_factory (sqlalchemy.orm.sessionmaker): The factory whose sessions get the hooks.
+    """
+    event.listen(session_factory, 'before_flush', share_code_blobs)
+    event.listen(session_factory, 'after_flush', prune_replaced_blobs)
+
+def share_code_blobs(session, flush_context, instances):
+    """
+    Points snippets with new code at the stored blob for that code, if there is one.
+
+    Setting Snippet.code always creates a new CodeBlob. Before it is inserted, it is replaced
+    with the blob already stored under the same hash, or with the first new blob of this flush
+    that has the same hash, so every body is stored exactly once.
+    """
+    pending = {}
+    with session.no_autoflush:
+        for snippet in list(session.new) + list(session.dirty):
+            # A blob that was never loaded was not replaced either.
+            if not isinstance(snippet, Snippet) or 'blob' in inspect(snippet).unloaded or snippet.blob is None:
+                continue
+            blob = snippet.blob
+            if inspect(blob).persistent:
+                continue
+            shared = pending.get(blob.hash) or session.get(CodeBlob, blob.hash)
+            if shared is None:
+                pending[blob.hash] = blob
+                continue
+            if blob in session:
+                session.expunge(blob)
+            snippet.blob = shared
+
+def prune_replaced_blobs(session, flush_context):
+    """
+    Deletes the blobs that deleted or re-coded snippets no longer share with any other snippet.
+    """
+    hashes = set()
+    for snippet in session.deleted:
+        if isinstance(snippet, Snippet) and snippet.code_hash:
+            hashes.add(snippet.code_hash)
+    for snippet in session.dirty:
+        if isinstance(snippet, Snippet):
+            hashes.update(blob.hash for blob in inspect(snippet).attrs.blob.history.deleted if blob is not None)
+    if hashes:
+        prune_code_blobs(session.connection(), hashes)
+
+def prune_code_blobs(connection, hashes=None):
+    """
+    Deletes code blobs that no snippet refers to.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+        hashes (iterable, optional): Only consider these blobs. By default every blob is checked.
+
+    Returns:
+        int: The number of deleted blobs.
+    """
+    if hashes is None:
+        return connection.execute(text(f"DELETE FROM code_blobs WHERE {ORPHANED}")).rowcount
+    deleted = 0
+    for blob_hash in hashes:
+        deleted += connection.execute(text(f"DELETE FROM code_blobs WHERE hash = :hash AND {ORPHANED}"),
+            {"hash": blob_hash}).rowcount
+    return deleted
+
+def release_code_blobs(connection, hashes):
+    """
+    Notes the blobs a set-based change to snippets may leave unused, so that
+    prune_released_blobs can delete them afterwards.
+
+    The hashes are copied into a temporary table by one INSERT ... SELECT, so no row is fetched.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+        hashes (sqlalchemy.sql.Select): A query yielding the code hashes of the affected snippets.
+    """
+    connection.execute(text("CREATE TEMP TABLE IF NOT EXISTS released_blobs (hash VARCHAR PRIMARY KEY)"))
+    connection.execute(text("DELETE FROM released_blobs"))
+    connection.execute(insert(table('released_blobs', column('hash'))).from_select(['hash'], hashes.distinct()))
+
+def prune_released_blobs(connection):
+    """
+    Deletes the blobs noted by release_code_blobs that no snippet refers to any more.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside the same transaction.
+
+    Returns:
+        int: The number of deleted blobs.
+    """
+    deleted = connection.execute(text(f"DELETE FROM code_blobs WHERE hash IN (SELECT hash FROM released_blobs) "
+        f"AND {ORPHANED}")).rowcount
+    connection.execute(text("DELETE FROM released_blobs"))
+    return deleted
+
+def duplicate_groups(session, limit=20, members_limit=10):
+    """
+    Finds the code bodies shared by more than one snippet, most shared first.
+
+    The groups are read from the index on snippets.code_hash; no code is compared or loaded.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        limit (int): The maximum number of groups to return (default: 20).
+        members_limit (int): The maximum number of snippets listed per group (default: 10).
+
+    Returns:
+        list: (hash, size, count, snippets) tuples, where count is the number of snippets
+        sharing the body and snippets lists the (id, title, language) of the first of them.
+    """
+    groups = session.query(Snippet.code_hash, func.count(Snippet.id)) \
+        .group_by(Snippet.code_hash) \
+        .having(func.count(Snippet.id) > 1) \
+        .order_by(func.count(Snippet.id).desc(), Snippet.code_hash) \
+        .limit(limit).all()
+    result = []
+    for blob_hash, count in groups:
+        size = session.query(CodeBlob.size).filter(CodeBlob.hash == blob_hash).scalar() or 0
+        members = session.query(Snippet.id, Snippet.title, Snippet.language) \
+            .filter(Snippet.code_hash == blob_hash).order_by(Snippet.id).limit(members_limit).all()
+        result.append((blob_hash, size, count, members))
+    return result
+
+def storage_summary(session):
+    """
+    Summarizes how much code storage deduplication saves.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        tuple: The number of snippets, the number of distinct code bodies, the bytes of code
+        stored (after compression) and the bytes the snippets' code would take without sharing
+        or compression.
+    """
+    snippets, logical = session.query(func.count(Snippet.id), func.coalesce(func.sum(CodeBlob.size), 0)) \
+        .join(CodeBlob, Snippet.code_hash == CodeBlob.hash).one()
+    blobs, stored = session.query(func.count(CodeBlob.hash), func.coalesce(stored_bytes(), 0)).one()
+    return snippets, blobs, stored, logical
+
+def stored_bytes():
+    """
+    Returns a SQL expression for the total bytes the selected code blobs take on disk.
+    """
+    return func.sum(func.length(cast(CodeBlob.data, LargeBinary)))
+
+def compression_summary(session):
+    """
+    Summarizes how code bodies are stored.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        list: (codec, blobs, code bytes, stored bytes) rows, one per codec. The codec is None for
+        bodies stored as text.
+    """
+    return session.query(CodeBlob.codec, func.count(CodeBlob.hash), func.sum(CodeBlob.size), stored_bytes()) \
+        .group_by(CodeBlob.codec).order_by(CodeBlob.codec).all()
+
+def compact_code_blobs(session, codec=CODE_COMPRESSION, threshold=CODE_COMPRESSION_THRESHOLD, batch_size=500,
+        on_progress=None):
+    """
+    Compresses the stored code bodies that are above the threshold but still stored as text.
+
+    Blobs are rewritten in batches of batch_size, each in its own transaction, in hash order.
+    The code itself does not change, so neither does its hash or its full-text index entry.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        codec (str): The codec to compress with (default: CODE_COMPRESSION).
+        threshold (int): Only bodies larger than this many bytes are compressed
+            (default: CODE_COMPRESSION_THRESHOLD).
+        batch_size (int): The number of blobs rewritten per transaction (default: 500).
+        on_progress (callable, optional): Called as on_progress(compressed) after every batch.
+
+    Returns:
+        tuple: The number of compressed blobs, and their size in bytes before and after.
+    """
+    compressed = before = after = 0
+    last_hash = ''
+    while True:
+        rows = session.query(CodeBlob.hash, CodeBlob.data) \
+            .filter(CodeBlob.codec.is_(None), CodeBlob.size > threshold, CodeBlob.hash > last_hash) \
+            .order_by(CodeBlob.hash).limit(batch_size).all()
+        if not rows:
+            break
+        for blob_hash, body in rows:
+            data, used = compress_code(body, codec, threshold)
+            if used is None:
+                continue
+            session.execute(update(CodeBlob.__table__).where(CodeBlob.__table__.c.hash == blob_hash)
+                .values(body=data, codec=used))
+            compressed += 1
+            before += len(body.encode('utf-8'))
+            after += len(data)
+        session.commit()
+        last_hash = rows[-1][0]
+        if on_progress:
+            on_progress(compressed)
+    return compressed, before, after
+
+def database_size(connection):
+    """
+    Reports the size of the database file.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        tuple: The size of the file and of its free pages, in bytes.
+    """
+    page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+    pages = connection.exec_driver_sql("PRAGMA page_count").scalar()
+    free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    return pages * page_size, free * page_size
+
+def migrate_inline_code(connection):
+    """
+    Moves code stored inline in snippets.code into the code_blobs table.
+
+    Used when upgrading a database created before code blobs existed. Every distinct body is
+    stored once, snippets get its hash, and the old column is dropped.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+    """
+    columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(snippets)")]
+    if 'code' not in columns:
+        return
+    dbapi_connection = connection.connection.dbapi_connection
+    dbapi_connection.create_function('hash_code', 1, hash_code, deterministic=True)
+    if 'code_hash' not in columns:
+        connection.exec_driver_sql("ALTER TABLE snippets ADD COLUMN code_hash VARCHAR REFERENCES code_blobs (hash)")
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO code_blobs (hash, body, size) "
+        "SELECT hash_code(code), code, length(CAST(code AS BLOB)) FROM snippets")
+    connection.exec_driver_sql("UPDATE snippets SET code_hash = hash_code(code)")
+    connection.exec_driver_sql("ALTER TABLE snippets DROP COLUMN code")
+
+def add_codec_column(connection):
+    """
+    Adds the codec column to a code_blobs table created before bodies could be compressed.
+
+    Existing bodies stay uncompressed until the compact command compresses them.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+    """
+    columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(code_blobs)")]
+    if 'codec' not in columns:
+        connection.exec_driver_sql("ALTER TABLE code_blobs ADD COLUMN codec VARCHAR")
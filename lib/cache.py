@@ -0,0 +1,174 @@
+# lib/cache.py
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from config import SNIPPET_CACHE_SIZE, SNIPPET_CACHE_MAX_BYTES, SNIPPET_CACHE_TTL
+from models import Snippet
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache of strings with an entry limit, a size limit and a TTL.
+
+    Attributes:
+        max_entries (int): The maximum number of entries.
+        max_bytes (int): The maximum total length of the cached values, in characters.
+        ttl (float): The number of seconds an entry stays valid.
+        hits (int): The number of lookups that found a valid entry.
+        misses (int): The number of lookups that did not.
+        evictions (int): The number of entries dropped to stay within the limits.
+        expirations (int): The number of entries dropped because they outlived the TTL.
+        invalidations (int): The number of entries dropped because the snippet was written.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        """
+        Initializes a new, empty LRUCache.
+
+        Args:
+            max_entries (int): The maximum number of entries.
+            max_bytes (int): The maximum total length of the cached values, in characters.
+            ttl (float): The number of seconds an entry stays valid.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, key):
+        """
+        Looks up an entry and marks it as the most recently used.
+
+        Args:
+            key: The key.
+
+        Returns:
+            str: The cached value, or None if there is no valid entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores an entry, evicting the least recently used ones if the cache is full.
+
+        Values larger than the whole cache are not stored.
+
+        Args:
+            key: The key.
+            value (str): The value.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(value) > self.max_bytes or self.max_entries <= 0:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._bytes += len(value)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drops the entry for a key, if there is one.
+
+        Args:
+            key: The key.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Drops every entry. The statistics are kept.
+        """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the cache's statistics.
+
+        Returns:
+            dict: The number of entries and bytes held, the limits, the hit, miss, eviction,
+            expiration and invalidation counts, and the hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+# Rendered 'view' output of snippets, keyed by snippet ID.
+snippet_cache = LRUCache(SNIPPET_CACHE_SIZE, SNIPPET_CACHE_MAX_BYTES, SNIPPET_CACHE_TTL)
+
+def register_cache_events(session_factory):
+    """
+    Registers the hooks that drop cached snippets when a session commits changes to them.
+
+    Args:
+        session_factory (sqlalchemy.orm.sessionmaker): The factory whose sessions get the hooks.
+    """
+    event.listen(session_factory, 'after_flush', _collect_written_snippets)
+    event.listen(session_factory, 'do_orm_execute', _collect_bulk_writes)
+    event.listen(session_factory, 'after_commit', _invalidate_written_snippets)
+    event.listen(session_factory, 'after_rollback', _forget_written_snippets)
+
+def _collect_written_snippets(session, flush_context):
+    written = session.info.setdefault('written_snippets', set())
+    # Snippets are cached by their global ID; a shard's session knows what to add to its own IDs.
+    offset = session.info.get('id_offset', 0)
+    for snippet in list(session.dirty) + list(session.deleted):
+        if isinstance(snippet, Snippet) and snippet.id is not None:
+            written.add(snippet.id + offset)
+
+def _collect_bulk_writes(orm_execute_state):
+    # An UPDATE or DELETE by filter does not say which snippets it changed, so the whole cache
+    # is dropped when it commits.
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper \
+            and orm_execute_state.bind_mapper.class_ is Snippet:
+        orm_execute_state.session.info['bulk_written'] = True
+
+def _invalidate_written_snippets(session):
+    if session.info.pop('bulk_written', False):
+        snippet_cache.clear()
+    for snippet_id in session.info.pop('written_snippets', ()):
+        snippet_cache.invalidate(snippet_id)
+
+def _forget_written_snippets(session):
+    session.info.pop('written_snippets', None)
+    session.info.pop('bulk_written', None)
@@ -1,6 +1,32 @@
 # lib/commands.py
-from database import Session
-from models import User, Collection, Snippet
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from config import LIST_BATCH_SIZE, IMPORT_REJECTS_SHOWN, PROFILE_REPEAT_THRESHOLD, SERVER_HOST, SERVER_PORT, SERVER_WORKERS, \
+    BATCH_COMMIT_EVERY, SIMILARITY_THRESHOLD, SHARD_DIRECTORY, RELATED_BATCH_SIZE
+from database import Session, get_engine, write_with_retry
+from models import Collection, Snippet
+from search import full_text_search
+from grep import grep_snippets
+from similarity import similar_snippets, near_duplicate_clusters
+from related import index_pending, pending_count, related_snippets
+from store import create_user, create_snippet, update_snippet, delete_snippet, count_snippets_where, \
+    delete_snippets_where, update_snippets_where, get_user
+from queries import snippet_summary_query, snippet_details, iter_keyset
+from diagnostics import explain_queries, profile_queries, format_profile
+from cache import snippet_cache
+from compression import decompress_code
+from utils import format_snippet_details
+from render import render_rows, check_format
+from stats import snippet_stats, rebuild_stats
+from history import snippet_history, snippet_version, revert_snippet
+from tags import tag_snippet, untag_snippet, snippet_tags, match_tags, iter_tagged, tag_counts
+from sync import export_changes, apply_changes, store_id, renew_store_id, current_revision, sync_peers
+from blobs import duplicate_groups, storage_summary, compact_code_blobs, compression_summary, database_size
+from shards import route_snippet, route_user, iter_sharded, import_sharded
 
 def create_user_command(username):
     """
@@ -13,17 +39,14 @@ def create_user_command(username):
         ValueError: If the username is empty or invalid.
     """
     try:
-        session = Session()
-        user = User(username=username)
-        session.add(user)
-        session.commit()
+        write_with_retry(lambda session: create_user(session, username))
         print(f"User '{username}' created successfully.")
     except ValueError as e:
         print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while creating the user: {str(e)}")
-    finally:
-        session.close()
+        return 1
 
 def create_snippet_command(title, description, language, code, collection_name, username):
     """
@@ -41,58 +64,127 @@ def create_snippet_command(title, description, language, code, collection_name,
         ValueError: If the user is not found or any of the input values are invalid.
     """
     try:
-        session = Session()
-        user = session.query(User).filter_by(username=username).first()
-        if not user:
-            raise ValueError(f"User '{username}' not found.")
-        
-        collection = session.query(Collection).filter_by(name=collection_name).first()
-        if not collection:
-            collection = Collection(name=collection_name)
-            session.add(collection)
-            session.commit()
-        
-        snippet = Snippet(title=title, description=description, language=language, code=code,
-            collection=collection, user=user)
-        session.add(snippet)
-        session.commit()
+        sessions = route_user(username, [collection_name])
+        write_with_retry(lambda session: create_snippet(session, title, description, language, code,
+            collection_name, username), session_factory=sessions)
         print("Snippet created successfully.")
     except ValueError as e:
         print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while creating the snippet: {str(e)}")
-    finally:
-        session.close()
+        return 1
 
 def view_snippet_command(snippet_id):
     """
     Viewing the details of a code snippet with the given ID.
 
+    The rendered details are served from the snippet cache when possible; otherwise they are
+    fetched in a single query and cached.
+
     Args:
         snippet_id (int): The ID of the snippet to view.
 
     Raises:
         ValueError: If the snippet with the given ID is not found.
     """
+    session = None
     try:
-        session = Session()
-        snippet = session.query(Snippet).filter_by(id=snippet_id).first()
-        if not snippet:
-            raise ValueError(f"Snippet with ID {snippet_id} not found.")
-        
-        print(f"Title: {snippet.title}")
-        print(f"Description: {snippet.description}")
-        print(f"Language: {snippet.language}")
-        print(f"Code:\n{snippet.code}")
-        print(f"Collection: {snippet.collection.name}")
-        print(f"User: {snippet.user.username}")
+        snippet_id = int(snippet_id)
+        details = snippet_cache.get(snippet_id)
+        if details is None:
+            sessions, local_id = route_snippet(snippet_id)
+            session = sessions()
+            row = snippet_details(session, local_id)
+            if not row:
+                raise ValueError(f"Snippet with ID {snippet_id} not found.")
+            title, description, language, data, codec, collection_name, username = row
+            details = format_snippet_details(title, description, language, decompress_code(data, codec),
+                collection_name, username, snippet_tags(session, local_id))
+            snippet_cache.put(snippet_id, details)
+        print(details)
     except ValueError as e:
         print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while viewing the snippet: {str(e)}")
+        return 1
+    finally:
+        if session is not None:
+            session.close()
+
+def view_version_command(snippet_id, version):
+    """
+    Viewing a saved version of a code snippet, rebuilt from its history.
+
+    Args:
+        snippet_id (int): The ID of the snippet to view.
+        version (int): The number of the version.
+    """
+    try:
+        session = Session()
+        title, description, language, code = snippet_version(session, snippet_id, version)
+        collection_name, username = snippet_details(session, int(snippet_id))[5:]
+        print(f"Version: {version}")
+        print(format_snippet_details(title, description, language, code, collection_name, username))
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while viewing the snippet version: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def history_command(snippet_id, output_format=None):
+    """
+    Lists the saved versions of a code snippet, newest first.
+
+    Args:
+        snippet_id (int): The ID of the snippet.
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
+    """
+    try:
+        session = Session()
+        check_format(output_format)
+        versions = snippet_history(session, snippet_id)
+        if output_format:
+            render_rows(([version, str(saved_at)] + rest for version, saved_at, *rest in versions),
+                ["version", "saved_at", "title", "language", "added", "removed", "storage", "stored_bytes"],
+                output_format)
+        elif not versions:
+            print(f"Snippet {snippet_id} has not been edited; it has only its current version.")
+        else:
+            print(f"History of snippet {snippet_id}:")
+            for version, saved_at, title, language, added, removed, kind, stored in versions:
+                print(f"  {version:>4}  {saved_at}  +{added} -{removed}  ({kind}, {stored} bytes)  {title} [{language}]")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while reading the snippet history: {str(e)}")
+        return 1
     finally:
         session.close()
 
+def revert_snippet_command(snippet_id, version):
+    """
+    Restores a code snippet to a saved version, saving the result as a new version.
+
+    Args:
+        snippet_id (int): The ID of the snippet.
+        version (int): The number of the version to restore.
+    """
+    try:
+        write_with_retry(lambda session: revert_snippet(session, snippet_id, version))
+        print(f"Snippet with ID {snippet_id} reverted to version {version}.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while reverting the snippet: {str(e)}")
+        return 1
+
 def update_snippet_command(snippet_id, title=None, description=None, language=None, code=None):
     """
     Updates the details of a code snippet with the given ID.
@@ -108,28 +200,16 @@ def update_snippet_command(snippet_id, title=None, description=None, language=No
         ValueError: If the snippet with the given ID is not found.
     """
     try:
-        session = Session()
-        snippet = session.query(Snippet).filter_by(id=snippet_id).first()
-        if not snippet:
-            raise ValueError(f"Snippet with ID {snippet_id} not found.")
-        
-        if title:
-            snippet.title = title
-        if description:
-            snippet.description = description
-        if language:
-            snippet.language = language
-        if code:
-            snippet.code = code
-        
-        session.commit()
+        sessions, local_id = route_snippet(snippet_id)
+        write_with_retry(lambda session: update_snippet(session, local_id, title, description, language, code),
+            session_factory=sessions)
         print(f"Snippet with ID {snippet_id} updated successfully.")
     except ValueError as e:
         print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while updating the snippet: {str(e)}")
-    finally:
-        session.close()
+        return 1
 
 def delete_snippet_command(snippet_id):
     """
@@ -142,85 +222,978 @@ def delete_snippet_command(snippet_id):
         ValueError: If the snippet with the given ID is not found.
     """
     try:
-        session = Session()
-        snippet = session.query(Snippet).filter_by(id=snippet_id).first()
-        if not snippet:
-            raise ValueError(f"Snippet with ID {snippet_id} not found.")
-        
-        session.delete(snippet)
-        session.commit()
+        sessions, local_id = route_snippet(snippet_id)
+        write_with_retry(lambda session: delete_snippet(session, local_id), session_factory=sessions)
         print(f"Snippet with ID {snippet_id} deleted successfully.")
     except ValueError as e:
         print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while deleting the snippet: {str(e)}")
+        return 1
+
+def tag_snippet_command(snippet_id, tags):
+    """
+    Adds tags to a code snippet, creating the tags that do not exist yet.
+
+    Args:
+        snippet_id (int): The ID of the snippet to tag.
+        tags (list): The tag names.
+    """
+    try:
+        added = write_with_retry(lambda session: tag_snippet(session, int(snippet_id), tags))
+        snippet_cache.invalidate(int(snippet_id))
+        print(f"Added {added} tag(s) to snippet {snippet_id}.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while tagging the snippet: {str(e)}")
+        return 1
+
+def untag_snippet_command(snippet_id, tags):
+    """
+    Removes tags from a code snippet.
+
+    Args:
+        snippet_id (int): The ID of the snippet.
+        tags (list): The tag names.
+    """
+    try:
+        removed = write_with_retry(lambda session: untag_snippet(session, int(snippet_id), tags))
+        snippet_cache.invalidate(int(snippet_id))
+        print(f"Removed {removed} tag(s) from snippet {snippet_id}.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while untagging the snippet: {str(e)}")
+        return 1
+
+def delete_where_command(language=None, collection_name=None, username=None, dry_run=False):
+    """
+    Deletes every snippet that matches the search filters, as one set-based statement.
+
+    Args:
+        language (str, optional): Only delete snippets in this programming language.
+        collection_name (str, optional): Only delete snippets in the collection with this name.
+        username (str, optional): Only delete snippets owned by the user with this username.
+        dry_run (bool, optional): Only report how many snippets would be deleted (default: False).
+    """
+    try:
+        session = Session()
+        if dry_run:
+            count = count_snippets_where(session, language, collection_name, username)
+            print(f"{count} snippet(s) would be deleted.")
+            return
+        start = time.perf_counter()
+        count = write_with_retry(lambda session: delete_snippets_where(session, language, collection_name, username))
+        print(f"{count} snippet(s) deleted in {time.perf_counter() - start:.2f}s.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while deleting snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def update_where_command(language=None, collection_name=None, username=None, new_language=None,
+        new_collection_name=None, new_username=None, new_description=None, dry_run=False):
+    """
+    Changes fields of every snippet that matches the search filters, as one set-based statement.
+
+    Args:
+        language (str, optional): Only update snippets in this programming language.
+        collection_name (str, optional): Only update snippets in the collection with this name.
+        username (str, optional): Only update snippets owned by the user with this username.
+        new_language (str, optional): The new programming language.
+        new_collection_name (str, optional): The collection to move the snippets to.
+        new_username (str, optional): The user who becomes the owner of the snippets.
+        new_description (str, optional): The new description.
+        dry_run (bool, optional): Only report how many snippets would be updated (default: False).
+    """
+    try:
+        session = Session()
+        if dry_run:
+            count = count_snippets_where(session, language, collection_name, username)
+            print(f"{count} snippet(s) would be updated.")
+            return
+        start = time.perf_counter()
+        count = write_with_retry(lambda session: update_snippets_where(session, language, collection_name,
+            username, new_language, new_collection_name, new_username, new_description))
+        print(f"{count} snippet(s) updated in {time.perf_counter() - start:.2f}s.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while updating snippets: {str(e)}")
+        return 1
     finally:
         session.close()
 
-def search_snippets_command(language=None, collection_name=None, username=None):
+def search_snippets_command(language=None, collection_name=None, username=None, limit=None, after=None,
+        output_format=None, tags=None, excluded_tags=None):
     """
     Search for code snippets based on the given criteria.
 
+    Matching snippets are streamed in ID order, one batch at a time, without loading their code.
+    Tags are matched with the stored bitmaps of their snippets, so only the snippets that have
+    the tags are fetched. In the sharded layout, the shards are searched in parallel, or only
+    the user's shard when a username is given.
+
     Args:
         language (str, optional): The specific snippet programming language to search for.
         collection_name (str, optional): The name of the collection to search in.
         username (str, optional): The username of the user whose snippets to search for.
+        limit (int, optional): The maximum number of snippets to show.
+        after (int, optional): Only show snippets with an ID greater than this one.
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
+        tags (list, optional): Only show snippets with all of these tags.
+        excluded_tags (list, optional): Leave out snippets with any of these tags.
     """
     try:
         session = Session()
-        query = session.query(Snippet)
-        
-        if language:
-            query = query.filter_by(language=language)
-        if collection_name:
-            query = query.join(Collection).filter(Collection.name == collection_name)
-        if username:
-            query = query.join(User).filter(User.username == username)
-        
-        snippets = query.all()
-        if not snippets:
-            print("No snippets found matching the search criteria.")
+        query = snippet_summary_query(session, language, collection_name, username)
+        rows = None
+        if SHARD_DIRECTORY:
+            if tags or excluded_tags:
+                raise ValueError("Searching by tag is not available with the sharded layout.")
+            user_ids = [get_user(session, username).id] if username else None
+            rows = lambda after, limit: iter_sharded(
+                lambda session: snippet_summary_query(session, language, collection_name, username),
+                after=after, limit=limit, batch_size=LIST_BATCH_SIZE, user_ids=user_ids)
+        elif tags or excluded_tags:
+            included, excluded = match_tags(session, tags or [], excluded_tags or [])
+            # Keep any bitmaps that had to be rebuilt.
+            session.commit()
+            rows = lambda after, limit: iter_tagged(query, included, excluded, after=after, limit=limit,
+                batch_size=LIST_BATCH_SIZE)
+        _print_snippet_page(query, "Search Results:", "No snippets found matching the search criteria.",
+            limit, after, output_format, rows)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while searching for snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def find_snippets_command(terms, limit=20, output_format=None):
+    """
+    Full-text search over snippet titles, descriptions and code, best matches first.
+
+    Args:
+        terms (list): The search terms. All of them must match; a trailing '*' matches a prefix.
+        limit (int, optional): The maximum number of results to show (default: 20).
+        output_format (str, optional): Write the results as 'table', 'json', 'jsonl' or 'csv'.
+    """
+    try:
+        session = Session()
+        check_format(output_format)
+        results = full_text_search(session, terms, limit=int(limit))
+        if output_format:
+            render_rows(results, ["id", "title", "language", "excerpt"], output_format)
+        elif not results:
+            print("No snippets found matching the search terms.")
         else:
             print("Search Results:")
-            for snippet in snippets:
-                print(f"ID: {snippet.id}, Title: {snippet.title}, Language: {snippet.language}")
+            for snippet_id, title, language, excerpt in results:
+                print(f"ID: {snippet_id}, Title: {title}, Language: {language}")
+                print(f"    {excerpt}")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while searching for snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def grep_snippets_command(pattern, ignore_case=False, limit=None, output_format=None):
+    """
+    Searches snippet code with a regular expression, printing the matching lines.
+
+    Only the snippets the trigram index finds for the literal text of the expression are
+    searched, on several processes when there are many of them.
+
+    Args:
+        pattern (str): The regular expression, in Python's syntax.
+        ignore_case (bool, optional): Match without regard to case (default: False).
+        limit (int, optional): The maximum number of snippets to show.
+        output_format (str, optional): Write one row per matching line as 'table', 'json', 'jsonl'
+            or 'csv', and the summary to standard error.
+    """
+    try:
+        session = Session()
+        check_format(output_format)
+        stats = {}
+        start = time.perf_counter()
+        count = 0
+        matches = grep_snippets(session, pattern, ignore_case, limit=int(limit) if limit is not None else None,
+            stats=stats)
+        out = sys.stdout
+        if output_format:
+            out = sys.stderr
+            snippets = set()
+
+            def rows():
+                for snippet_id, title, language, lines in matches:
+                    snippets.add(snippet_id)
+                    for line_number, line in lines:
+                        yield snippet_id, title, language, line_number, line.rstrip("\n")
+
+            render_rows(rows(), ["id", "title", "language", "line", "text"], output_format)
+            count = len(snippets)
+            matches = []
+        for snippet_id, title, language, lines in matches:
+            if count == 0:
+                print("Matching snippets:")
+            print(f"ID: {snippet_id}, Title: {title}, Language: {language}")
+            for line_number, line in lines:
+                print(f"    {line_number}: {line.strip()}")
+            count += 1
+        if count == 0 and not output_format:
+            print("No snippets found matching the expression.")
+        if stats['query'] is None:
+            print("The expression has no literal text of 3 or more characters, so every snippet was searched.",
+                file=out)
+        print(f"{count} matching snippet(s) out of {stats['candidates']} candidate(s) "
+            f"in {time.perf_counter() - start:.2f}s.", file=out)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while searching snippet code: {str(e)}")
+        return 1
     finally:
         session.close()
 
-def list_snippets_command():
+def list_snippets_command(limit=None, after=None, output_format=None):
     """
     Listing all the code snippets.
+
+    Snippets are streamed in ID order, one batch at a time, without loading their code. In the
+    sharded layout, all shards are read in parallel and merged.
+
+    Args:
+        limit (int, optional): The maximum number of snippets to show.
+        after (int, optional): Only show snippets with an ID greater than this one.
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
     """
     try:
         session = Session()
-        snippets = session.query(Snippet).all()
-        if not snippets:
-            print("No snippets found.")
-        else:
-            print("Snippets:")
-            for snippet in snippets:
-                print(f"ID: {snippet.id}, Title: {snippet.title}, Language: {snippet.language}")
+        query = snippet_summary_query(session)
+        rows = None
+        if SHARD_DIRECTORY:
+            rows = lambda after, limit: iter_sharded(snippet_summary_query, after=after, limit=limit,
+                batch_size=LIST_BATCH_SIZE)
+        _print_snippet_page(query, "Snippets:", "No snippets found.", limit, after, output_format, rows)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while listing snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def _print_snippet_page(query, header, empty_message, limit=None, after=None, output_format=None, rows=None):
+    """
+    Prints snippet summary rows as they are fetched, using keyset pagination on the ID.
+
+    When a limit is given and more rows remain, the ID to continue after is printed; with an
+    output format, to standard error, so that standard output holds nothing but the rows.
+
+    Args:
+        query (sqlalchemy.orm.Query): A query yielding (id, title, language) rows.
+        header (str): The line printed before the first row.
+        empty_message (str): The line printed when there are no rows.
+        limit (int, optional): The maximum number of rows to print.
+        after (int, optional): Only print rows with an ID greater than this one.
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
+        rows (callable, optional): Called with after and limit to iterate over the rows instead
+            of paging through the query.
+    """
+    check_format(output_format)
+    limit = int(limit) if limit is not None else None
+    after = int(after) if after is not None else None
+    if rows is None:
+        rows = lambda after, limit: iter_keyset(query, Snippet.id, after=after, limit=limit,
+            batch_size=LIST_BATCH_SIZE)
+    # Fetch one extra row to find out whether another page exists.
+    rows = rows(after, limit + 1 if limit is not None else None)
+    if output_format:
+        render_rows(_page(rows, limit), ["id", "title", "language"], output_format)
+        return
+    count = 0
+    last_id = None
+    for snippet_id, title, language in rows:
+        if count == limit:
+            print(f"More snippets available. Continue with --after {last_id}")
+            break
+        if count == 0:
+            print(header)
+        print(f"ID: {snippet_id}, Title: {title}, Language: {language}")
+        count += 1
+        last_id = snippet_id
+    if count == 0:
+        print(empty_message)
+
+def _page(rows, limit):
+    """
+    Yields up to limit rows, then reports on standard error where the next page starts, if
+    there is one.
+    """
+    last_id = None
+    for count, row in enumerate(rows):
+        if count == limit:
+            sys.stdout.flush()
+            print(f"More snippets available. Continue with --after {last_id}", file=sys.stderr)
+            return
+        yield row
+        last_id = row[0]
+
+def import_snippets_command(path, username=None, collection_name=None, rejects_path=None):
+    """
+    Imports snippets in bulk from a directory of source files or a JSONL file.
+
+    Args:
+        path (str): A directory of source files or a JSON Lines file of snippet records.
+        username (str, optional): The user who owns the imported snippets, unless a JSONL record names one.
+        collection_name (str, optional): The collection for the imported snippets. Defaults to the
+            directory holding each file, or the collection named in each JSONL record.
+        rejects_path (str, optional): A file to write rejected records to as JSON Lines. When not
+            given, the first rejects are printed.
+
+    Raises:
+        ValueError: If the path does not exist.
+    """
+    rejects_file = None
+    shown_rejects = []
+
+    def on_progress(imported, rejected, elapsed):
+        rate = imported / elapsed if elapsed else 0
+        print(f"Imported {imported} snippets, rejected {rejected} ({rate:.0f} snippets/s)")
+
+    def on_reject(source, error):
+        if rejects_file:
+            rejects_file.write(json.dumps({"source": source, "error": error}) + "\n")
+        elif len(shown_rejects) < IMPORT_REJECTS_SHOWN:
+            shown_rejects.append(source)
+            print(f"Rejected {source}: {error}")
+
+    try:
+        session = Session()
+        from importer import read_directory, read_jsonl, import_snippets
+        if not os.path.exists(path):
+            raise ValueError(f"Path '{path}' not found.")
+        reader = read_directory if os.path.isdir(path) else read_jsonl
+        if rejects_path:
+            rejects_file = open(rejects_path, "w", encoding="utf-8")
+        start = time.perf_counter()
+        load = import_sharded if SHARD_DIRECTORY else \
+            lambda records, **kwargs: import_snippets(session, records, **kwargs)
+        imported, rejected = load(reader(path, username, collection_name), on_progress=on_progress,
+            on_reject=on_reject)
+        elapsed = time.perf_counter() - start
+        print(f"Import finished: {imported} imported, {rejected} rejected in {elapsed:.2f}s.")
+        if rejected and rejects_path:
+            print(f"Rejected records were written to {rejects_path}.")
+        elif rejected > len(shown_rejects):
+            print(f"{rejected - len(shown_rejects)} more rejects not shown. Use --rejects FILE to save them all.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while importing snippets: {str(e)}")
+        return 1
+    finally:
+        if rejects_file:
+            rejects_file.close()
+        session.close()
+
+def batch_command(path, commit_every=None, parse=None):
+    """
+    Runs a script of user, add, update and delete commands, one per line, in one transaction.
+
+    Lines that fail are reported and rolled back on their own; the rest of the script still runs.
+
+    Args:
+        path (str): The script file, or '-' to read it from standard input.
+        commit_every (int, optional): Commit after this many successful lines instead of once
+            at the end (default: BATCH_COMMIT_EVERY).
+        parse (callable): Turns a command line into a (command function, arguments) pair.
+
+    Returns:
+        int: The number of lines that failed.
+    """
+    script = None
+    try:
+        session = Session()
+        from batch import read_script, run_batch
+        commit_every = int(commit_every if commit_every is not None else BATCH_COMMIT_EVERY)
+        if commit_every < 0:
+            raise ValueError("--commit-every cannot be negative.")
+        if path != "-" and not os.path.isfile(path):
+            raise ValueError(f"File '{path}' not found.")
+        script = sys.stdin if path == "-" else open(path, encoding="utf-8")
+
+        def on_error(line_number, command, error):
+            # Database errors carry the statement and parameters; the driver's message is enough.
+            print(f"Line {line_number}: {str(getattr(error, 'orig', None) or error)}  [{command}]")
+
+        succeeded, failed, commits, elapsed = run_batch(session, read_script(script), parse, commit_every, on_error)
+        rate = (succeeded + failed) / elapsed if elapsed else 0
+        print(f"Batch finished: {succeeded} succeeded, {failed} failed, {commits} commit(s) in {elapsed:.2f}s "
+            f"({rate:.0f} lines/s).")
+        return failed
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        session.rollback()
+        print(f"An error occurred while running the batch: {str(e)}")
+        return 1
+    finally:
+        if script is not None and script is not sys.stdin:
+            script.close()
+        session.close()
+
+def export_snippets_command(path, export_format="jsonl", language=None, collection_name=None, username=None):
+    """
+    Exports snippets to a JSON Lines file or a tar archive of source files.
+
+    Args:
+        path (str): The output file, or '-' to write JSONL to standard output.
+        export_format (str, optional): 'jsonl' or 'tar' (default: 'jsonl').
+        language (str, optional): Only export snippets in this programming language.
+        collection_name (str, optional): Only export snippets in this collection.
+        username (str, optional): Only export snippets owned by this user.
+    """
+    # Keep standard output clean when the export itself is written there.
+    out = sys.stderr if path == "-" else sys.stdout
+
+    def on_progress(exported, elapsed):
+        rate = exported / elapsed if elapsed else 0
+        print(f"Exported {exported} snippets ({rate:.0f} snippets/s)", file=out)
+
+    try:
+        session = Session()
+        from exporter import export_snippets
+        start = time.perf_counter()
+        exported = export_snippets(session, path, export_format, language, collection_name, username,
+            on_progress=on_progress)
+        elapsed = time.perf_counter() - start
+        print(f"Export finished: {exported} snippets written to {path} in {elapsed:.2f}s.", file=out)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while exporting snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def sync_export_command(path, since=0):
+    """
+    Writes the snippets changed after a revision of this store to a change set file.
+
+    Args:
+        path (str): The output file, or '-' to write to standard output.
+        since (int, optional): Only include changes made after this revision (default: 0).
+    """
+    # Keep standard output clean when the change set itself is written there.
+    out = sys.stderr if path == "-" else sys.stdout
+    try:
+        session = Session()
+        start = time.perf_counter()
+        count, revision = export_changes(session, path, int(since))
+        size = f", {os.path.getsize(path)} bytes" if path != "-" else ""
+        print(f"Exported {count} change(s) after revision {since}, up to revision {revision}{size}, "
+            f"in {time.perf_counter() - start:.2f}s.", file=out)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while exporting changes: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def sync_apply_command(path, theirs=False, force=False):
+    """
+    Applies a change set exported from another store, reporting conflicting snippets.
+
+    The change set is applied with write_with_retry, so it starts over if another writer holds
+    the lock. Standard input is copied to a temporary file first, to be read again on a retry.
+
+    Args:
+        path (str): The change set file, or '-' to read standard input.
+        theirs (bool, optional): Overwrite snippets changed here too with the incoming version,
+            instead of keeping them (default: False).
+        force (bool, optional): Accept a change set that starts after revision 0 from a store
+            never applied here (default: False).
+    """
+    spool = None
+    try:
+        start = time.perf_counter()
+        if path == "-":
+            spool = tempfile.SpooledTemporaryFile(mode="w+", encoding="utf-8")
+            shutil.copyfileobj(sys.stdin, spool)
+        header, counts, conflicts = write_with_retry(
+            lambda session: apply_changes(session, spool or path, theirs, force))
+        print(f"Applied changes {header['since'] + 1} to {header['revision']} of store {header['store']} "
+            f"in {time.perf_counter() - start:.2f}s: {counts['created']} created, {counts['updated']} updated, "
+            f"{counts['deleted']} deleted, {counts['unchanged']} already up to date.")
+        if conflicts:
+            verb = "overwritten" if theirs else "kept; rerun with --theirs to take the incoming version"
+            print(f"{counts['conflicts']} snippet(s) were changed in both stores ({verb}):")
+            for uid, title in conflicts[:IMPORT_REJECTS_SHOWN]:
+                print(f"  {uid}: {title or '(deleted)'}")
+            if len(conflicts) > IMPORT_REJECTS_SHOWN:
+                print(f"  ... and {len(conflicts) - IMPORT_REJECTS_SHOWN} more")
+        print(f"Next time, export from that store with --since {header['revision']}.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while applying changes: {str(e)}")
+        return 1
+    finally:
+        if spool is not None:
+            spool.close()
+
+def sync_status_command():
+    """
+    Prints this store's sync identifier and revision, and the stores whose changes it holds.
+    """
+    try:
+        session = Session()
+        print(f"Store {store_id(session)} at revision {current_revision(session)}.")
+        for peer_id, revision, applied_at in sync_peers(session):
+            print(f"  Applied store {peer_id} up to revision {revision} (last on {applied_at}).")
+    except Exception as e:
+        print(f"An error occurred while reading the sync status: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def sync_new_id_command():
+    """
+    Gives this store a new sync identifier, as a copied database file needs before it is synced
+    with the original.
+    """
+    try:
+        value = write_with_retry(renew_store_id)
+        print(f"This store now syncs as {value}.")
+    except Exception as e:
+        print(f"An error occurred while renewing the store identifier: {str(e)}")
+        return 1
+
+def dupes_command(limit=20):
+    """
+    Lists snippets that share an identical code body, most shared bodies first.
+
+    Args:
+        limit (int, optional): The maximum number of shared bodies to show (default: 20).
+    """
+    try:
+        session = Session()
+        groups = duplicate_groups(session, limit=int(limit))
+        if not groups:
+            print("No duplicate code found.")
+        else:
+            print("Duplicate code:")
+            for blob_hash, size, count, members in groups:
+                print(f"Hash {blob_hash[:12]} ({count} snippets, {size} bytes each):")
+                for snippet_id, title, language in members:
+                    print(f"  ID: {snippet_id}, Title: {title}, Language: {language}")
+                if count > len(members):
+                    print(f"  ... and {count - len(members)} more")
+        snippets, blobs, stored, logical = storage_summary(session)
+        print(f"{snippets} snippets share {blobs} distinct code bodies: {stored} bytes stored "
+            f"for {logical} bytes of code ({logical - stored} bytes saved).")
+    except Exception as e:
+        print(f"An error occurred while looking for duplicate code: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def similar_command(snippet_id, threshold=None, limit=20):
+    """
+    Lists the snippets whose code is a near-duplicate of a snippet's code, most similar first.
+
+    Args:
+        snippet_id (int): The ID of the snippet.
+        threshold (float, optional): The lowest similarity shown, between 0 and 1
+            (default: SIMILARITY_THRESHOLD).
+        limit (int, optional): The maximum number of snippets to show (default: 20).
+    """
+    try:
+        session = Session()
+        threshold = _similarity_threshold(threshold)
+        results = similar_snippets(session, int(snippet_id), threshold, int(limit))
+        if not results:
+            print(f"No snippets found with code at least {threshold:.0%} similar.")
+        else:
+            print(f"Snippets similar to {snippet_id}:")
+            for similarity, other_id, title, language in results:
+                print(f"  {similarity:4.0%}  ID: {other_id}, Title: {title}, Language: {language}")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while looking for similar snippets: {str(e)}")
+        return 1
     finally:
         session.close()
 
-def list_collections_command():
+def related_command(query, limit=20, rebuild=False):
+    """
+    Lists the snippets whose title, description and code identifiers best match a query, by
+    TF-IDF cosine similarity, most related first.
+
+    Unlike find, a snippet does not need every word of the query: a query for "debounce an
+    input" also ranks a snippet whose code calls a debounce helper from an input handler.
+    Looking up only reads the index; snippets still queued for a vector are counted and left
+    out until the index is rebuilt.
+
+    Args:
+        query (str): The words to look for, or an empty string to only rebuild the index.
+        limit (int, optional): The maximum number of snippets to show (default: 20).
+        rebuild (bool, optional): Whether to compute the vectors of every queued snippet first,
+            RELATED_BATCH_SIZE snippets per transaction (default: False).
+    """
+    try:
+        session = Session()
+        if rebuild:
+            start = time.perf_counter()
+            indexed = 0
+            while True:
+                batch = write_with_retry(lambda session: index_pending(session.connection(), limit=RELATED_BATCH_SIZE))
+                if not batch:
+                    break
+                indexed += batch
+            print(f"Indexed {indexed} queued snippet(s) in {time.perf_counter() - start:.2f}s.")
+            if not query:
+                return
+        results = related_snippets(session, query, int(limit))
+        pending = pending_count(session)
+        if pending:
+            print(f"Note: {pending} snippet(s) are not indexed yet and are left out. Run 'related --rebuild' to index them.")
+        if not results:
+            print(f"No snippets found related to '{query}'.")
+        else:
+            print(f"Snippets related to '{query}':")
+            for similarity, snippet_id, title, language in results:
+                print(f"  {similarity:4.0%}  ID: {snippet_id}, Title: {title}, Language: {language}")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while looking for related snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def cluster_command(threshold=None, limit=20):
+    """
+    Reports the clusters of near-duplicate snippets in the whole store, largest first.
+
+    Args:
+        threshold (float, optional): The lowest similarity that puts two snippets in one cluster,
+            between 0 and 1 (default: SIMILARITY_THRESHOLD).
+        limit (int, optional): The maximum number of clusters to show (default: 20).
+    """
+    try:
+        session = Session()
+        threshold = _similarity_threshold(threshold)
+        clusters, total = near_duplicate_clusters(session, threshold, int(limit))
+        if not clusters:
+            print(f"No snippets found with code at least {threshold:.0%} similar.")
+        else:
+            print(f"Near-duplicate clusters (at least {threshold:.0%} similar):")
+            for count, bodies, members in clusters:
+                print(f"Cluster of {count} snippets ({bodies} distinct code bodies):")
+                for snippet_id, title, language in members:
+                    print(f"  ID: {snippet_id}, Title: {title}, Language: {language}")
+                if count > len(members):
+                    print(f"  ... and {count - len(members)} more")
+            if total > len(clusters):
+                print(f"{total - len(clusters)} smaller cluster(s) not shown.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while clustering similar snippets: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def _similarity_threshold(threshold):
+    if threshold is None:
+        return SIMILARITY_THRESHOLD
+    threshold = float(threshold)
+    if not 0 < threshold <= 1:
+        raise ValueError("The threshold must be between 0 and 1.")
+    return threshold
+
+def stats_command(rebuild=False, limit=10, output_format=None):
+    """
+    Prints the number of snippets and the size of their code per language, collection and user.
+
+    The numbers are read from the summary table that the database keeps up to date as snippets
+    are written, so no snippet is scanned.
+
+    Args:
+        rebuild (bool, optional): Whether to recompute the summary table from the snippets
+            first, reporting any group whose stored numbers were wrong (default: False).
+        limit (int, optional): The maximum number of groups shown per dimension (default: 10).
+        output_format (str, optional): Write (dimension, name, snippets, code bytes) rows as
+            'table', 'json', 'jsonl' or 'csv', and the rebuild report to standard error.
+    """
+    try:
+        session = Session()
+        check_format(output_format)
+        limit = int(limit)
+        out = sys.stderr if output_format else sys.stdout
+        if rebuild:
+            start = time.perf_counter()
+            drift = write_with_retry(lambda session: rebuild_stats(session.connection()))
+            print(f"Statistics rebuilt in {time.perf_counter() - start:.2f}s.", file=out)
+            if not drift:
+                print("No drift found.", file=out)
+            for dimension, value, stored, actual in drift:
+                stored = f"{stored[0]} snippets, {stored[1]} bytes" if stored else "missing"
+                actual = f"{actual[0]} snippets, {actual[1]} bytes" if actual else "none"
+                print(f"  Drift in {dimension} '{value}': stored {stored}, actual {actual}", file=out)
+        (snippets, code_bytes), groups = snippet_stats(session, limit)
+        if output_format:
+            rows = [("total", None, snippets, code_bytes)] + [(dimension, name, count, size)
+                for dimension, group in groups.items() for name, count, size in group]
+            render_rows(rows, ["dimension", "name", "snippets", "code_bytes"], output_format)
+            return
+        print(f"{snippets} snippets, {code_bytes} bytes of code.")
+        for dimension, rows in groups.items():
+            print(f"By {dimension}:")
+            for name, count, size in rows:
+                print(f"  {name or '(none)'}: {count} snippets, {size} bytes")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while reading the statistics: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def compact_command(vacuum=False):
+    """
+    Compresses large code bodies that are still stored as text and reports storage use.
+
+    Args:
+        vacuum (bool, optional): Whether to rebuild the database file afterwards, returning the
+            space freed by compression to the file system.
+    """
+    def on_progress(compressed):
+        print(f"Compressed {compressed} code bodies...")
+
+    try:
+        session = Session()
+        compressed, before, after = compact_code_blobs(session, on_progress=on_progress)
+        print(f"Compressed {compressed} code bodies from {before} to {after} bytes.")
+        if vacuum:
+            # VACUUM needs the session's connection back in the pool; the report then reads the
+            # rebuilt file through a new session.
+            Session.remove()
+            with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.exec_driver_sql("VACUUM")
+            session = Session()
+        print("Code storage:")
+        for codec, blobs, size, stored in compression_summary(session):
+            print(f"  {codec or 'text'}: {blobs} bodies, {size} bytes of code, {stored} bytes stored")
+        file_size, free = database_size(session.connection())
+        print(f"Database file: {file_size} bytes ({free} bytes free)")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while compacting the database: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def cache_stats_command():
+    """
+    Prints the size and hit rate of the snippet cache.
+    """
+    stats = snippet_cache.stats()
+    print("Snippet cache:")
+    print(f"  Entries: {stats['entries']} of {stats['max_entries']}")
+    print(f"  Size: {stats['bytes']} of {stats['max_bytes']} bytes")
+    print(f"  TTL: {stats['ttl']:g}s")
+    print(f"  Hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hit_rate']:.1%}")
+    print(f"  Evictions: {stats['evictions']}, expirations: {stats['expirations']}, "
+        f"invalidations: {stats['invalidations']}")
+
+def cache_clear_command():
+    """
+    Drops every entry from the snippet cache.
+    """
+    snippet_cache.clear()
+    print("Snippet cache cleared.")
+
+def list_collections_command(output_format=None):
     """
     Listing all the collections.
+
+    Collections are streamed in ID order, one batch at a time.
+
+    Args:
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
     """
     try:
         session = Session()
-        collections = session.query(Collection).all()
-        if not collections:
+        check_format(output_format)
+        rows = iter_keyset(session.query(Collection.id, Collection.name), Collection.id, batch_size=LIST_BATCH_SIZE)
+        if output_format:
+            render_rows(rows, ["id", "name"], output_format)
+            return
+        count = 0
+        for collection_id, name in rows:
+            if count == 0:
+                print("Collections:")
+            print(f"ID: {collection_id}, Name: {name}")
+            count += 1
+        if count == 0:
             print("No collections found.")
-        else:
-            print("Collections:")
-            for collection in collections:
-                print(f"ID: {collection.id}, Name: {collection.name}")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
     except Exception as e:
         print(f"An error occurred while listing collections: {str(e)}")
+        return 1
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+def list_tags_command(output_format=None):
+    """
+    Listing all the tags with the number of snippets that have each, most used first.
+
+    Args:
+        output_format (str, optional): Write the rows as 'table', 'json', 'jsonl' or 'csv'.
+    """
+    try:
+        session = Session()
+        check_format(output_format)
+        rows = tag_counts(session)
+        if output_format:
+            render_rows(rows, ["tag", "snippets"], output_format)
+            return
+        count = 0
+        for name, snippets in rows:
+            if count == 0:
+                print("Tags:")
+            print(f"{name}: {snippets} snippet(s)")
+            count += 1
+        if count == 0:
+            print("No tags found.")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except Exception as e:
+        print(f"An error occurred while listing tags: {str(e)}")
+        return 1
+    finally:
+        session.close()
+
+def serve_command(host=None, port=None, workers=None):
+    """
+    Serves the snippet store as a local HTTP/JSON API until interrupted.
+
+    Args:
+        host (str, optional): The interface to listen on (default: SERVER_HOST).
+        port (int, optional): The port to listen on (default: SERVER_PORT).
+        workers (int, optional): The number of database worker threads (default: SERVER_WORKERS).
+    """
+    try:
+        from server import serve
+        host = host or SERVER_HOST
+        port = int(port or SERVER_PORT)
+        workers = int(workers or SERVER_WORKERS)
+        if workers < 1:
+            raise ValueError("The number of workers must be at least 1.")
+
+        def on_ready(address):
+            print(f"Serving the snippet API on http://{address[0]}:{address[1]} with {workers} database workers. "
+                "Press Ctrl+C to stop.")
+            sys.stdout.flush()
+
+        serve(host, port, workers, on_ready)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    except OSError as e:
+        print(f"An error occurred while starting the server: {str(e)}")
+        return 1
+
+def explain_command(cmd_func, cmd_args):
+    """
+    Runs a command and prints the SQLite query plan of every query it executes.
+
+    Args:
+        cmd_func (callable): The command function to run.
+        cmd_args (list): The arguments of the command.
+
+    Returns:
+        int: The status the command returned.
+    """
+    with explain_queries(get_engine()):
+        return cmd_func(*cmd_args)
+
+def profile_command(cmd_func, cmd_args):
+    """
+    Runs a command and reports the statements it executed to standard error.
+
+    The report gives the number of statements, the time spent in the database, the rows
+    fetched, and the statements that ran repeatedly, which flags N+1 query patterns.
+
+    Args:
+        cmd_func (callable): The command function to run.
+        cmd_args (list): The arguments of the command.
+
+    Returns:
+        int: The status the command returned.
+    """
+    with profile_queries(get_engine()) as profile:
+        status = cmd_func(*cmd_args)
+    for line in format_profile(cmd_func.__name__, profile, PROFILE_REPEAT_THRESHOLD):
+        print(line, file=sys.stderr)
+    return status
+
+# The commands that work on a sharded store. The others read or write the snippets of every user
+# in one database (duplicates, sync, statistics, tags, history) and are not sharded yet.
+SHARDED_COMMANDS = {'create_user_command', 'create_snippet_command', 'view_snippet_command', 'update_snippet_command',
+    'delete_snippet_command', 'search_snippets_command', 'list_snippets_command', 'list_collections_command',
+    'import_snippets_command', 'cache_stats_command', 'cache_clear_command'}
+
+def get_command(name):
+    """
+    Returns a command function by name, or one that reports it is unavailable if the store is
+    sharded and the command does not support that.
+
+    Args:
+        name (str): The name of the command function.
+
+    Returns:
+        callable: The command function.
+    """
+    if SHARD_DIRECTORY and name not in SHARDED_COMMANDS:
+        def unavailable(*args, **kwargs):
+            command = name[:-len('_command')] if name.endswith('_command') else name
+            print(f"Error: The '{command}' command is not available with the sharded layout.")
+            return 1
+        return unavailable
+    return globals()[name]
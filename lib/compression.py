@@ -0,0 +1,70 @@
+# lib/compression.py
+import lzma
+import zlib
+from config import CODE_COMPRESSION, CODE_COMPRESSION_THRESHOLD
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+def compress_code(code, codec=CODE_COMPRESSION, threshold=CODE_COMPRESSION_THRESHOLD):
+    """
+    Compresses a code body if it is large enough for compression to pay off.
+
+    Args:
+        code (str): The code.
+        codec (str): 'zlib', 'lzma' or 'none' (default: CODE_COMPRESSION).
+        threshold (int): Bodies of at most this many bytes are stored as they are
+            (default: CODE_COMPRESSION_THRESHOLD).
+
+    Returns:
+        tuple: The value to store and the codec used. The codec is None, and the value the code
+        itself, when the body is small, compression is off, or compressing does not make it smaller.
+
+    Raises:
+        ValueError: If the codec is unknown.
+    """
+    if codec == 'none':
+        return code, None
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec '{codec}'. Expected one of: {', '.join(CODECS)}, none.")
+    raw = code.encode('utf-8')
+    if len(raw) <= threshold:
+        return code, None
+    compressed = CODECS[codec][0](raw)
+    if len(compressed) >= len(raw):
+        return code, None
+    return compressed, codec
+
+def decompress_code(data, codec):
+    """
+    Restores a code body stored by compress_code.
+
+    Also registered as the SQL function code_text(body, codec), so that views and triggers
+    can read compressed bodies.
+
+    Args:
+        data (str or bytes): The stored value.
+        codec (str): The codec it was compressed with, or None if it is stored as text.
+
+    Returns:
+        str: The code.
+
+    Raises:
+        ValueError: If the codec is unknown.
+    """
+    if codec is None:
+        return data
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec '{codec}'.")
+    return CODECS[codec][1](data).decode('utf-8')
+
+def register_sql_functions(dbapi_connection):
+    """
+    Registers code_text(body, codec) on a raw SQLite connection.
+
+    Args:
+        dbapi_connection (sqlite3.Connection): The connection.
+    """
+    dbapi_connection.create_function('code_text', 2, decompress_code, deterministic=True)
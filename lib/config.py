@@ -5,6 +5,49 @@ import os
 # Database configuration
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///db/snippets.db')
 
+# Engine profiles: the SQLite pragmas applied to every new connection and the pool settings.
+# 'tuned' trades a little durability on power loss (synchronous=NORMAL under WAL) for much
+# cheaper commits; 'safe' keeps SQLite's own defaults.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'tuned')
+DATABASE_PROFILES = {
+    'tuned': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+        'pool_size': 5,
+        'max_overflow': 10,
+    },
+    'safe': {
+        'pragmas': {
+            'busy_timeout': 5000,
+        },
+        'pool_size': 1,
+        'max_overflow': 0,
+    },
+}
+
+# Sharded layout: when SHARD_DIRECTORY is set, DATABASE_URL holds only the catalog of users and
+# collections, and each user's snippets live in their own database file in SHARD_DIRECTORY.
+# A snippet's ID is its owner's user ID times SHARD_ID_STRIDE plus its ID within the shard.
+# Queries across shards run on SHARD_WORKERS threads. At most SHARD_OPEN_LIMIT shards keep their
+# connection open between uses (about three file descriptors each); the least recently used idle
+# ones are closed beyond that. At least SHARD_WORKERS + 1 are kept open.
+SHARD_DIRECTORY = os.environ.get('SHARD_DIRECTORY') or None
+SHARD_ID_STRIDE = 1_000_000_000
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', min(32, (os.cpu_count() or 1) + 4)))
+SHARD_OPEN_LIMIT = int(os.environ.get('SHARD_OPEN_LIMIT', 64))
+
+# Writes that fail because another connection holds the database lock are retried up to
+# WRITE_RETRIES times, after WRITE_RETRY_DELAY seconds, doubling up to WRITE_RETRY_MAX_DELAY.
+WRITE_RETRIES = int(os.environ.get('WRITE_RETRIES', 6))
+WRITE_RETRY_DELAY = float(os.environ.get('WRITE_RETRY_DELAY', 0.02))
+WRITE_RETRY_MAX_DELAY = float(os.environ.get('WRITE_RETRY_MAX_DELAY', 1.0))
+
 # Application configuration
 APP_TITLE = "Code Marshall"
 APP_VERSION = "1.0.0"
@@ -34,10 +77,112 @@ Enter 'help' to see available commands.
 # Snippet configuration
 MAX_SNIPPET_TITLE_LENGTH = 100
 MAX_SNIPPET_DESCRIPTION_LENGTH = 500
-MAX_SNIPPET_CODE_LENGTH = 5000
+MAX_SNIPPET_CODE_LENGTH = 1000000
+
+# Code compression: bodies larger than the threshold (in bytes) are stored compressed with the
+# codec ('zlib', 'lzma' or 'none').
+CODE_COMPRESSION = os.environ.get('CODE_COMPRESSION', 'zlib')
+CODE_COMPRESSION_THRESHOLD = int(os.environ.get('CODE_COMPRESSION_THRESHOLD', 1024))
+
+# Listing configuration
+LIST_BATCH_SIZE = int(os.environ.get('LIST_BATCH_SIZE', 500))
+
+# Snippet cache: rendered 'view' output of recently viewed snippets, kept per process
+SNIPPET_CACHE_SIZE = int(os.environ.get('SNIPPET_CACHE_SIZE', 1024))
+SNIPPET_CACHE_MAX_BYTES = int(os.environ.get('SNIPPET_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+SNIPPET_CACHE_TTL = float(os.environ.get('SNIPPET_CACHE_TTL', 300))
+
+# Profiling: statements run at least this many times by one command are reported as repeated
+PROFILE_REPEAT_THRESHOLD = int(os.environ.get('PROFILE_REPEAT_THRESHOLD', 2))
+
+# Regex grep: candidates from the trigram index are searched in chunks of GREP_CHUNK_SIZE on
+# GREP_WORKERS processes. Character classes and alternations of up to GREP_EXACT_LIMIT strings
+# are expanded into trigram lookups.
+GREP_WORKERS = int(os.environ.get('GREP_WORKERS', os.cpu_count() or 1))
+GREP_CHUNK_SIZE = int(os.environ.get('GREP_CHUNK_SIZE', 500))
+GREP_EXACT_LIMIT = 16
+
+# Near-duplicate detection: code is split into shingles of SIMILARITY_SHINGLE_SIZE tokens and
+# summarized by a MinHash signature of SIMILARITY_BANDS x SIMILARITY_ROWS values. Codes whose
+# estimated similarity is at least SIMILARITY_THRESHOLD count as near-duplicates.
+SIMILARITY_SHINGLE_SIZE = 4
+SIMILARITY_BANDS = 12
+SIMILARITY_ROWS = 5
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', 0.7))
+
+# Related search: every snippet gets a TF-IDF vector of the RELATED_MAX_TERMS heaviest words of
+# its title, description and code identifiers. Queued vectors are computed RELATED_BATCH_SIZE
+# snippets at a time.
+RELATED_MAX_TERMS = int(os.environ.get('RELATED_MAX_TERMS', 64))
+RELATED_BATCH_SIZE = 500
+
+# Import configuration
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 5000))
+IMPORT_REJECTS_SHOWN = 20
+
+# Batch scripts: commit after this many successful lines (0 commits once, at the end), and
+# flush this many lines at a time
+BATCH_COMMIT_EVERY = int(os.environ.get('BATCH_COMMIT_EVERY', 0))
+BATCH_FLUSH_SIZE = 100
+
+# Output formats: a table sizes its columns from its first TABLE_SAMPLE_ROWS rows, up to
+# TABLE_MAX_WIDTH characters each
+TABLE_SAMPLE_ROWS = 100
+TABLE_MAX_WIDTH = 60
+
+# Export configuration
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Sync: the number of incoming changes applied per flush
+SYNC_FLUSH_SIZE = 500
+
+# Version history: a full copy of a snippet's code is kept every this many versions, and the
+# versions in between are stored as deltas
+HISTORY_CHECKPOINT_INTERVAL = int(os.environ.get('HISTORY_CHECKPOINT_INTERVAL', 10))
+
+# API server configuration. Database work runs on SERVER_WORKERS threads; keep it within the
+# connection pool of the database profile.
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 8080))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 8))
+SERVER_PAGE_SIZE = 100
+SERVER_MAX_PAGE_SIZE = 10000
+SERVER_MAX_BODY = 8 * 1024 * 1024
+
+# Source file extensions and the snippet language they map to
+LANGUAGE_EXTENSIONS = {
+    '.py': 'python',
+    '.js': 'javascript',
+    '.ts': 'typescript',
+    '.java': 'java',
+    '.c': 'c',
+    '.h': 'c',
+    '.cpp': 'cpp',
+    '.hpp': 'cpp',
+    '.cs': 'csharp',
+    '.go': 'go',
+    '.rs': 'rust',
+    '.rb': 'ruby',
+    '.php': 'php',
+    '.swift': 'swift',
+    '.kt': 'kotlin',
+    '.scala': 'scala',
+    '.sh': 'shell',
+    '.sql': 'sql',
+    '.html': 'html',
+    '.css': 'css',
+    '.json': 'json',
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.toml': 'toml',
+    '.md': 'markdown',
+}
 
 # Collection configuration
 MAX_COLLECTION_NAME_LENGTH = 50
 
+# Tag configuration
+MAX_TAG_NAME_LENGTH = 40
+
 # User configuration
 MAX_USERNAME_LENGTH = 20
\ No newline at end of file
@@ -1,11 +1,26 @@
 # lib/database.py
+import random
 import time
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from config import DATABASE_URL
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
+from config import DATABASE_URL, DATABASE_PROFILE, DATABASE_PROFILES, WRITE_RETRIES, WRITE_RETRY_DELAY, \
+    WRITE_RETRY_MAX_DELAY, SHARD_DIRECTORY
 from models import Base
+from search import create_search_index, drop_search_index, drop_search_triggers
+from grep import create_trigram_index
+from stats import create_stats_index
+from sync import add_snippet_uids, create_change_log
+from tags import create_tag_index
+from history import register_history_events, create_history_index
+from related import register_related_events, create_related_index
+from similarity import register_signature_events, create_signature_index, backfill_signatures
+from blobs import register_blob_events, migrate_inline_code, add_codec_column
+from compression import register_sql_functions
+from cache import register_cache_events
 
-def create_engine_with_retry(url, retries=3, delay=1):
+def create_engine_with_retry(url, retries=3, delay=1, profile=DATABASE_PROFILE, pool_size=None):
     """
     Create a SQLAlchemy engine with retry functionality.
 
@@ -13,16 +28,27 @@ def create_engine_with_retry(url, retries=3, delay=1):
         url (str): The database URL.
         retries (int): The number of retry attempts (default: 3).
         delay (int): The delay in seconds between retry attempts (default: 1).
+        profile (str): The name of the engine profile in DATABASE_PROFILES (default: DATABASE_PROFILE).
+        pool_size (int, optional): The number of connections kept open (default: the profile's).
 
     Returns:
         sqlalchemy.engine.Engine: The created SQLAlchemy engine.
 
     Raises:
+        ValueError: If the profile is unknown.
         Exception: If the connection fails after the specified number of retries.
     """
+    if profile not in DATABASE_PROFILES:
+        raise ValueError(f"Unknown database profile '{profile}'. Expected one of: {', '.join(DATABASE_PROFILES)}.")
+    settings = DATABASE_PROFILES[profile]
+    if pool_size is not None:
+        settings = dict(settings, pool_size=pool_size)
     for attempt in range(retries):
         try:
-            engine = create_engine(url)
+            engine = create_engine(url, **pool_arguments(url, settings))
+            if url.startswith('sqlite'):
+                apply_sqlite_pragmas(engine, settings['pragmas'])
+                event.listen(engine, 'connect', _register_functions)
             return engine
         except Exception as e:
             if attempt == retries - 1:
@@ -31,18 +57,210 @@ def create_engine_with_retry(url, retries=3, delay=1):
                 print(f"Connection attempt {attempt + 1} failed. Retrying in {delay} second(s)...")
                 time.sleep(delay)
 
-engine = create_engine_with_retry(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+def pool_arguments(url, settings):
+    """
+    Choose the connection pool for a database URL.
+
+    In-memory SQLite databases exist only as long as their connection, so they share a single
+    connection. File databases keep a small pool of open connections, so commands reuse a
+    connection whose pragmas are already applied instead of reconnecting every time.
+
+    Args:
+        url (str): The database URL.
+        settings (dict): The engine profile.
+
+    Returns:
+        dict: Keyword arguments for create_engine.
+    """
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+    arguments = {
+        'poolclass': QueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+    }
+    if url.startswith('sqlite'):
+        arguments['connect_args'] = {'check_same_thread': False}
+    return arguments
+
+def _register_functions(dbapi_connection, connection_record):
+    register_sql_functions(dbapi_connection)
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Run the given PRAGMA statements on every new connection of an SQLite engine.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The engine.
+        pragmas (dict): Pragma names and the values to set them to.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+_engine = None
+
+def get_engine():
+    """
+    Return the application's engine, creating it on first use.
+
+    Creating the engine lazily keeps startup fast for invocations that never touch the database.
+
+    Returns:
+        sqlalchemy.engine.Engine: The engine for DATABASE_URL.
+    """
+    global _engine
+    if _engine is None:
+        _engine = create_engine_with_retry(DATABASE_URL)
+    return _engine
+
+def _create_session():
+    return SessionFactory(bind=get_engine())
+
+SessionFactory = sessionmaker()
+register_blob_events(SessionFactory)
+register_cache_events(SessionFactory)
+register_signature_events(SessionFactory)
+register_history_events(SessionFactory)
+register_related_events(SessionFactory)
+# Each thread (the REPL, a worker) gets one long-lived session; commands close it when they
+# finish, which hands the connection back to the pool without tearing it down.
+Session = scoped_session(_create_session)
+
+def close_database():
+    """
+    Release the session of the current thread and close all pooled connections.
+    """
+    global _engine
+    Session.remove()
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+    if SHARD_DIRECTORY:
+        from shards import close_shards
+        close_shards()
 
-def create_tables():
+def is_lock_error(error):
     """
-    Create the database tables based on the defined models.
+    Tell whether a database error was caused by another connection holding a lock.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        bool: True for SQLite's 'database is locked' and 'database table is locked' errors.
+    """
+    return isinstance(error, OperationalError) and 'locked' in str(error.orig).lower()
+
+def write_with_retry(work, retries=WRITE_RETRIES, delay=WRITE_RETRY_DELAY, max_delay=WRITE_RETRY_MAX_DELAY,
+        on_retry=None, session_factory=None):
+    """
+    Runs a unit of write work in a transaction of the current thread's session and commit it,
+    starting over when the database is locked by another writer.
+
+    SQLite lets one connection write at a time. A writer waits up to the profile's busy_timeout
+    for the lock, but a transaction that read before it wrote fails at once if another
+    connection committed in between, so work that fails on a lock is rolled back and run again
+    after an exponentially growing, jittered delay. Any other error rolls back and is raised.
+
+    Args:
+        work (callable): Called as work(session) to make the changes; it must not commit. It
+            may be called more than once, so it must not have effects outside the session.
+        retries (int): The number of times to start over (default: WRITE_RETRIES).
+        delay (float): The delay in seconds before the first retry, doubled for every following
+            one (default: WRITE_RETRY_DELAY).
+        max_delay (float): The longest delay in seconds (default: WRITE_RETRY_MAX_DELAY).
+        on_retry (callable, optional): Called as on_retry(attempt, error) before every retry.
+        session_factory (scoped_session, optional): Where the session comes from, such as the
+            sessions of a shard (default: Session).
+
+    Returns:
+        The value returned by work.
+
+    Raises:
+        OperationalError: If the database is still locked after the last retry.
+    """
+    for attempt in range(retries + 1):
+        session = (session_factory or Session)()
+        try:
+            result = work(session)
+            session.commit()
+            return result
+        except Exception as e:
+            session.rollback()
+            if attempt == retries or not is_lock_error(e):
+                raise
+            if on_retry:
+                on_retry(attempt + 1, e)
+            time.sleep(min(max_delay, delay * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+# Stored in PRAGMA user_version once the schema is created. Bump it whenever tables, indexes
+# or triggers are added, so existing databases pick them up on their next start, and add an
+# entry to MIGRATIONS if existing rows have to be rewritten.
+SCHEMA_VERSION = 10
+
+def _migrate_to_code_blobs(connection):
+    drop_search_index(connection)
+    migrate_inline_code(connection)
+
+def _migrate_to_compressed_blobs(connection):
+    drop_search_triggers(connection)
+    add_codec_column(connection)
+
+# Schema version -> the function that upgrades a database from the previous version.
+MIGRATIONS = {
+    2: _migrate_to_code_blobs,
+    3: _migrate_to_compressed_blobs,
+    5: backfill_signatures,
+    7: add_snippet_uids,
+}
+
+def create_tables(engine=None):
+    """
+    Create the database tables based on the defined models, along with the full-text search and
+    trigram indexes, the snippet statistics, the change log, and the tag, version history and
+    related search triggers.
+
+    Indexes that were added to the models after a table was created are created as well, and
+    databases at an older schema version are migrated. Nothing is done if the database is
+    already at SCHEMA_VERSION.
+
+    Args:
+        engine (sqlalchemy.engine.Engine, optional): The database to create the tables in, such
+            as a shard (default: the application's engine).
 
     Raises:
         Exception: If an error occurs while creating the tables.
     """
     try:
+        engine = engine or get_engine()
+        with engine.connect() as connection:
+            version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        if version == SCHEMA_VERSION:
+            return
         Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            if version:
+                for target in range(version + 1, SCHEMA_VERSION + 1):
+                    if target in MIGRATIONS:
+                        MIGRATIONS[target](connection)
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+            create_search_index(connection)
+            create_trigram_index(connection)
+            create_signature_index(connection)
+            create_stats_index(connection)
+            create_change_log(connection)
+            create_tag_index(connection)
+            create_history_index(connection)
+            create_related_index(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
     except Exception as e:
         print(f"An error occurred while creating tables: {str(e)}")
-        raise
\ No newline at end of file
+        raise
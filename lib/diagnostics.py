@@ -0,0 +1,273 @@
+# lib/diagnostics.py
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+EXPLAINED_STATEMENTS = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+
+@contextmanager
+def explain_queries(engine, out=print):
+    """
+    Prints the SQLite query plan of every statement the engine runs while the context is active.
+
+    Plan steps that scan a whole table rather than searching an index are marked, so that a
+    missing or unused index shows up before it reaches a production-sized database.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The engine whose statements are explained.
+        out (callable): The function used to print the plans (default: print).
+    """
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+            return
+        explain_cursor = cursor.connection.cursor()
+        try:
+            plan = explain_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        finally:
+            explain_cursor.close()
+        out(f"Query: {' '.join(statement.split())}")
+        for line in format_plan(plan):
+            out(f"  {line}")
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def format_plan(plan):
+    """
+    Formats EXPLAIN QUERY PLAN rows as an indented tree.
+
+    Args:
+        plan (list): The (id, parent, notused, detail) rows returned by EXPLAIN QUERY PLAN.
+
+    Returns:
+        list: One line per plan step. Full table scans are marked with '<-- full scan'.
+    """
+    depths = {0: -1}
+    lines = []
+    for step_id, parent, _, detail in plan:
+        depth = depths.get(parent, -1) + 1
+        depths[step_id] = depth
+        line = "  " * depth + detail
+        if is_full_scan(detail):
+            line += "  <-- full scan"
+        lines.append(line)
+    return lines
+
+def is_full_scan(detail):
+    """
+    Tells whether a plan step reads every row of a table.
+
+    Scans of virtual tables (the full-text index) and of covering indexes are not counted.
+
+    Args:
+        detail (str): The detail column of an EXPLAIN QUERY PLAN row.
+
+    Returns:
+        bool: True if the step is a full table scan.
+    """
+    return detail.startswith('SCAN ') and 'VIRTUAL TABLE' not in detail and 'COVERING INDEX' not in detail
+
+class QueryProfile:
+    """
+    The statements a command ran, as recorded by profile_queries.
+
+    Attributes:
+        statements (dict): Per distinct SQL text, a [count, seconds, rows] list, where seconds
+            includes the time spent fetching the statement's rows.
+        parameters (dict): Per distinct SQL text, the parameters of every execution, with the
+            statement that first fetched each of their values, or None.
+        elapsed (float): The wall-clock time of the profiled block, in seconds.
+    """
+
+    # Fetched values remembered to trace parameters back to rows: integers and short strings,
+    # which is what keys are.
+    TRACED_STRING_LENGTH = 64
+
+    def __init__(self):
+        """
+        Initializes a new, empty QueryProfile.
+        """
+        self.statements = {}
+        self.parameters = {}
+        self.elapsed = 0.0
+        self._sources = {}
+
+    @property
+    def count(self):
+        """int: The number of statements executed."""
+        return sum(stats[0] for stats in self.statements.values())
+
+    @property
+    def seconds(self):
+        """float: The time spent executing statements and fetching their rows, in seconds."""
+        return sum(stats[1] for stats in self.statements.values())
+
+    @property
+    def rows(self):
+        """int: The number of rows fetched from the database."""
+        return sum(stats[2] for stats in self.statements.values())
+
+    def repeated(self, threshold=2):
+        """
+        Returns the statements that ran at least threshold times, most frequent first.
+
+        A statement is a likely N+1 query when, in at least threshold of its executions, the
+        parameters that change from one execution to the next came from the rows of an earlier,
+        different statement: it ran once per row of that result. A statement fed by its own
+        earlier results, such as the batches of keyset pagination, is not.
+
+        Args:
+            threshold (int): The minimum number of executions (default: 2).
+
+        Returns:
+            list: (statement, count, seconds, per_row) tuples, where per_row tells whether the
+            statement looks like an N+1 query.
+        """
+        repeated = [(statement, count, seconds, self._per_row(statement) >= threshold)
+            for statement, (count, seconds, _) in self.statements.items() if count >= threshold]
+        return sorted(repeated, key=lambda item: (-item[1], -item[2]))
+
+    def _per_row(self, statement):
+        # The number of executions whose changing parameters came from another statement's rows.
+        executions = self.parameters.get(statement, [])
+        width = min((len(values) for values, _ in executions), default=0)
+        changing = [position for position in range(width)
+            if len({values[position] for values, _ in executions}) > 1]
+        return sum(1 for _, sources in executions
+            if any(sources[position] not in (None, statement) for position in changing))
+
+    def _record(self, statement):
+        return self.statements.setdefault(' '.join(statement.split()), [0, 0.0, 0])
+
+    def _record_execution(self, statement, parameters):
+        key = ' '.join(statement.split())
+        values = _parameter_values(parameters)
+        sources = tuple(self._sources.get(value) if self._traced(value) else None for value in values)
+        self.parameters.setdefault(key, []).append((values, sources))
+        return key, self._record(statement)
+
+    def _traced(self, value):
+        if isinstance(value, bool):
+            return False
+        return isinstance(value, int) or isinstance(value, str) and len(value) <= self.TRACED_STRING_LENGTH
+
+    def _record_rows(self, key, rows):
+        for row in rows:
+            for value in row:
+                if self._traced(value):
+                    self._sources.setdefault(value, key)
+
+def _parameter_values(parameters):
+    # The parameters of one execution as a tuple; those of executemany are not traced.
+    if isinstance(parameters, dict):
+        return tuple(value for _, value in sorted(parameters.items()))
+    if isinstance(parameters, (list, tuple)) and not any(isinstance(item, (list, tuple, dict)) for item in parameters):
+        return tuple(parameters)
+    return ()
+
+class _CountingCursor:
+    """
+    Wraps a DB-API cursor, counting the rows fetched through it and the time spent fetching
+    them. SQLite computes rows as they are fetched, so most of a query's cost is spent here.
+    """
+
+    def __init__(self, cursor, profile, key, stats):
+        self._cursor = cursor
+        self._profile = profile
+        self._key = key
+        self._stats = stats
+
+    def _fetched(self, start, rows):
+        self._stats[1] += time.perf_counter() - start
+        self._stats[2] += len(rows)
+        self._profile._record_rows(self._key, rows)
+        return rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched(start, [row] if row is not None else [])
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        return self._fetched(start, self._cursor.fetchmany(*args))
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self._fetched(start, self._cursor.fetchall())
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+@contextmanager
+def profile_queries(engine):
+    """
+    Records the number, duration, parameters and result size of the statements the engine runs
+    while the context is active.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The engine whose statements are profiled.
+
+    Yields:
+        QueryProfile: The profile, filled in as statements run.
+    """
+    profile = QueryProfile()
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._profile_start = time.perf_counter()
+
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        key, stats = profile._record_execution(statement, () if executemany else parameters)
+        stats[0] += 1
+        stats[1] += time.perf_counter() - context._profile_start
+        if cursor.description is not None:
+            context.cursor = _CountingCursor(cursor, profile, key, stats)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.elapsed = time.perf_counter() - start
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute', after_cursor_execute)
+
+def format_profile(name, profile, threshold=2):
+    """
+    Formats a QueryProfile as a short report.
+
+    Args:
+        name (str): The name of the profiled command.
+        profile (QueryProfile): The profile.
+        threshold (int): Statements run at least this many times are listed (default: 2).
+
+    Returns:
+        list: The report lines. Repeated statements that ran once per row of an earlier result
+        are marked as possible N+1 queries.
+    """
+    lines = [
+        f"Profile of {name}: {profile.elapsed * 1000:.1f} ms",
+        f"  Statements: {profile.count}, DB time: {profile.seconds * 1000:.1f} ms, rows fetched: {profile.rows}",
+    ]
+    repeated = profile.repeated(threshold)
+    if repeated:
+        lines.append("  Repeated statements:")
+        for statement, count, seconds, per_row in repeated:
+            marker = "  <-- possible N+1" if per_row else ""
+            lines.append(f"    {count}x {seconds * 1000:.1f} ms  {_shorten(statement)}{marker}")
+    return lines
+
+def _shorten(statement, width=120):
+    return statement if len(statement) <= width else statement[:width - 3] + "..."
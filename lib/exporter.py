@@ -0,0 +1,130 @@
+# lib/exporter.py
+import io
+import json
+import re
+import sys
+import tarfile
+import time
+from config import EXPORT_BATCH_SIZE, LANGUAGE_EXTENSIONS
+from models import Snippet
+from compression import decompress_code
+from queries import snippet_export_query, iter_keyset
+
+EXPORT_FORMATS = ["jsonl", "tar"]
+
+def language_extension(language):
+    """
+    Returns the file extension used for snippets in the given language.
+
+    Args:
+        language (str): The snippet language.
+
+    Returns:
+        str: The first extension mapped to the language in LANGUAGE_EXTENSIONS, or '.txt'.
+    """
+    for extension, name in LANGUAGE_EXTENSIONS.items():
+        if name == language.lower():
+            return extension
+    return '.txt'
+
+def snippet_file_name(snippet_id, title, language):
+    """
+    Builds the archive member name for a snippet: '<id>-<title>.<ext>'.
+
+    Args:
+        snippet_id (int): The ID of the snippet.
+        title (str): The title of the snippet.
+        language (str): The language of the snippet.
+
+    Returns:
+        str: A file name that is unique per snippet and safe on any file system.
+    """
+    stem = re.sub(r'[^A-Za-z0-9_.-]+', '_', title).strip('._')[:60]
+    stem, _ = _split_known_extension(stem)
+    return f"{snippet_id}-{stem or 'snippet'}{language_extension(language)}"
+
+def _split_known_extension(stem):
+    """
+    Drops a trailing source extension from a title, so 'utils/a.py' does not become 'a.py.py'.
+    """
+    for extension in LANGUAGE_EXTENSIONS:
+        if stem.lower().endswith(extension):
+            return stem[:-len(extension)], extension
+    return stem, None
+
+def export_snippets(session, path, export_format="jsonl", language=None, collection_name=None, username=None,
+        on_progress=None):
+    """
+    Streams snippets to a JSON Lines file or a tar archive.
+
+    Rows are read in keyset-paginated batches of EXPORT_BATCH_SIZE and written as they arrive,
+    so memory use does not grow with the number of snippets. JSONL records use the same fields
+    as the import command, so an export can be imported into another store. In a tar archive,
+    each snippet is a file under its collection's directory, named by its language's extension.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        path (str): The output file. '-' writes JSONL to standard output. Archives whose name
+            ends in '.gz' or '.tgz' are gzip-compressed.
+        export_format (str): 'jsonl' or 'tar' (default: 'jsonl').
+        language (str, optional): Only export snippets in this programming language.
+        collection_name (str, optional): Only export snippets in this collection.
+        username (str, optional): Only export snippets owned by this user.
+        on_progress (callable, optional): Called as on_progress(exported, elapsed) after every batch.
+
+    Returns:
+        int: The number of exported snippets.
+
+    Raises:
+        ValueError: If the format is unknown or a tar archive is written to standard output.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}'. Expected one of: {', '.join(EXPORT_FORMATS)}.")
+    if export_format == "tar" and path == "-":
+        raise ValueError("A tar archive cannot be written to standard output.")
+    query = snippet_export_query(session, language, collection_name, username)
+    rows = iter_keyset(query, Snippet.id, batch_size=EXPORT_BATCH_SIZE)
+    write = _write_tar if export_format == "tar" else _write_jsonl
+    return write(rows, path, on_progress)
+
+def _report(count, start, on_progress):
+    if on_progress and count % EXPORT_BATCH_SIZE == 0:
+        on_progress(count, time.perf_counter() - start)
+
+def _write_jsonl(rows, path, on_progress):
+    start = time.perf_counter()
+    file = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+    count = 0
+    try:
+        for snippet_id, title, description, language, data, codec, collection_name, username in rows:
+            file.write(json.dumps({
+                "id": snippet_id,
+                "title": title,
+                "description": description,
+                "language": language,
+                "code": decompress_code(data, codec),
+                "collection": collection_name,
+                "user": username,
+            }) + "\n")
+            count += 1
+            _report(count, start, on_progress)
+    finally:
+        if file is not sys.stdout:
+            file.close()
+    return count
+
+def _write_tar(rows, path, on_progress):
+    start = time.perf_counter()
+    mode = "w|gz" if path.endswith((".gz", ".tgz")) else "w|"
+    count = 0
+    with tarfile.open(path, mode) as archive:
+        for snippet_id, title, description, language, data, codec, collection_name, username in rows:
+            data = decompress_code(data, codec).encode("utf-8")
+            directory = re.sub(r'[^A-Za-z0-9_.-]+', '_', collection_name or "uncategorized")
+            info = tarfile.TarInfo(f"{directory}/{snippet_file_name(snippet_id, title, language)}")
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+            count += 1
+            _report(count, start, on_progress)
+    return count
@@ -0,0 +1,359 @@
+# lib/grep.py
+import collections
+import itertools
+import re
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text
+from config import GREP_WORKERS, GREP_CHUNK_SIZE, GREP_EXACT_LIMIT
+from compression import decompress_code
+
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+TRIGRAM_TABLE = 'snippets_trigrams'
+TRIGRAM_CONTENT_VIEW = 'snippet_code'
+TRIGRAM_TRIGGERS = ['snippets_trigrams_ai', 'snippets_trigrams_ad', 'snippets_trigrams_au']
+
+# A trigram index of the code of every snippet, kept in sync by triggers like the full-text
+# index in search.py. The trigram tokenizer folds case, so it finds the candidates of both
+# case-sensitive and case-insensitive patterns.
+TRIGRAM_SCHEMA = [
+    f"""
+    CREATE VIEW IF NOT EXISTS {TRIGRAM_CONTENT_VIEW} AS
+    SELECT s.id AS id, code_text(b.body, b.codec) AS code
+    FROM snippets s JOIN code_blobs b ON b.hash = s.code_hash
+    """,
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {TRIGRAM_TABLE} USING fts5(
+        code,
+        content='{TRIGRAM_CONTENT_VIEW}', content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_trigrams_ai AFTER INSERT ON snippets BEGIN
+        INSERT INTO {TRIGRAM_TABLE}(rowid, code)
+        VALUES (new.id, (SELECT code_text(body, codec) FROM code_blobs WHERE hash = new.code_hash));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_trigrams_ad AFTER DELETE ON snippets BEGIN
+        INSERT INTO {TRIGRAM_TABLE}({TRIGRAM_TABLE}, rowid, code)
+        VALUES ('delete', old.id, (SELECT code_text(body, codec) FROM code_blobs WHERE hash = old.code_hash));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_trigrams_au AFTER UPDATE OF code_hash ON snippets BEGIN
+        INSERT INTO {TRIGRAM_TABLE}({TRIGRAM_TABLE}, rowid, code)
+        VALUES ('delete', old.id, (SELECT code_text(body, codec) FROM code_blobs WHERE hash = old.code_hash));
+        INSERT INTO {TRIGRAM_TABLE}(rowid, code)
+        VALUES (new.id, (SELECT code_text(body, codec) FROM code_blobs WHERE hash = new.code_hash));
+    END
+    """,
+]
+
+def create_trigram_index(connection):
+    """
+    Creates the trigram index of snippet code and the triggers that keep it in sync.
+
+    If the index is created on a database that already holds snippets, it is built from them.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    existed = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": TRIGRAM_TABLE}).first() is not None
+    for statement in TRIGRAM_SCHEMA:
+        connection.execute(text(statement))
+    if not existed:
+        connection.execute(text(f"INSERT INTO {TRIGRAM_TABLE}({TRIGRAM_TABLE}) VALUES ('rebuild')"))
+
+def drop_trigram_triggers(connection):
+    """
+    Drops the content view and triggers of the trigram index but keeps the indexed data.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    for trigger in TRIGRAM_TRIGGERS:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    connection.execute(text(f"DROP VIEW IF EXISTS {TRIGRAM_CONTENT_VIEW}"))
+
+# Trigram queries are nested tuples: ('and', [...]) and ('or', [...]) of literal strings, each of
+# which must occur in the code. ANY matches every snippet.
+ANY = ('and', [])
+
+def _and(*queries):
+    parts = []
+    for query in queries:
+        if query == ANY:
+            continue
+        if isinstance(query, tuple) and query[0] == 'and':
+            parts.extend(part for part in query[1] if part not in parts)
+        elif query not in parts:
+            parts.append(query)
+    return parts[0] if len(parts) == 1 else ('and', parts)
+
+def _or(*queries):
+    parts = []
+    for query in queries:
+        if query == ANY:
+            return ANY
+        if isinstance(query, tuple) and query[0] == 'or':
+            parts.extend(part for part in query[1] if part not in parts)
+        elif query not in parts:
+            parts.append(query)
+    return parts[0] if len(parts) == 1 else ('or', parts)
+
+def _exact_query(strings):
+    # The trigram index cannot look up strings shorter than a trigram, and it folds case.
+    if strings is None or any(len(string) < 3 for string in strings):
+        return ANY
+    return _or(*sorted({string.lower() for string in strings}))
+
+class _Info:
+    """
+    What is known about the text a regular expression node matches: the set of strings it can
+    match exactly, when that set is small, and a trigram query that every match satisfies.
+    """
+
+    def __init__(self, exact=None, query=ANY):
+        self.exact = exact
+        self.query = query
+
+    def to_query(self):
+        return _and(self.query, _exact_query(self.exact))
+
+def _analyze_sequence(nodes):
+    run = {''}
+    query = ANY
+    flushed = False
+    for node in nodes:
+        info = _analyze(node)
+        if info.exact is not None and len(run) * len(info.exact) <= GREP_EXACT_LIMIT:
+            run = {prefix + suffix for prefix in run for suffix in info.exact}
+            query = _and(query, info.query)
+            continue
+        # The literal run ends here; what it matched is still required.
+        query = _and(query, _exact_query(run), info.query)
+        flushed = True
+        if info.exact is not None:
+            run = info.exact
+        else:
+            run = {''}
+    if flushed:
+        return _Info(None, _and(query, _exact_query(run)))
+    return _Info(run, query)
+
+def _analyze(node):
+    op, value = node
+    if op == sre_parse.LITERAL:
+        return _Info({chr(value)})
+    if op == sre_parse.IN:
+        chars = set()
+        for item_op, item in value:
+            if item_op == sre_parse.LITERAL:
+                chars.add(chr(item))
+            elif item_op == sre_parse.RANGE and item[1] - item[0] < GREP_EXACT_LIMIT:
+                chars.update(chr(code) for code in range(item[0], item[1] + 1))
+            else:
+                return _Info()
+        return _Info(chars if len(chars) <= GREP_EXACT_LIMIT else None)
+    if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        # Anchors and lookarounds match no text of their own.
+        return _Info({''})
+    if op == sre_parse.SUBPATTERN:
+        return _analyze_sequence(value[-1])
+    if op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+        return _analyze_sequence(value)
+    if op == sre_parse.BRANCH:
+        branches = [_analyze_sequence(branch) for branch in value[1]]
+        if all(branch.exact is not None for branch in branches):
+            exact = set().union(*(branch.exact for branch in branches))
+            if len(exact) <= GREP_EXACT_LIMIT:
+                return _Info(exact, _or(*(branch.query for branch in branches)))
+        return _Info(None, _or(*(branch.to_query() for branch in branches)))
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        low, high, nodes = value
+        if low == 0:
+            return _Info()
+        info = _analyze_sequence(nodes)
+        if low == high and info.exact is not None and len(info.exact) ** low <= GREP_EXACT_LIMIT:
+            exact = {''}
+            for _ in range(low):
+                exact = {prefix + suffix for prefix in exact for suffix in info.exact}
+            return _Info(exact, info.query)
+        return _Info(None, info.to_query())
+    return _Info()
+
+def trigram_query(pattern):
+    """
+    Turns a regular expression into the trigram query that narrows down its candidates.
+
+    Every snippet the expression matches also matches the query, so only the snippets that
+    match the query need to be searched with the expression itself.
+
+    Args:
+        pattern (str): The regular expression.
+
+    Returns:
+        tuple or str: The query; ANY when the expression has no literal text of three or more
+        characters to look up.
+
+    Raises:
+        ValueError: If the regular expression is invalid.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid regular expression: {e}")
+    return _analyze_sequence(list(parsed)).to_query()
+
+def build_trigram_match(query):
+    """
+    Renders a trigram query as an FTS5 MATCH expression.
+
+    Args:
+        query (tuple or str): A query returned by trigram_query, other than ANY.
+
+    Returns:
+        str: The MATCH expression.
+    """
+    if isinstance(query, str):
+        return '"' + query.replace('"', '""') + '"'
+    operator = ' AND ' if query[0] == 'and' else ' OR '
+    return '(' + operator.join(build_trigram_match(part) for part in query[1]) + ')'
+
+_worker_regex = None
+
+def _start_worker(pattern, flags):
+    global _worker_regex
+    _worker_regex = re.compile(pattern, flags)
+
+def _grep_chunk(rows, max_lines):
+    """
+    Searches a chunk of (id, title, language, body, codec) rows with the worker's regular expression.
+
+    Returns:
+        list: (id, title, language, matches) tuples for the matching rows, where matches lists up
+        to max_lines (line number, line) pairs.
+    """
+    results = []
+    for snippet_id, title, language, body, codec in rows:
+        code = decompress_code(body, codec)
+        match = _worker_regex.search(code)
+        if not match:
+            continue
+        lines = []
+        while match and len(lines) < max_lines:
+            line_start = code.rfind('\n', 0, match.start()) + 1
+            line_end = code.find('\n', match.start())
+            if line_end == -1:
+                line_end = len(code)
+            lines.append((code.count('\n', 0, line_start) + 1, code[line_start:line_end]))
+            match = _worker_regex.search(code, max(line_end + 1, match.end()))
+        results.append((snippet_id, title, language, lines))
+    return results
+
+def _candidate_chunks(session, query, chunk_size):
+    # Streams the code of the candidates in ID order, chunk_size rows at a time.
+    if query == ANY:
+        statement = text("""
+            SELECT s.id, s.title, s.language, b.body, b.codec FROM snippets s JOIN code_blobs b ON b.hash = s.code_hash
+            WHERE s.id > :after ORDER BY s.id LIMIT :limit
+        """)
+        parameters = {}
+    else:
+        statement = text(f"""
+            SELECT s.id, s.title, s.language, b.body, b.codec FROM {TRIGRAM_TABLE} t
+            JOIN snippets s ON s.id = t.rowid
+            JOIN code_blobs b ON b.hash = s.code_hash
+            WHERE {TRIGRAM_TABLE} MATCH :query AND t.rowid > :after
+            ORDER BY t.rowid LIMIT :limit
+        """)
+        parameters = {"query": build_trigram_match(query)}
+    after = 0
+    while True:
+        rows = session.execute(statement, dict(parameters, after=after, limit=chunk_size)).fetchall()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        after = rows[-1][0]
+
+def grep_snippets(session, pattern, ignore_case=False, limit=None, max_lines=3, workers=GREP_WORKERS,
+        chunk_size=GREP_CHUNK_SIZE, stats=None):
+    """
+    Finds the snippets whose code matches a regular expression.
+
+    The trigram index narrows the snippets down to those that contain every literal the
+    expression requires, and only their code is searched with the expression. Large candidate
+    sets are searched in chunks on a pool of worker processes; results come back in ID order.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        pattern (str): The regular expression, in Python's syntax.
+        ignore_case (bool): Match without regard to case (default: False).
+        limit (int, optional): The maximum number of snippets to return.
+        max_lines (int): The maximum number of matching lines returned per snippet (default: 3).
+        workers (int): The number of worker processes; 0 or 1 searches in this process
+            (default: GREP_WORKERS).
+        chunk_size (int): The number of snippets searched per task (default: GREP_CHUNK_SIZE).
+        stats (dict, optional): Filled in with the trigram 'query' and the number of 'candidates'.
+
+    Yields:
+        tuple: (id, title, language, matches) for every matching snippet, where matches lists
+        (line number, line) pairs.
+
+    Raises:
+        ValueError: If the regular expression is invalid.
+    """
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    try:
+        re.compile(pattern, flags)
+    except re.error as e:
+        raise ValueError(f"Invalid regular expression: {e}")
+    query = trigram_query(pattern)
+    if stats is not None:
+        stats['query'] = None if query == ANY else build_trigram_match(query)
+        stats['candidates'] = 0
+
+    def counted(chunk):
+        if stats is not None:
+            stats['candidates'] += len(chunk)
+        return chunk
+
+    chunks = _candidate_chunks(session, query, chunk_size)
+    head = list(itertools.islice(chunks, 2))
+    chunks = (counted(chunk) for chunk in itertools.chain(head, chunks))
+    # A single chunk of candidates is not worth starting worker processes for.
+    if workers > 1 and len(head) > 1:
+        results = _pool_results(chunks, pattern, flags, max_lines, workers)
+    else:
+        _start_worker(pattern, flags)
+        results = (result for chunk in chunks for result in _grep_chunk(chunk, max_lines))
+    found = 0
+    for result in results:
+        yield result
+        found += 1
+        if limit is not None and found >= limit:
+            results.close()
+            return
+
+def _pool_results(chunks, pattern, flags, max_lines, workers):
+    # Keeps a few chunks queued per worker, so memory stays bounded on large stores, and yields
+    # the results in the order the chunks were read.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(pattern, flags)) as pool:
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(_grep_chunk, chunk, max_lines))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,237 @@
+# lib/history.py
+import difflib
+import json
+from sqlalchemy import event, func, insert, inspect, text, tuple_
+from config import HISTORY_CHECKPOINT_INTERVAL
+from models import CodeBlob, Snippet, SnippetVersion, hash_code
+from compression import compress_code, decompress_code
+from store import get_snippet
+
+HISTORY_TRIGGERS = ['snippets_versions_ad']
+
+# The versions of a snippet go with it, however it is deleted.
+HISTORY_SCHEMA = [
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_versions_ad AFTER DELETE ON snippets BEGIN
+        DELETE FROM snippet_versions WHERE snippet_id = old.id;
+    END
+    """,
+]
+
+def create_history_index(connection):
+    """
+    Creates the trigger that deletes the saved versions of deleted snippets.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    for statement in HISTORY_SCHEMA:
+        connection.execute(text(statement))
+
+def register_history_events(session_factory):
+    """
+    Registers the flush hook that saves a new version of every snippet that is edited.
+
+    Args:
+        session_factory (sqlalchemy.orm.sessionmaker): The factory whose sessions get the hook.
+    """
+    event.listen(session_factory, 'before_flush', save_versions)
+
+def _old_value(state, key):
+    history = state.attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(state.obj(), key)
+
+def save_versions(session, flush_context, instances):
+    """
+    Saves a version of every snippet whose title, description, language or code is about to
+    be changed by the flush.
+
+    Snippets are not given a version when they are created, only when they are first edited:
+    then the state they had until the edit is saved as version 1 and the edit as version 2.
+    This keeps history out of bulk imports, and means a snippet changed without the ORM (by
+    'update where', say) simply gets its state before the next edit saved as a version too.
+    """
+    edits = {}
+    with session.no_autoflush:
+        for snippet in session.dirty:
+            if not isinstance(snippet, Snippet) or snippet.id is None:
+                continue
+            state = inspect(snippet)
+            # The blob is loaded when the code is set; if it was not, the code did not change.
+            code_changed = 'blob' not in state.unloaded and snippet.blob is not None \
+                and snippet.blob.hash != snippet.code_hash
+            old = [_old_value(state, key) for key in ('_title', 'description', '_language')]
+            if old == [snippet.title, snippet.description, snippet.language] and not code_changed:
+                continue
+            # code_hash still holds the old hash; it is only set from the new blob during the flush.
+            old_code = session.get(CodeBlob, snippet.code_hash).body if code_changed else snippet.code
+            edits[snippet.id] = (tuple(old) + (old_code,),
+                (snippet.title, snippet.description, snippet.language, snippet.code))
+        if edits:
+            _append_versions(session.connection(), edits)
+
+def _append_versions(connection, edits):
+    table = SnippetVersion.__table__
+    latest = connection.execute(table.select()
+        .with_only_columns(table.c.snippet_id, table.c.version, table.c.checkpoint, table.c.title,
+            table.c.description, table.c.language, table.c.code_hash)
+        .where(tuple_(table.c.snippet_id, table.c.version).in_(
+            table.select().with_only_columns(table.c.snippet_id, func.max(table.c.version))
+                .where(table.c.snippet_id.in_(list(edits)))
+                .group_by(table.c.snippet_id)))).mappings().all()
+    latest = {row['snippet_id']: row for row in latest}
+    rows = []
+    for snippet_id, (old, new) in edits.items():
+        previous = latest.get(snippet_id)
+        if previous is None or (previous['title'], previous['description'], previous['language'],
+                previous['code_hash']) != old[:3] + (hash_code(old[3]),):
+            # The state before this edit was never saved, so it is saved first, in full.
+            previous = _version(snippet_id, previous and previous['version'], None, old)
+            rows.append(previous)
+        rows.append(_version(snippet_id, previous['version'], previous['checkpoint'], new, old[3]))
+    connection.execute(insert(table), rows)
+
+def _version(snippet_id, previous_version, previous_checkpoint, fields, previous_code=None):
+    title, description, language, code = fields
+    version = (previous_version or 0) + 1
+    added, removed = 0, 0
+    if previous_code is not None:
+        delta, added, removed = diff_code(previous_code, code)
+    if previous_checkpoint is None or version - previous_checkpoint >= HISTORY_CHECKPOINT_INTERVAL:
+        checkpoint, payload = version, code
+    else:
+        checkpoint, payload = previous_checkpoint, json.dumps(delta, separators=(',', ':'))
+    data, codec = compress_code(payload)
+    return {'snippet_id': snippet_id, 'version': version, 'checkpoint': checkpoint, 'title': title,
+        'description': description, 'language': language, 'code_hash': hash_code(code), 'data': data,
+        'codec': codec, 'added': added, 'removed': removed}
+
+def diff_code(old, new):
+    """
+    Computes a line delta that turns one version of code into the next.
+
+    The delta is a list of [start, end] ranges of lines to copy from the old code and strings
+    of new text to insert, in order.
+
+    Args:
+        old (str): The old code.
+        new (str): The new code.
+
+    Returns:
+        tuple: The delta, and the number of lines added and removed.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    delta = []
+    added = removed = 0
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+            continue
+        removed += i2 - i1
+        added += j2 - j1
+        if j2 > j1:
+            delta.append("".join(new_lines[j1:j2]))
+    return delta, added, removed
+
+def apply_delta(old, delta):
+    """
+    Applies a delta computed by diff_code.
+
+    Args:
+        old (str): The code the delta was computed against.
+        delta (list): The delta.
+
+    Returns:
+        str: The new code.
+    """
+    old_lines = old.splitlines(keepends=True)
+    return "".join("".join(old_lines[part[0]:part[1]]) if isinstance(part, list) else part for part in delta)
+
+def snippet_history(session, snippet_id):
+    """
+    Lists the saved versions of a snippet, newest first, without rebuilding their code.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+
+    Returns:
+        list: (version, saved_at, title, language, added, removed, kind, stored bytes) rows,
+        where kind is 'full' for checkpoints and 'delta' otherwise. Empty if the snippet has
+        never been edited.
+
+    Raises:
+        ValueError: If the snippet is not found.
+    """
+    snippet_id = int(snippet_id)
+    get_snippet(session, snippet_id)
+    return [(version, saved_at, title, language, added, removed, 'full' if version == checkpoint else 'delta',
+            stored)
+        for version, checkpoint, saved_at, title, language, added, removed, stored in session.query(
+            SnippetVersion.version, SnippetVersion.checkpoint, SnippetVersion.saved_at, SnippetVersion.title,
+            SnippetVersion.language, SnippetVersion.added, SnippetVersion.removed, func.length(SnippetVersion.data))
+        .filter(SnippetVersion.snippet_id == snippet_id).order_by(SnippetVersion.version.desc())]
+
+def snippet_version(session, snippet_id, version):
+    """
+    Rebuilds a saved version of a snippet.
+
+    The version's checkpoint and the deltas after it are read in one range query, so at most
+    HISTORY_CHECKPOINT_INTERVAL rows are read and applied however many versions there are.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+        version (int): The number of the version.
+
+    Returns:
+        tuple: The title, description, language and code of the snippet in that version. A
+        snippet that has never been edited has one version, its current state.
+
+    Raises:
+        ValueError: If the snippet or version is not found, or the rebuilt code does not match
+            the version's hash.
+    """
+    snippet_id, version = int(snippet_id), int(version)
+    row = session.get(SnippetVersion, (snippet_id, version))
+    if row is None:
+        snippet = get_snippet(session, snippet_id)
+        if version == 1 and not session.query(SnippetVersion.version).filter_by(snippet_id=snippet_id).first():
+            return snippet.title, snippet.description, snippet.language, snippet.code
+        raise ValueError(f"Snippet {snippet_id} has no version {version}.")
+    code = None
+    for number, data, codec in session.query(SnippetVersion.version, SnippetVersion.data, SnippetVersion.codec) \
+            .filter(SnippetVersion.snippet_id == snippet_id, SnippetVersion.version.between(row.checkpoint, version)) \
+            .order_by(SnippetVersion.version):
+        payload = decompress_code(data, codec)
+        code = payload if number == row.checkpoint else apply_delta(code, json.loads(payload))
+    if hash_code(code) != row.code_hash:
+        raise ValueError(f"Version {version} of snippet {snippet_id} could not be rebuilt: its history is damaged.")
+    return row.title, row.description, row.language, code
+
+def revert_snippet(session, snippet_id, version):
+    """
+    Restores a snippet's title, description, language and code to a saved version.
+
+    The restored state is saved as a new version, so reverting can be undone too.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+        version (int): The number of the version to restore.
+
+    Returns:
+        Snippet: The snippet.
+
+    Raises:
+        ValueError: If the snippet or version is not found.
+    """
+    title, description, language, code = snippet_version(session, snippet_id, version)
+    snippet = get_snippet(session, int(snippet_id))
+    snippet.title = title
+    snippet.description = description
+    snippet.language = language
+    snippet.code = code
+    return snippet
@@ -0,0 +1,236 @@
+# lib/importer.py
+import json
+import os
+import time
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.sqlite import insert as upsert
+from config import IMPORT_BATCH_SIZE, LANGUAGE_EXTENSIONS
+from models import User, Collection, Snippet, CodeBlob, hash_code
+from compression import compress_code
+from similarity import store_signatures
+from related import index_pending
+from utils import validate_collection_name, validate_snippet_title, validate_snippet_language, validate_snippet_code
+
+def read_jsonl(path, username=None, collection_name=None):
+    """
+    Reads snippet records from a JSON Lines file.
+
+    Each line is an object with 'title', 'language' and 'code', and optionally 'description',
+    'collection' and 'user'. A missing collection or user falls back to the given defaults.
+
+    Args:
+        path (str): The path of the JSONL file.
+        username (str, optional): The user for records that do not name one.
+        collection_name (str, optional): The collection for records that do not name one.
+
+    Yields:
+        tuple: The source location ('path:line') and either the record dict or the
+        ValueError raised while parsing the line.
+    """
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            source = f"{path}:{line_number}"
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Expected a JSON object.")
+            except ValueError as e:
+                yield source, ValueError(f"Invalid JSON: {str(e)}")
+                continue
+            record.setdefault('user', username)
+            record.setdefault('collection', collection_name)
+            yield source, record
+
+def read_directory(path, username=None, collection_name=None):
+    """
+    Reads snippet records from the source files in a directory tree.
+
+    The title is the file's path relative to the directory, the language comes from its
+    extension (see LANGUAGE_EXTENSIONS) and, unless a collection is given, the collection is
+    the name of the directory holding the file. Hidden files and directories are skipped.
+
+    Args:
+        path (str): The root directory.
+        username (str, optional): The user who will own the snippets.
+        collection_name (str, optional): The collection for all of the snippets.
+
+    Yields:
+        tuple: The file path and either the record dict or the ValueError raised while reading it.
+    """
+    root_name = os.path.basename(os.path.abspath(path))
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            file_path = os.path.join(directory, name)
+            language = LANGUAGE_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+            if language is None:
+                yield file_path, ValueError("Unsupported file extension.")
+                continue
+            try:
+                with open(file_path, encoding='utf-8') as file:
+                    code = file.read()
+            except (OSError, ValueError) as e:
+                yield file_path, ValueError(f"Could not read file: {str(e)}")
+                continue
+            parent = os.path.basename(os.path.abspath(directory)) or root_name
+            yield file_path, {
+                'title': os.path.relpath(file_path, path),
+                'description': None,
+                'language': language,
+                'code': code,
+                'collection': collection_name or parent,
+                'user': username,
+            }
+
+def import_snippets(session, records, batch_size=IMPORT_BATCH_SIZE, on_progress=None, on_reject=None):
+    """
+    Inserts snippet records in batches, one transaction and one executemany per batch.
+
+    Users and collections are resolved through in-memory caches, so each name is looked up
+    once per import. Code bodies are inserted into the code blob table first, skipping any that
+    are already stored, new bodies get their near-duplicate signature and new snippets their
+    related search vector. Missing collections are created; missing users reject the record.
+    Records that fail validation are reported through on_reject and skipped. If a batch fails
+    as a whole, it is rolled back and retried one record at a time so that only the offending
+    records are rejected.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        records (iterable): (source, record) pairs as yielded by read_jsonl or read_directory.
+        batch_size (int): The number of records per transaction (default: IMPORT_BATCH_SIZE).
+        on_progress (callable, optional): Called as on_progress(imported, rejected, elapsed)
+            after every batch.
+        on_reject (callable, optional): Called as on_reject(source, error) for every rejected record.
+
+    Returns:
+        tuple: The number of imported and rejected records.
+    """
+    users = {}
+    collections = {}
+    counts = {'imported': 0, 'rejected': 0}
+    start = time.perf_counter()
+
+    def reject(source, error):
+        counts['rejected'] += 1
+        if on_reject:
+            on_reject(source, error)
+
+    def insert_batch(batch):
+        created = []
+        valid = []
+        rows = []
+        blobs = {}
+        bodies = {}
+        for source, record in batch:
+            try:
+                row, blob = _prepare_row(session, record, users, collections, created)
+                rows.append(row)
+                blobs[blob['hash']] = blob
+                bodies[blob['hash']] = record['code']
+                valid.append((source, record))
+            except ValueError as e:
+                reject(source, str(e))
+        try:
+            if rows:
+                session.execute(insert(CodeBlob.__table__).prefix_with('OR IGNORE'), list(blobs.values()))
+                session.execute(insert(Snippet.__table__), rows)
+                store_signatures(session.connection(), bodies)
+                index_pending(session.connection())
+            session.commit()
+            return len(rows)
+        except Exception as e:
+            session.rollback()
+            for name in created:
+                collections.pop(name, None)
+            if len(valid) == 1:
+                reject(valid[0][0], str(e))
+                return 0
+        return sum(insert_batch([item]) for item in valid)
+
+    batch = []
+    for source, record in records:
+        if isinstance(record, Exception):
+            reject(source, str(record))
+            continue
+        batch.append((source, record))
+        if len(batch) < batch_size:
+            continue
+        counts['imported'] += insert_batch(batch)
+        batch = []
+        if on_progress:
+            on_progress(counts['imported'], counts['rejected'], time.perf_counter() - start)
+    if batch:
+        counts['imported'] += insert_batch(batch)
+    if on_progress:
+        on_progress(counts['imported'], counts['rejected'], time.perf_counter() - start)
+    return counts['imported'], counts['rejected']
+
+def _prepare_row(session, record, users, collections, created):
+    """
+    Validates a record and turns it into a row for the snippets table and one for the code blobs table.
+
+    Raises:
+        ValueError: If a field is invalid or the user does not exist.
+    """
+    for field in ('title', 'language', 'code'):
+        if not isinstance(record.get(field), str):
+            raise ValueError(f"Field '{field}' must be a non-empty string.")
+    title = record.get('title')
+    language = record.get('language')
+    code = record.get('code')
+    validate_snippet_title(title)
+    validate_snippet_language(language)
+    validate_snippet_code(code)
+    user_id = _user_id(session, record.get('user'), users)
+    data, codec = compress_code(code)
+    blob = {'hash': hash_code(code), 'body': data, 'codec': codec, 'size': len(code.encode('utf-8'))}
+    row = {
+        'title': title,
+        'description': record.get('description'),
+        'language': language,
+        'code_hash': blob['hash'],
+        'collection_id': _collection_id(session, record.get('collection'), collections, created),
+        'user_id': user_id,
+    }
+    return row, blob
+
+def _user_id(session, username, users):
+    """
+    Looks up a user ID through the cache.
+
+    Raises:
+        ValueError: If no username is given or the user does not exist.
+    """
+    if not username:
+        raise ValueError("No user given.")
+    if username not in users:
+        users[username] = session.execute(
+            select(User.__table__.c.id).where(User.__table__.c.username == username)).scalar()
+    if users[username] is None:
+        raise ValueError(f"User '{username}' not found.")
+    return users[username]
+
+def _collection_id(session, name, collections, created):
+    """
+    Looks up a collection ID through the cache, creating the collection if it does not exist.
+
+    Raises:
+        ValueError: If the collection name is invalid.
+    """
+    if name in collections:
+        return collections[name]
+    validate_collection_name(name)
+    table = Collection.__table__
+    query = select(table.c.id).where(table.c.name == name)
+    collection_id = session.execute(query).scalar()
+    if collection_id is None:
+        # Another writer may create the same collection at the same time.
+        if session.execute(upsert(table).values(name=name).on_conflict_do_nothing(index_elements=['name'])).rowcount:
+            created.append(name)
+        collection_id = session.execute(query).scalar_one()
+    collections[name] = collection_id
+    return collection_id
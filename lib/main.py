@@ -1,6 +1,83 @@
 #!/usr/bin/env python3
 # lib/main.py
-from commands import create_user_command, create_snippet_command, view_snippet_command, update_snippet_command, delete_snippet_command, search_snippets_command, list_snippets_command, list_collections_command
+import os
+import shlex
+import sys
+
+SEARCH_FIELDS = ["language", "collection", "user"]
+UPDATE_FIELDS = ["title", "description", "language", "code"]
+SET_FIELDS = ["language", "collection", "user", "description"]
+
+def load_command(name):
+    """
+    Return a command function, importing the commands module on first use.
+
+    The commands module pulls in SQLAlchemy, so it is only imported once a command that needs
+    it is actually about to run. Printing help or a usage error never pays for it.
+
+    Args:
+        name (str): The name of the command function in the commands module.
+
+    Returns:
+        callable: The command function.
+    """
+    import commands
+    return commands.get_command(name)
+
+def parse_options(args, names):
+    """
+    Split '--name value' options out of a list of command arguments.
+
+    Args:
+        args (list): The command arguments.
+        names (list): The option names that are accepted, without the leading dashes.
+
+    Returns:
+        tuple: The remaining positional arguments and a dict of the given option values.
+
+    Raises:
+        ValueError: If an option is unknown or has no value.
+    """
+    positional = []
+    options = {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--"):
+            name = args[i][2:]
+            if name not in names:
+                raise ValueError(f"Unknown option: --{name}")
+            if i + 1 >= len(args):
+                raise ValueError(f"Missing value for option --{name}")
+            options[name] = args[i + 1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
+def parse_pairs(args, fields, usage):
+    """
+    Read '<field> <value>' pairs into a list of values in the order of the given fields.
+
+    Args:
+        args (list): The pairs, flattened.
+        fields (list): The accepted field names.
+        usage (str): The message of the error raised for invalid pairs.
+
+    Returns:
+        list: The value of each field, or None where it was not given.
+
+    Raises:
+        ValueError: If no pairs are given, a field is unknown or repeated, or a value is missing.
+    """
+    if not args or len(args) % 2:
+        raise ValueError(usage)
+    values = [None] * len(fields)
+    for field, value in zip(args[::2], args[1::2]):
+        if field not in fields or values[fields.index(field)] is not None:
+            raise ValueError(usage)
+        values[fields.index(field)] = value
+    return values
 
 def parse_command(command):
     """
@@ -15,7 +92,7 @@ def parse_command(command):
     Raises:
         ValueError: If the command is invalid or the arguments are missing or incorrect.
     """
-    parts = command.split()
+    parts = shlex.split(command)
     if len(parts) == 0:
         return None, []
 
@@ -25,44 +102,197 @@ def parse_command(command):
     if cmd == "user":
         if len(args) != 1:
             raise ValueError("Usage: user <username>")
-        return create_user_command, args
+        return load_command("create_user_command"), args
     elif cmd == "add":
-        if len(args) != 3:
-            raise ValueError("Usage: add <title> <language> <code>")
-        return create_snippet_command, args
+        args, options = parse_options(args, ["user", "collection", "description"])
+        if len(args) != 3 or "user" not in options or "collection" not in options:
+            raise ValueError("Usage: add <title> <language> <code> --user USERNAME --collection NAME [--description TEXT]")
+        title, language, code = args
+        return load_command("create_snippet_command"), [title, options.get("description"), language, code,
+            options["collection"], options["user"]]
     elif cmd == "view":
         if len(args) != 1:
-            raise ValueError("Usage: view <snippet_id>")
-        return view_snippet_command, args
+            raise ValueError("Usage: view <snippet_id>[@<version>]")
+        if "@" in args[0]:
+            return load_command("view_version_command"), args[0].split("@", 1)
+        return load_command("view_snippet_command"), args
+    elif cmd == "history":
+        args, options = parse_options(args, ["format"])
+        if len(args) != 1:
+            raise ValueError("Usage: history <snippet_id> [--format F]")
+        return load_command("history_command"), [args[0], options.get("format")]
+    elif cmd == "revert":
+        if len(args) != 2:
+            raise ValueError("Usage: revert <snippet_id> <version>")
+        return load_command("revert_snippet_command"), args
+    elif cmd == "update" and args[:1] == ["where"]:
+        usage = ("Usage: update where <language|collection|user> <value>... "
+            "set <language|collection|user|description> <value>... [--dry-run]")
+        dry_run = "--dry-run" in args
+        args = [arg for arg in args if arg != "--dry-run"]
+        if "set" not in args:
+            raise ValueError(usage)
+        split = args.index("set")
+        filters = parse_pairs(args[1:split], SEARCH_FIELDS, usage)
+        changes = parse_pairs(args[split + 1:], SET_FIELDS, usage)
+        if not any(changes):
+            raise ValueError(usage)
+        return load_command("update_where_command"), filters + changes + [dry_run]
     elif cmd == "update":
-        if len(args) != 3:
-            raise ValueError("Usage: update <snippet_id> <field> <new_value>")
-        return update_snippet_command, args
+        if len(args) != 3 or args[1] not in UPDATE_FIELDS:
+            raise ValueError("Usage: update <snippet_id> <title|description|language|code> <new_value>")
+        snippet_id, field, value = args
+        return load_command("update_snippet_command"), [snippet_id] + [value if name == field else None
+            for name in UPDATE_FIELDS]
+    elif cmd == "delete" and args[:1] == ["where"]:
+        usage = "Usage: delete where <language|collection|user> <value>... [--dry-run]"
+        dry_run = "--dry-run" in args
+        filters = parse_pairs([arg for arg in args[1:] if arg != "--dry-run"], SEARCH_FIELDS, usage)
+        return load_command("delete_where_command"), filters + [dry_run]
     elif cmd == "delete":
         if len(args) != 1:
             raise ValueError("Usage: delete <snippet_id>")
-        return delete_snippet_command, args
+        return load_command("delete_snippet_command"), args
     elif cmd == "search":
-        if len(args) != 2:
-            raise ValueError("Usage: search <field> <value>")
-        return search_snippets_command, args
+        usage = ("Usage: search [<language|collection|user> <value>]... [tag:T]... [-tag:T]... "
+            "[--limit N] [--after ID] [--format F]")
+        args, options = parse_options(args, ["limit", "after", "format"])
+        tags = [arg[len("tag:"):] for arg in args if arg.startswith("tag:")]
+        excluded_tags = [arg[len("-tag:"):] for arg in args if arg.startswith("-tag:")]
+        args = [arg for arg in args if not arg.startswith(("tag:", "-tag:"))]
+        if args or not (tags or excluded_tags):
+            filters = parse_pairs(args, SEARCH_FIELDS, usage)
+        else:
+            filters = [None] * len(SEARCH_FIELDS)
+        return load_command("search_snippets_command"), filters + [options.get("limit"), options.get("after"),
+            options.get("format"), tags, excluded_tags]
+    elif cmd in ["tag", "untag"]:
+        if len(args) < 2:
+            raise ValueError(f"Usage: {cmd} <snippet_id> <tag>...")
+        return load_command(f"{cmd}_snippet_command"), [args[0], args[1:]]
+    elif cmd == "find":
+        args, options = parse_options(args, ["limit", "format"])
+        if len(args) == 0:
+            raise ValueError("Usage: find <terms...> [--limit N] [--format F]")
+        return load_command("find_snippets_command"), [args, options.get("limit", 20), options.get("format")]
+    elif cmd == "grep":
+        ignore_case = "--ignore-case" in args
+        args, options = parse_options([arg for arg in args if arg != "--ignore-case"], ["limit", "format"])
+        if len(args) != 1:
+            raise ValueError("Usage: grep <regex> [--ignore-case] [--limit N] [--format F]")
+        return load_command("grep_snippets_command"), [args[0], ignore_case, options.get("limit"), options.get("format")]
+    elif cmd == "import":
+        args, options = parse_options(args, ["user", "collection", "rejects"])
+        if len(args) != 1:
+            raise ValueError("Usage: import <directory|file.jsonl> [--user USERNAME] [--collection NAME] [--rejects FILE]")
+        return load_command("import_snippets_command"), [args[0], options.get("user"), options.get("collection"), options.get("rejects")]
+    elif cmd == "export":
+        args, options = parse_options(args, ["format", "language", "collection", "user"])
+        if len(args) != 1:
+            raise ValueError("Usage: export <file|-> [--format jsonl|tar] [--language L] [--collection C] [--user U]")
+        return load_command("export_snippets_command"), [args[0], options.get("format", "jsonl"), options.get("language"),
+            options.get("collection"), options.get("user")]
+    elif cmd == "explain":
+        if len(args) == 0:
+            raise ValueError("Usage: explain <command>")
+        explained_func, explained_args = parse_command(shlex.join(args))
+        return load_command("explain_command"), [explained_func, explained_args]
+    elif cmd == "profile":
+        if len(args) == 0 or args in (["on"], ["off"]):
+            raise ValueError("Usage: profile <command> | profile <on|off>")
+        profiled_func, profiled_args = parse_command(shlex.join(args))
+        return load_command("profile_command"), [profiled_func, profiled_args]
+    elif cmd == "serve":
+        args, options = parse_options(args, ["host", "port", "workers"])
+        if len(args) != 0:
+            raise ValueError("Usage: serve [--host HOST] [--port PORT] [--workers N]")
+        return load_command("serve_command"), [options.get("host"), options.get("port"), options.get("workers")]
+    elif cmd == "dupes":
+        args, options = parse_options(args, ["limit"])
+        if len(args) != 0:
+            raise ValueError("Usage: dupes [--limit N]")
+        return load_command("dupes_command"), [options.get("limit", 20)]
+    elif cmd == "similar":
+        args, options = parse_options(args, ["threshold", "limit"])
+        if len(args) != 1:
+            raise ValueError("Usage: similar <snippet_id> [--threshold T] [--limit N]")
+        return load_command("similar_command"), [args[0], options.get("threshold"), options.get("limit", 20)]
+    elif cmd == "related":
+        rebuild = "--rebuild" in args
+        args, options = parse_options([arg for arg in args if arg != "--rebuild"], ["limit"])
+        if len(args) == 0 and not rebuild:
+            raise ValueError("Usage: related [--rebuild] <words...> [--limit N]")
+        return load_command("related_command"), [" ".join(args), options.get("limit", 20), rebuild]
+    elif cmd == "cluster":
+        args, options = parse_options(args, ["threshold", "limit"])
+        if len(args) != 0:
+            raise ValueError("Usage: cluster [--threshold T] [--limit N]")
+        return load_command("cluster_command"), [options.get("threshold"), options.get("limit", 20)]
+    elif cmd == "sync":
+        usage = ("Usage: sync export <file|-> [--since REV] | sync apply <file|-> [--theirs] [--force] | "
+            "sync status | sync new-id")
+        if args[:1] == ["export"]:
+            args, options = parse_options(args[1:], ["since"])
+            if len(args) != 1:
+                raise ValueError(usage)
+            return load_command("sync_export_command"), [args[0], options.get("since", 0)]
+        elif args[:1] == ["apply"] and len(args) >= 2 and set(args[2:]) <= {"--theirs", "--force"} \
+                and len(set(args[2:])) == len(args[2:]):
+            return load_command("sync_apply_command"), [args[1], "--theirs" in args[2:], "--force" in args[2:]]
+        elif args == ["status"]:
+            return load_command("sync_status_command"), []
+        elif args == ["new-id"]:
+            return load_command("sync_new_id_command"), []
+        raise ValueError(usage)
+    elif cmd == "stats":
+        rebuild = "--rebuild" in args
+        args, options = parse_options([arg for arg in args if arg != "--rebuild"], ["limit", "format"])
+        if len(args) != 0:
+            raise ValueError("Usage: stats [--rebuild] [--limit N] [--format F]")
+        return load_command("stats_command"), [rebuild, options.get("limit", 10), options.get("format")]
+    elif cmd == "compact":
+        if args not in ([], ["--vacuum"]):
+            raise ValueError("Usage: compact [--vacuum]")
+        return load_command("compact_command"), [args == ["--vacuum"]]
+    elif cmd == "cache":
+        if args == ["stats"]:
+            return load_command("cache_stats_command"), []
+        elif args == ["clear"]:
+            return load_command("cache_clear_command"), []
+        raise ValueError("Usage: cache <stats|clear>")
     elif cmd in ["list", "ls"]:
+        args, options = parse_options(args, ["limit", "after", "format"])
         if len(args) != 1:
-            raise ValueError("Usage: list <snippets|collections>")
+            raise ValueError("Usage: list <snippets|collections|tags>")
         if args[0] == "snippets":
-            return list_snippets_command, []
+            return load_command("list_snippets_command"), [options.get("limit"), options.get("after"),
+                options.get("format")]
         elif args[0] == "collections":
-            return list_collections_command, []
+            return load_command("list_collections_command"), [options.get("format")]
+        elif args[0] == "tags":
+            return load_command("list_tags_command"), [options.get("format")]
         else:
-            raise ValueError("Invalid argument for list command. Usage: list <snippets|collections>")
+            raise ValueError("Invalid argument for list command. Usage: list <snippets|collections|tags>")
     else:
         raise ValueError(f"Unknown command: {cmd}")
 
-def main():
+def main(argv=None):
     """
     The main function of the Code Marshall application.
-    It displays the welcome message, prompts the user for commands, and executes the corresponding actions.
+
+    With command-line arguments, runs that single command and exits. Otherwise it displays the
+    welcome message, prompts the user for commands, and executes the corresponding actions.
+
+    Args:
+        argv (list, optional): The command-line arguments (default: sys.argv[1:]).
+
+    Returns:
+        int: The exit status.
     """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_once(argv)
+
     print("""
 
    _____          _        __  __                _           _ _ 
@@ -78,20 +308,118 @@ def main():
     print("Welcome to Code Marshall!")
     print("Enter 'help' to see available commands.")
 
-    while True:
-        try:
-            command = input("Enter a command (or 'quit' to exit): ")
-            if command.lower() == "quit":
+    from database import create_tables, close_database
+    create_tables()
+
+    profiling = False
+    try:
+        while True:
+            try:
+                command = input("Enter a command (or 'quit' to exit): ")
+                if command.lower() == "quit":
+                    break
+                elif command.lower() == "help":
+                    print_help()
+                elif command.lower().split() in (["profile", "on"], ["profile", "off"]):
+                    profiling = command.lower().split()[1] == "on"
+                    print(f"Profiling {'enabled' if profiling else 'disabled'}.")
+                else:
+                    cmd_func, cmd_args = parse_command(command)
+                    if cmd_func:
+                        run_command(cmd_func, cmd_args, profiling)
+            except EOFError:
                 break
-            elif command.lower() == "help":
-                print_help()
-            else:
-                cmd_func, cmd_args = parse_command(command)
-                cmd_func(*cmd_args)
-        except ValueError as e:
-            print(f"Error: {str(e)}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {str(e)}")
+            except ValueError as e:
+                print(f"Error: {str(e)}")
+            except Exception as e:
+                print(f"An unexpected error occurred: {str(e)}")
+    finally:
+        close_database()
+    return 0
+
+def run_command(cmd_func, cmd_args, profiling=False):
+    """
+    Run a parsed command, reporting the statements it executes if profiling is on.
+
+    Args:
+        cmd_func (callable): The command function.
+        cmd_args (list): The arguments of the command.
+        profiling (bool): Whether to profile the command (default: False).
+
+    Returns:
+        int: The status the command returned: None or 0 on success, non-zero if it failed.
+    """
+    if profiling:
+        return load_command("profile_command")(cmd_func, cmd_args)
+    return cmd_func(*cmd_args)
+
+def run_once(argv):
+    """
+    Run a single command given as command-line arguments, e.g. ['view', '42'].
+
+    Only the modules the command needs are imported, and the database engine is created only
+    when the command first uses it. A leading '--profile' reports the statements the command
+    executes.
+
+    Args:
+        argv (list): The command and its arguments.
+
+    Returns:
+        int: 0 on success, 1 if the command failed, 2 if the command or its arguments are invalid.
+    """
+    if argv[0] == "--batch":
+        return run_batch(argv[1:])
+    profiling = argv[0] == "--profile"
+    if profiling:
+        argv = argv[1:]
+    if not argv:
+        print("Usage: main.py [--profile] <command> [arguments...]", file=sys.stderr)
+        return 2
+    if argv[0].lower() in ["help", "-h", "--help"]:
+        print_help()
+        return 0
+    try:
+        cmd_func, cmd_args = parse_command(shlex.join(argv))
+    except ValueError as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 2
+    from database import create_tables, close_database
+    status = 0
+    try:
+        create_tables()
+        status = run_command(cmd_func, cmd_args, profiling)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader of our output went away (e.g. piped into head); stop quietly.
+        sys.stdout = open(os.devnull, "w")
+    finally:
+        close_database()
+    return 1 if status else 0
+
+def run_batch(args):
+    """
+    Run a script of commands given as '--batch <file|-> [--commit-every N]' arguments.
+
+    Args:
+        args (list): The arguments after '--batch'.
+
+    Returns:
+        int: 0 if every line succeeded, 1 if any failed, 2 if the arguments are invalid.
+    """
+    try:
+        args, options = parse_options(args, ["commit-every"])
+        if len(args) != 1:
+            raise ValueError("Usage: main.py --batch <file|-> [--commit-every N]")
+    except ValueError as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 2
+    from database import create_tables, close_database
+    try:
+        create_tables()
+        failed = load_command("batch_command")(args[0], options.get("commit-every"), parse_command)
+    finally:
+        close_database()
+    return 1 if failed else 0
 
 def print_help():
     """
@@ -99,14 +427,49 @@ def print_help():
     """
     print("Available commands:")
     print("  user <username>                 Create a new user")
-    print("  add <title> <language> <code>   Add a new code snippet")
+    print("  add <title> <language> <code> --user U --collection C [--description D]  Add a new code snippet")
     print("  view <snippet_id>               View a snippet")
-    print("  update <snippet_id> <field> <new_value>  Update a snippet")
+    print("  view <snippet_id>@<version>     View a saved version of a snippet")
+    print("  history <snippet_id>            List the saved versions of a snippet")
+    print("  revert <snippet_id> <version>   Restore a snippet to a saved version")
+    print("  update <snippet_id> <title|description|language|code> <new_value>  Update a snippet")
     print("  delete <snippet_id>             Delete a snippet")
-    print("  search <field> <value>          Search snippets")
-    print("  list snippets                   List all snippets")
+    print("  update where <field> <value>... set <field> <value>... [--dry-run]  Update every matching snippet")
+    print("  delete where <field> <value>... [--dry-run]  Delete every matching snippet")
+    print("  search <field> <value>          Search snippets by language, collection or user")
+    print("  search tag:a tag:b -tag:c       Search snippets by tags, with or without other filters")
+    print("  tag <snippet_id> <tag>...       Add tags to a snippet")
+    print("  untag <snippet_id> <tag>...     Remove tags from a snippet")
+    print("  find <terms...> [--limit N]     Full-text search of titles, descriptions and code")
+    print("  grep <regex> [--ignore-case] [--limit N]  Regular expression search of snippet code")
+    print("  import <dir|file.jsonl> [--user U] [--collection C] [--rejects FILE]  Bulk import snippets")
+    print("  export <file|-> [--format jsonl|tar] [--language L] [--collection C] [--user U]  Export snippets")
+    print("  list snippets [--limit N] [--after ID]  List snippets, one page at a time")
     print("  list collections                List all collections")
+    print("  list tags                       List all tags with their number of snippets")
+    print("  dupes [--limit N]               List snippets that share identical code")
+    print("  similar <snippet_id> [--threshold T] [--limit N]  List snippets with nearly the same code")
+    print("  cluster [--threshold T] [--limit N]  Report clusters of near-duplicate snippets")
+    print("  related [--rebuild] <words...> [--limit N]  Rank snippets by TF-IDF similarity of their words to the query")
+    print("  sync export <file|-> [--since REV]  Write the snippets changed after a revision to a change set")
+    print("  sync apply <file|-> [--theirs] [--force]  Apply a change set from another store, reporting conflicts")
+    print("  sync status | sync new-id       Show this store's revision and peers, or give a copy its own identity")
+    print("  stats [--rebuild] [--limit N]   Show snippet counts and code size per language, collection and user")
+    print("  compact [--vacuum]              Compress large code bodies and report storage use")
+    print("  cache stats                     Show snippet cache size and hit rate")
+    print("  cache clear                     Empty the snippet cache")
+    print("  explain <command>               Run a command and print the query plan of each query")
+    print("  serve [--host H] [--port P] [--workers N]  Serve the store as a local HTTP/JSON API")
+    print("  profile <command>               Run a command and report its statements, DB time and rows")
+    print("  profile on|off                  Profile every following command")
     print("  quit                            Exit the application")
+    print()
+    print("Run 'main.py <command> [arguments...]' to run a single command, or")
+    print("'main.py --batch <file|-> [--commit-every N]' to run a script of user, add, update and")
+    print("delete commands in one transaction.")
+    print()
+    print("list, search, find, grep, history and stats take --format table|json|jsonl|csv to write their rows")
+    print("for other tools; messages then go to standard error.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,9 +1,12 @@
 # lib/models.py
 # lib/models.py
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+import hashlib
+import uuid
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Index, LargeBinary, Boolean, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, synonym
 from sqlalchemy.sql import func
+from compression import compress_code, decompress_code
 
 Base = declarative_base()
 
@@ -19,9 +22,9 @@ class User(Base):
     """
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    username = Column(String, unique=True, nullable=False)
+    _username = Column('username', String, unique=True, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
-    snippets = relationship('Snippet', back_populates='user')
+    snippets = relationship('Snippet', back_populates='_user')
 
     def __init__(self, username):
         """
@@ -57,6 +60,8 @@ class User(Base):
             raise ValueError("Username cannot be empty.")
         self._username = value
 
+    username = synonym('_username', descriptor=username)
+
 class Collection(Base):
     """
     Represents a collection of code snippets.
@@ -68,8 +73,8 @@ class Collection(Base):
     """
     __tablename__ = 'collections'
     id = Column(Integer, primary_key=True)
-    name = Column(String, unique=True, nullable=False)
-    snippets = relationship('Snippet', back_populates='collection')
+    _name = Column('name', String, unique=True, nullable=False)
+    snippets = relationship('Snippet', back_populates='_collection')
 
     def __init__(self, name):
         """
@@ -105,6 +110,322 @@ class Collection(Base):
             raise ValueError("Collection name cannot be empty.")
         self._name = value
 
+    name = synonym('_name', descriptor=name)
+
+def hash_code(code):
+    """
+    Computes the content address of a code body.
+
+    Args:
+        code (str): The code.
+
+    Returns:
+        str: The SHA-256 hex digest of the UTF-8 encoded code.
+    """
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+def new_uid():
+    """
+    Generates the store-independent identifier of a new snippet.
+
+    Returns:
+        str: 32 random hex digits.
+    """
+    return uuid.uuid4().hex
+
+class CodeBlob(Base):
+    """
+    Represents a code body, stored once no matter how many snippets share it.
+
+    Bodies larger than CODE_COMPRESSION_THRESHOLD are stored compressed and only decompressed
+    when the body is read.
+
+    Attributes:
+        hash (str): The SHA-256 hex digest of the code, which identifies the blob.
+        data (str or bytes): The stored body: the code itself, or its compressed bytes.
+        codec (str): The codec the body is compressed with, or None if it is stored as text.
+        size (int): The length of the code in bytes, UTF-8 encoded.
+        body (str): The code.
+    """
+    __tablename__ = 'code_blobs'
+    # Clustered on the hash, so looking a blob up does not go through a separate index.
+    __table_args__ = {'sqlite_with_rowid': False}
+    hash = Column(String, primary_key=True)
+    data = Column('body', String, nullable=False)
+    codec = Column(String)
+    size = Column(Integer, nullable=False)
+
+    def __init__(self, body):
+        """
+        Initializes a new CodeBlob instance.
+
+        Args:
+            body (str): The code.
+        """
+        self.hash = hash_code(body)
+        self.data, self.codec = compress_code(body)
+        self.size = len(body.encode('utf-8'))
+
+    @property
+    def body(self):
+        """
+        Gets the code, decompressing it on first access.
+
+        Returns:
+            str: The code.
+        """
+        if self.codec is None:
+            return self.data
+        if getattr(self, '_body', None) is None:
+            self._body = decompress_code(self.data, self.codec)
+        return self._body
+
+class SnippetStat(Base):
+    """
+    Represents the number of snippets that share one language, collection or user, and the
+    size of their code.
+
+    The rows are kept up to date by triggers on the snippets table (see stats.py).
+
+    Attributes:
+        dimension (str): What the snippets are grouped by: 'language', 'collection' or 'user'.
+        value (str): The language, or the ID of the collection or user. Empty for snippets
+            without a collection or user.
+        snippets (int): The number of snippets.
+        code_bytes (int): The size of their code in bytes, before sharing or compression.
+    """
+    __tablename__ = 'snippet_stats'
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    snippets = Column(Integer, nullable=False)
+    code_bytes = Column(BigInteger, nullable=False)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class CodeSignature(Base):
+    """
+    Represents the MinHash signature of a code body, used to find near-duplicate code.
+
+    Attributes:
+        id (int): The unique identifier of the signature, referenced by its LSH buckets.
+        code_hash (str): The hash of the code blob the signature was computed from.
+        signature (bytes): The packed MinHash values (see similarity.pack_signature).
+    """
+    __tablename__ = 'code_signatures'
+    id = Column(Integer, primary_key=True)
+    code_hash = Column(String, ForeignKey('code_blobs.hash'), unique=True, nullable=False)
+    signature = Column(LargeBinary, nullable=False)
+
+class SignatureBucket(Base):
+    """
+    Represents one locality-sensitive hashing bucket a signature falls into.
+
+    Every signature is split into bands, and each band is hashed into a bucket. Signatures
+    that share a bucket are candidate near-duplicates.
+
+    Attributes:
+        bucket (int): The hash of one band of the signature, including the band's number.
+        signature_id (int): The ID of the signature.
+    """
+    __tablename__ = 'signature_buckets'
+    bucket = Column(BigInteger, primary_key=True)
+    signature_id = Column(Integer, ForeignKey('code_signatures.id'), primary_key=True)
+    __table_args__ = (
+        Index('ix_signature_buckets_signature_id', 'signature_id'),
+        {'sqlite_with_rowid': False},
+    )
+
+class Change(Base):
+    """
+    Represents one entry of the change log: the state of a snippet after it was created,
+    updated or deleted.
+
+    Entries are written by triggers on the snippets table (see sync.py). Revisions only ever
+    grow, so the changes made after a revision can be read from the log in order.
+
+    Attributes:
+        revision (int): The revision of the change.
+        uid (str): The store-independent identifier of the snippet.
+        deleted (bool): Whether the snippet was deleted.
+        title (str): The title of the snippet after the change.
+        description (str): The description of the snippet after the change.
+        language (str): The programming language of the snippet after the change.
+        code_hash (str): The hash of the snippet's code after the change. The code blob itself
+            may since have been pruned.
+        collection_id (int): The ID of the snippet's collection after the change.
+        user_id (int): The ID of the snippet's owner after the change.
+    """
+    __tablename__ = 'change_log'
+    revision = Column(Integer, primary_key=True)
+    uid = Column(String, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    title = Column(String)
+    description = Column(String)
+    language = Column(String)
+    code_hash = Column(String)
+    collection_id = Column(Integer)
+    user_id = Column(Integer)
+    __table_args__ = (
+        Index('ix_change_log_uid_revision', 'uid', 'revision'),
+        {'sqlite_autoincrement': True},
+    )
+
+class SyncPeer(Base):
+    """
+    Represents another store whose changes have been applied to this one.
+
+    Attributes:
+        store_id (str): The identifier of the other store.
+        revision (int): The revision of the other store up to which its changes have been applied.
+        applied_at (datetime): When its changes were last applied.
+    """
+    __tablename__ = 'sync_peers'
+    store_id = Column(String, primary_key=True)
+    revision = Column(Integer, nullable=False)
+    applied_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class StoreInfo(Base):
+    """
+    Represents a named property of this store, such as the identifier it syncs under.
+
+    Attributes:
+        name (str): The name of the property.
+        value (str): Its value.
+    """
+    __tablename__ = 'store_info'
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+class Tag(Base):
+    """
+    Represents a tag that snippets can be labelled with.
+
+    Attributes:
+        id (int): The unique identifier of the tag.
+        name (str): The name of the tag.
+        revision (int): Counts the changes to the set of snippets with the tag. It is raised by
+            triggers on the snippet_tags table (see tags.py), so a stored bitmap of the tag's
+            snippets can tell whether it is up to date.
+    """
+    __tablename__ = 'tags'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    revision = Column(Integer, nullable=False, default=0)
+
+class SnippetTag(Base):
+    """
+    Represents one tag of a snippet.
+
+    Attributes:
+        snippet_id (int): The ID of the snippet.
+        tag_id (int): The ID of the tag.
+    """
+    __tablename__ = 'snippet_tags'
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), primary_key=True)
+    tag_id = Column(Integer, ForeignKey('tags.id'), primary_key=True)
+    __table_args__ = (
+        Index('ix_snippet_tags_tag_id', 'tag_id', 'snippet_id'),
+        {'sqlite_with_rowid': False},
+    )
+
+class TagBitmap(Base):
+    """
+    Represents the set of snippets with one tag, as a bitmap of their IDs.
+
+    Attributes:
+        tag_id (int): The ID of the tag.
+        revision (int): The revision of the tag the bitmap was built at.
+        base (int): The snippet ID that the first bit stands for.
+        bitmap (bytes): One bit per snippet ID from base on, least significant bit first.
+    """
+    __tablename__ = 'tag_bitmaps'
+    tag_id = Column(Integer, ForeignKey('tags.id'), primary_key=True)
+    revision = Column(Integer, nullable=False)
+    base = Column(Integer, nullable=False)
+    bitmap = Column(LargeBinary, nullable=False)
+
+class SnippetVersion(Base):
+    """
+    Represents one saved version of a snippet.
+
+    A version's code is stored either in full (a checkpoint) or as a line delta against the
+    version before it (see history.py). A full copy is stored every HISTORY_CHECKPOINT_INTERVAL
+    versions, so any version is rebuilt from its checkpoint and a bounded number of deltas.
+
+    Attributes:
+        snippet_id (int): The ID of the snippet.
+        version (int): The number of the version, counting from 1.
+        checkpoint (int): The version whose full copy this version is rebuilt from; the
+            version itself if it is a checkpoint.
+        title (str): The title of the snippet in this version.
+        description (str): The description of the snippet in this version.
+        language (str): The programming language of the snippet in this version.
+        code_hash (str): The hash of the code in this version, to check the rebuilt code against.
+        data (str or bytes): The full code or the delta, compressed like code blobs when large.
+        codec (str): The codec the data is compressed with, or None if it is stored as text.
+        added (int): The number of lines added since the previous version.
+        removed (int): The number of lines removed since the previous version.
+        saved_at (datetime): When the version was saved.
+    """
+    __tablename__ = 'snippet_versions'
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), primary_key=True)
+    version = Column(Integer, primary_key=True)
+    checkpoint = Column(Integer, nullable=False)
+    title = Column(String, nullable=False)
+    description = Column(String)
+    language = Column(String, nullable=False)
+    code_hash = Column(String, nullable=False)
+    data = Column(String, nullable=False)
+    codec = Column(String)
+    added = Column(Integer, nullable=False)
+    removed = Column(Integer, nullable=False)
+    saved_at = Column(DateTime, server_default=func.now())
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class RelatedTerm(Base):
+    """
+    Represents a word of the vocabulary the related search weighs snippets by.
+
+    Attributes:
+        id (int): The unique identifier of the term.
+        term (str): The word, lowercased and stemmed (see related.terms).
+        snippets (int): The number of snippets whose vector holds the term, from which the
+            term's inverse document frequency is computed.
+    """
+    __tablename__ = 'related_terms'
+    id = Column(Integer, primary_key=True)
+    term = Column(String, unique=True, nullable=False)
+    snippets = Column(Integer, nullable=False, default=0)
+
+class RelatedPosting(Base):
+    """
+    Represents the weight of one term in the TF-IDF vector of a snippet.
+
+    Attributes:
+        snippet_id (int): The ID of the snippet.
+        term_id (int): The ID of the term.
+        weight (float): The log-scaled frequency of the term in the snippet, divided by the
+            length of the snippet's vector, so that every vector has length 1.
+    """
+    __tablename__ = 'related_postings'
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), primary_key=True)
+    term_id = Column(Integer, ForeignKey('related_terms.id'), primary_key=True)
+    weight = Column(Float, nullable=False)
+    __table_args__ = (
+        Index('ix_related_postings_term_id', 'term_id', 'snippet_id', 'weight'),
+        {'sqlite_with_rowid': False},
+    )
+
+class RelatedPending(Base):
+    """
+    Represents a snippet whose TF-IDF vector has to be computed, because the snippet was added
+    or its title, description or code changed. Rows are added by triggers (see related.py).
+
+    Attributes:
+        snippet_id (int): The ID of the snippet.
+    """
+    __tablename__ = 'related_pending'
+    snippet_id = Column(Integer, primary_key=True)
+
 class Snippet(Base):
     """
     Represents a code snippet.
@@ -114,22 +435,43 @@ class Snippet(Base):
         title (str): The title of the snippet.
         description (str): The description of the snippet.
         language (str): The programming language of the snippet.
-        code (str): The code content of the snippet.
+        code (str): The code content of the snippet, stored in its code blob.
+        code_hash (str): The hash of the code blob holding the snippet's code.
         collection_id (int): The ID of the collection to which the snippet belongs.
         user_id (int): The ID of the user who owns the snippet.
+        uid (str): The identifier of the snippet in every store it is synced to (see sync.py).
         collection (Collection): The collection to which the snippet belongs.
         user (User): The user who owns the snippet.
+        blob (CodeBlob): The code blob holding the snippet's code. Snippets with identical
+            code share one blob.
     """
     __tablename__ = 'snippets'
     id = Column(Integer, primary_key=True)
-    title = Column(String, nullable=False)
+    _title = Column('title', String, nullable=False)
     description = Column(String)
-    language = Column(String, nullable=False)
-    code = Column(String, nullable=False)
+    _language = Column('language', String, nullable=False)
+    code_hash = Column(String, ForeignKey('code_blobs.hash'), nullable=False)
     collection_id = Column(Integer, ForeignKey('collections.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
-    collection = relationship('Collection', back_populates='snippets')
-    user = relationship('User', back_populates='snippets')
+    uid = Column(String, nullable=False, default=new_uid)
+    _collection = relationship('Collection', back_populates='snippets')
+    _user = relationship('User', back_populates='snippets')
+    # Loaded only when the code is read or replaced, so loading snippets to list, tag, update
+    # or delete them does not fetch their bodies.
+    blob = relationship('CodeBlob', lazy='select')
+
+    # Entries of an SQLite index are ordered by their columns and then by rowid, so the
+    # single-column indexes let a filtered listing page through matches in ID order without
+    # sorting, and the composite ones serve searches that combine two filters.
+    __table_args__ = (
+        Index('ix_snippets_language', 'language'),
+        Index('ix_snippets_collection_id', 'collection_id'),
+        Index('ix_snippets_user_id', 'user_id'),
+        Index('ix_snippets_language_user_id', 'language', 'user_id'),
+        Index('ix_snippets_collection_id_language', 'collection_id', 'language'),
+        Index('ix_snippets_code_hash', 'code_hash'),
+        Index('ix_snippets_uid', 'uid', unique=True),
+    )
 
     def __init__(self, title, description, language, code, collection, user):
         """
@@ -175,6 +517,8 @@ class Snippet(Base):
             raise ValueError("Title cannot be empty.")
         self._title = value
 
+    title = synonym('_title', descriptor=title)
+
     @property
     def language(self):
         """
@@ -200,6 +544,8 @@ class Snippet(Base):
             raise ValueError("Language cannot be empty.")
         self._language = value
 
+    language = synonym('_language', descriptor=language)
+
     @property
     def code(self):
         """
@@ -208,13 +554,16 @@ class Snippet(Base):
         Returns:
             str: The code content of the snippet.
         """
-        return self._code
+        return self.blob.body if self.blob else None
 
     @code.setter
     def code(self, value):
         """
         Set the code content of the snippet.
 
+        The snippet gets a new code blob; when the session is flushed it is swapped for the
+        stored blob with the same hash, if there is one.
+
         Args:
             value (str): The new code value.
 
@@ -223,7 +572,8 @@ class Snippet(Base):
         """
         if not value:
             raise ValueError("Code cannot be empty.")
-        self._code = value
+        if self.blob is None or self.blob.hash != hash_code(value):
+            self.blob = CodeBlob(value)
 
     @property
     def collection(self):
@@ -250,6 +600,8 @@ class Snippet(Base):
             raise ValueError("Invalid collection. Expected an instance of Collection.")
         self._collection = value
 
+    collection = synonym('_collection', descriptor=collection)
+
     @property
     def user(self):
         """
@@ -273,4 +625,6 @@ class Snippet(Base):
         """
         if not isinstance(value, User):
             raise ValueError("Invalid user. Expected an instance of User.")
-        self._user = value
\ No newline at end of file
+        self._user = value
+
+    user = synonym('_user', descriptor=user)
@@ -0,0 +1,148 @@
+# lib/queries.py
+from sqlalchemy import select
+from models import User, Collection, Snippet, CodeBlob
+
+def snippet_summary_query(session, language=None, collection_name=None, username=None):
+    """
+    Builds a query for the snippet columns shown in listings, optionally filtered.
+
+    Only the id, title and language are selected, so the code column is never loaded.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        language (str, optional): Only include snippets in this programming language.
+        collection_name (str, optional): Only include snippets in the collection with this name.
+        username (str, optional): Only include snippets owned by the user with this username.
+
+    Returns:
+        sqlalchemy.orm.Query: The query, yielding (id, title, language) rows.
+    """
+    query = session.query(Snippet.id, Snippet.title, Snippet.language)
+    return filter_snippets(query, language, collection_name, username)
+
+def snippet_export_query(session, language=None, collection_name=None, username=None):
+    """
+    Builds a query for every snippet field, with its collection name and owner's username.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        language (str, optional): Only include snippets in this programming language.
+        collection_name (str, optional): Only include snippets in the collection with this name.
+        username (str, optional): Only include snippets owned by the user with this username.
+
+    Returns:
+        sqlalchemy.orm.Query: The query, yielding (id, title, description, language, stored code,
+        codec, collection name, username) rows. The stored code is compressed when the codec is
+        not None; see compression.decompress_code.
+    """
+    query = session.query(Snippet.id, Snippet.title, Snippet.description, Snippet.language, CodeBlob.data,
+            CodeBlob.codec, Collection.name, User.username) \
+        .join(CodeBlob, Snippet.code_hash == CodeBlob.hash) \
+        .outerjoin(Collection, Snippet.collection_id == Collection.id) \
+        .outerjoin(User, Snippet.user_id == User.id)
+    if language:
+        query = query.filter(Snippet.language == language)
+    if collection_name:
+        query = query.filter(Collection.name == collection_name)
+    if username:
+        query = query.filter(User.username == username)
+    return query
+
+def snippet_details(session, snippet_id):
+    """
+    Fetches everything the view command shows about a snippet in a single query.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+
+    Returns:
+        Row: (title, description, language, stored code, codec, collection name, username),
+        or None if there is no snippet with this ID.
+    """
+    return session.query(Snippet.title, Snippet.description, Snippet.language, CodeBlob.data, CodeBlob.codec,
+            Collection.name, User.username) \
+        .join(CodeBlob, Snippet.code_hash == CodeBlob.hash) \
+        .outerjoin(Collection, Snippet.collection_id == Collection.id) \
+        .outerjoin(User, Snippet.user_id == User.id) \
+        .filter(Snippet.id == snippet_id).first()
+
+def filter_snippets(query, language=None, collection_name=None, username=None):
+    """
+    Applies the search filters shared by the snippet commands to a query over snippets.
+
+    Args:
+        query (sqlalchemy.orm.Query): A query selecting from the snippets table.
+        language (str, optional): Only include snippets in this programming language.
+        collection_name (str, optional): Only include snippets in the collection with this name.
+        username (str, optional): Only include snippets owned by the user with this username.
+
+    Returns:
+        sqlalchemy.orm.Query: The filtered query.
+    """
+    if language:
+        query = query.filter(Snippet.language == language)
+    if collection_name:
+        query = query.join(Collection, Snippet.collection_id == Collection.id).filter(Collection.name == collection_name)
+    if username:
+        query = query.join(User, Snippet.user_id == User.id).filter(User.username == username)
+    return query
+
+def snippet_conditions(language=None, collection_name=None, username=None):
+    """
+    Builds the search filters shared by the snippet commands as conditions on the snippets table.
+
+    Unlike filter_snippets, no joins are added: collections and users are matched with scalar
+    subqueries, so the conditions can be used in UPDATE and DELETE statements.
+
+    Args:
+        language (str, optional): Only match snippets in this programming language.
+        collection_name (str, optional): Only match snippets in the collection with this name.
+        username (str, optional): Only match snippets owned by the user with this username.
+
+    Returns:
+        list: The conditions, to be combined with AND.
+    """
+    conditions = []
+    if language:
+        conditions.append(Snippet.language == language)
+    if collection_name:
+        conditions.append(Snippet.collection_id ==
+            select(Collection.id).where(Collection.name == collection_name).scalar_subquery())
+    if username:
+        conditions.append(Snippet.user_id == select(User.id).where(User.username == username).scalar_subquery())
+    return conditions
+
+def iter_keyset(query, key_column, after=None, limit=None, batch_size=500):
+    """
+    Iterates over the rows of a query in key order, one batch at a time.
+
+    Each batch is fetched with 'WHERE key > last_key ORDER BY key LIMIT batch_size', so the
+    cost of a page does not depend on how deep into the table it starts and no more than
+    one batch is held in memory.
+
+    Args:
+        query (sqlalchemy.orm.Query): The query to iterate over. Its first column must be the key.
+        key_column: The column to paginate on; it must be unique and indexed.
+        after (int, optional): Only yield rows whose key is greater than this value.
+        limit (int, optional): The maximum number of rows to yield.
+        batch_size (int): The number of rows fetched per round trip (default: 500).
+
+    Yields:
+        Row: The rows of the query, in ascending key order.
+    """
+    remaining = limit
+    last_key = after
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        page = query
+        if last_key is not None:
+            page = page.filter(key_column > last_key)
+        rows = page.order_by(key_column).limit(size).all()
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        last_key = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
@@ -0,0 +1,301 @@
+# lib/related.py
+import math
+import re
+from collections import Counter
+from sqlalchemy import bindparam, delete, event, func, insert, select, text, update
+from sqlalchemy.dialects.sqlite import insert as upsert
+from config import RELATED_MAX_TERMS, RELATED_BATCH_SIZE
+from models import CodeBlob, RelatedPending, RelatedPosting, RelatedTerm, Snippet, SnippetStat
+from compression import decompress_code
+from similarity import KEYWORDS
+
+RELATED_TRIGGERS = ['snippets_related_ai', 'snippets_related_au', 'snippets_related_ad']
+
+# New snippets and snippets whose title, description or code changed are queued for a new
+# vector, whichever statement wrote them; a deleted snippet's vector goes with it, and the
+# document frequencies of its terms drop. Vectors are computed in Python (see index_pending).
+RELATED_SCHEMA = [
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_related_ai AFTER INSERT ON snippets BEGIN
+        INSERT OR IGNORE INTO related_pending (snippet_id) VALUES (new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_related_au AFTER UPDATE OF title, description, code_hash ON snippets
+    WHEN old.title IS NOT new.title OR old.description IS NOT new.description OR old.code_hash IS NOT new.code_hash
+    BEGIN
+        INSERT OR IGNORE INTO related_pending (snippet_id) VALUES (new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_related_ad AFTER DELETE ON snippets BEGIN
+        UPDATE related_terms SET snippets = snippets - 1
+        WHERE id IN (SELECT term_id FROM related_postings WHERE snippet_id = old.id);
+        DELETE FROM related_postings WHERE snippet_id = old.id;
+        DELETE FROM related_pending WHERE snippet_id = old.id;
+    END
+    """,
+]
+
+# Words of a camelCase, PascalCase or snake_case identifier, or of prose. Digits and
+# punctuation separate words but are not words, so getHTTPResponse2 is get, http, response.
+WORD_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+')
+
+STOP_WORDS = frozenset("""
+    a about an and are as at be been but by can do does for from has have how i if in into is it
+    its me my no not of on or so than that the their then there these this to was we what when
+    where which while who why will with without you your
+""".split())
+
+# How many times a word counts in each field: a word of the title says more about what a
+# snippet is for than one of its identifiers.
+FIELD_WEIGHTS = {'title': 3, 'description': 2, 'code': 1}
+
+def stem(word):
+    """
+    Strips the common English suffixes of a lowercase word, so that the forms of a word share
+    one term: debounce, debounced, debounces and debouncing all become debounc.
+
+    Args:
+        word (str): The word.
+
+    Returns:
+        str: The stem.
+    """
+    if len(word) > 5 and word.endswith('ing'):
+        word = word[:-3]
+    elif len(word) > 4 and word.endswith('ed'):
+        word = word[:-2]
+    elif len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    if len(word) > 3 and word.endswith('e'):
+        word = word[:-1]
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'aeiouls':
+        # running -> runn -> run
+        word = word[:-1]
+    return word
+
+def terms(text, code=False):
+    """
+    Splits text into the terms the related search weighs.
+
+    Identifiers are split into their words, words are lowercased and stemmed, and common
+    English words are dropped, along with language keywords when the text is code.
+
+    Args:
+        text (str): The text.
+        code (bool): Whether the text is code (default: False).
+
+    Returns:
+        list: The terms, in order, with repeats.
+    """
+    stop = STOP_WORDS | KEYWORDS if code else STOP_WORDS
+    result = []
+    for word in WORD_PATTERN.findall(text or ''):
+        word = word.lower()
+        if len(word) > 1 and word not in stop:
+            result.append(stem(word))
+    return result
+
+def snippet_vector(title, description, code, max_terms=RELATED_MAX_TERMS):
+    """
+    Computes the TF-IDF document vector of a snippet.
+
+    Documents are weighed without IDF (the 'lnc' of SMART's lnc.ltc scheme): a term's weight is
+    1 + log of its field-weighted count, and the vector is scaled to length 1. A vector thus
+    depends on the snippet alone and never has to be recomputed when other snippets change;
+    IDF is applied to the query instead (see related_snippets).
+
+    Args:
+        title (str): The title.
+        description (str): The description, or None.
+        code (str): The code.
+        max_terms (int): Only the heaviest this many terms are kept (default: RELATED_MAX_TERMS).
+
+    Returns:
+        dict: The weight of every term.
+    """
+    counts = Counter()
+    for field, value in (('title', title), ('description', description), ('code', code)):
+        for term in terms(value, code=field == 'code'):
+            counts[term] += FIELD_WEIGHTS[field]
+    weights = sorted(((1 + math.log(count), term) for term, count in counts.items()), reverse=True)[:max_terms]
+    length = math.sqrt(sum(weight * weight for weight, _ in weights))
+    return {term: weight / length for weight, term in weights}
+
+def create_related_index(connection):
+    """
+    Creates the triggers that keep the related search's vectors up to date.
+
+    If the triggers are created on a database that already holds snippets, every snippet is
+    queued, and the vectors are computed by 'related --rebuild' (see index_pending).
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    existed = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"),
+        {"name": RELATED_TRIGGERS[0]}).first() is not None
+    for statement in RELATED_SCHEMA:
+        connection.execute(text(statement))
+    if not existed:
+        connection.execute(text("INSERT OR IGNORE INTO related_pending (snippet_id) SELECT id FROM snippets"))
+
+def register_related_events(session_factory):
+    """
+    Registers the flush hook that computes the vectors of the snippets a flush adds or changes.
+
+    Args:
+        session_factory (sqlalchemy.orm.sessionmaker): The factory whose sessions get the hook.
+    """
+    event.listen(session_factory, 'after_flush', index_flushed_snippets)
+
+def index_flushed_snippets(session, flush_context):
+    """
+    Computes the vectors of the snippets written by a flush whose text changed, so that a new or
+    edited snippet is found by 'related' right away.
+    """
+    snippet_ids = [snippet.id for snippet in list(session.new) + list(session.dirty)
+        if isinstance(snippet, Snippet) and snippet.id is not None]
+    if snippet_ids:
+        index_pending(session.connection(), snippet_ids)
+
+def index_pending(connection, snippet_ids=None, batch_size=RELATED_BATCH_SIZE, limit=None):
+    """
+    Computes the vectors of queued snippets and updates the document frequencies of their terms.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+        snippet_ids (list, optional): Only compute the vectors of these snippets, if queued
+            (default: every queued snippet).
+        batch_size (int): The number of snippets read at a time (default: RELATED_BATCH_SIZE).
+        limit (int, optional): When snippet_ids is not given, the maximum number of queued
+            snippets to index (default: all of them).
+
+    Returns:
+        int: The number of snippets whose vector was computed.
+    """
+    pending = RelatedPending.__table__
+    indexed = 0
+    if snippet_ids is None:
+        while limit is None or indexed < limit:
+            size = batch_size if limit is None else min(batch_size, limit - indexed)
+            batch = connection.execute(select(pending.c.snippet_id)
+                .order_by(pending.c.snippet_id).limit(size)).scalars().all()
+            if not batch:
+                return indexed
+            indexed += _index_batch(connection, batch)
+        return indexed
+    snippet_ids = list(snippet_ids)
+    for start in range(0, len(snippet_ids), batch_size):
+        batch = connection.execute(select(pending.c.snippet_id)
+            .where(pending.c.snippet_id.in_(snippet_ids[start:start + batch_size]))).scalars().all()
+        if batch:
+            indexed += _index_batch(connection, batch)
+    return indexed
+
+def _index_batch(connection, snippet_ids):
+    snippets, blobs, postings, terms_ = (Snippet.__table__, CodeBlob.__table__, RelatedPosting.__table__,
+        RelatedTerm.__table__)
+    vectors = {snippet_id: snippet_vector(title, description, decompress_code(body, codec))
+        for snippet_id, title, description, body, codec in connection.execute(
+            select(snippets.c.id, snippets.c.title, snippets.c.description, blobs.c.body, blobs.c.codec)
+            .join(blobs, blobs.c.hash == snippets.c.code_hash).where(snippets.c.id.in_(snippet_ids)))}
+    # Document frequencies change by the terms gained less the terms lost.
+    changes = Counter()
+    for term_id in connection.execute(select(postings.c.term_id).where(postings.c.snippet_id.in_(snippet_ids))).scalars():
+        changes[term_id] -= 1
+    connection.execute(delete(postings).where(postings.c.snippet_id.in_(snippet_ids)))
+    term_ids = _term_ids(connection, {term for vector in vectors.values() for term in vector})
+    rows = [{'snippet_id': snippet_id, 'term_id': term_ids[term], 'weight': weight}
+        for snippet_id, vector in vectors.items() for term, weight in vector.items()]
+    if rows:
+        connection.execute(insert(postings), rows)
+    for row in rows:
+        changes[row['term_id']] += 1
+    changes = [{'term_id_': term_id, 'change': change} for term_id, change in changes.items() if change]
+    if changes:
+        connection.execute(update(terms_).where(terms_.c.id == bindparam('term_id_'))
+            .values(snippets=terms_.c.snippets + bindparam('change')), changes)
+    connection.execute(delete(RelatedPending.__table__).where(RelatedPending.snippet_id.in_(snippet_ids)))
+    return len(vectors)
+
+def _term_ids(connection, words):
+    table = RelatedTerm.__table__
+    words = list(words)
+    ids = {}
+    for attempt in range(2):
+        missing = [word for word in words if word not in ids]
+        for start in range(0, len(missing), 500):
+            ids.update((term, term_id) for term_id, term in connection.execute(
+                select(table.c.id, table.c.term).where(table.c.term.in_(missing[start:start + 500]))))
+        missing = [word for word in words if word not in ids]
+        if not missing or attempt:
+            return ids
+        connection.execute(upsert(table).on_conflict_do_nothing(), [{'term': word, 'snippets': 0} for word in missing])
+
+def pending_count(session):
+    """
+    Counts the snippets queued for a new vector, which related search does not find yet.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        int: The number of queued snippets.
+    """
+    return session.query(func.count(RelatedPending.snippet_id)).scalar()
+
+def related_snippets(session, query, limit=20):
+    """
+    Ranks snippets by the cosine similarity of their TF-IDF vectors to a query.
+
+    The query is weighed with IDF (the 'ltc' of lnc.ltc): a term's weight is 1 + log of its
+    count times log(1 + N / n), for N snippets of which n have the term, scaled to length 1.
+    The scores are computed in one aggregate query that walks the postings of the query's
+    terms only, so its cost depends on how many snippets share a term with the query rather
+    than on the size of the store. Nothing is written: queued snippets are left out until
+    index_pending computes their vectors (see pending_count).
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        query (str): The words to look for, in any form: prose, identifiers or both.
+        limit (int): The maximum number of snippets to return (default: 20).
+
+    Returns:
+        list: (similarity, id, title, language) tuples, most similar first.
+
+    Raises:
+        ValueError: If the query has no words that can be searched for.
+    """
+    counts = Counter(terms(query))
+    if not counts:
+        raise ValueError("The query has no words to search for.")
+    total = session.query(func.coalesce(func.sum(SnippetStat.snippets), 0)) \
+        .filter(SnippetStat.dimension == 'language').scalar()
+    weights = {term_id: (1 + math.log(counts[term])) * math.log(1 + total / snippets)
+        for term_id, term, snippets in session.query(RelatedTerm.id, RelatedTerm.term, RelatedTerm.snippets)
+        .filter(RelatedTerm.term.in_(list(counts)), RelatedTerm.snippets > 0)}
+    if not weights:
+        return []
+    length = math.sqrt(sum(weight * weight for weight in weights.values()))
+    parameters = {'limit': int(limit)}
+    values = []
+    for index, (term_id, weight) in enumerate(weights.items()):
+        parameters[f'term{index}'] = term_id
+        parameters[f'weight{index}'] = weight / length
+        values.append(f"(:term{index}, :weight{index})")
+    # CROSS JOIN makes SQLite read the query's few terms first and look their postings up in
+    # the covering (term_id, snippet_id, weight) index.
+    rows = session.execute(text(f"""
+        WITH query (term_id, weight) AS (VALUES {', '.join(values)})
+        SELECT top.score, s.id, s.title, s.language FROM (
+            SELECT p.snippet_id, sum(p.weight * query.weight) AS score
+            FROM query CROSS JOIN related_postings p ON p.term_id = query.term_id
+            GROUP BY p.snippet_id
+            ORDER BY score DESC, p.snippet_id
+            LIMIT :limit
+        ) AS top JOIN snippets s ON s.id = top.snippet_id
+        ORDER BY top.score DESC, s.id
+    """), parameters)
+    return [tuple(row) for row in rows]
@@ -0,0 +1,105 @@
+# lib/render.py
+import csv
+import itertools
+import json
+import os
+import sys
+from config import TABLE_SAMPLE_ROWS, TABLE_MAX_WIDTH
+
+OUTPUT_FORMATS = ["table", "json", "jsonl", "csv"]
+
+def check_format(output_format):
+    """
+    Checks that an output format is known.
+
+    Args:
+        output_format (str): The format name, or None for the commands' own text output.
+
+    Raises:
+        ValueError: If the format is not one of OUTPUT_FORMATS.
+    """
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'. Expected one of: {', '.join(OUTPUT_FORMATS)}.")
+
+def render_rows(rows, columns, output_format, out=None):
+    """
+    Writes rows to standard output in a machine-readable or tabular format as they arrive.
+
+    Nothing but the rows is written, so the output can be piped into tools like jq. Rows are
+    written one at a time to the buffered stream, so the memory used does not depend on how
+    many there are; only a table holds its first TABLE_SAMPLE_ROWS rows, to size its columns.
+    If the reader goes away (as with '| head'), writing stops quietly.
+
+    Args:
+        rows (iterable): Tuples of values, in the order of columns.
+        columns (list): The column names.
+        output_format (str): 'json' (one array), 'jsonl' (one object per line), 'csv' (with a
+            header row) or 'table' (aligned columns).
+        out (file, optional): The stream to write to (default: standard output).
+
+    Returns:
+        int: The number of rows written.
+
+    Raises:
+        ValueError: If the format is unknown.
+    """
+    check_format(output_format)
+    out = out or sys.stdout
+    write = {"json": _write_json, "jsonl": _write_jsonl, "csv": _write_csv, "table": _write_table}[output_format]
+    try:
+        count = write(rows, columns, out)
+        out.flush()
+        return count
+    except BrokenPipeError:
+        # Keep the interpreter from complaining again when it flushes standard output on exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, out.fileno())
+        return 0
+
+def _write_jsonl(rows, columns, out):
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row))) + "\n")
+        count += 1
+    return count
+
+def _write_json(rows, columns, out):
+    count = 0
+    out.write("[")
+    for row in rows:
+        out.write(("\n" if count == 0 else ",\n") + json.dumps(dict(zip(columns, row))))
+        count += 1
+    out.write("\n]\n" if count else "]\n")
+    return count
+
+def _write_csv(rows, columns, out):
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+def _write_table(rows, columns, out):
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, TABLE_SAMPLE_ROWS))
+    widths = [min(TABLE_MAX_WIDTH, max([len(column)] + [len(_cell(row[i])) for row in sample]))
+        for i, column in enumerate(columns)]
+
+    def line(values):
+        cells = [_cell(value) for value in values]
+        cells = [cell if len(cell) <= width else cell[:width - 1] + "…" for cell, width in zip(cells, widths)]
+        return "  ".join(cell.ljust(width) for cell, width in zip(cells, widths)).rstrip() + "\n"
+
+    out.write(line(columns))
+    out.write("  ".join("-" * width for width in widths) + "\n")
+    count = 0
+    for row in itertools.chain(sample, rows):
+        out.write(line(row))
+        count += 1
+    return count
+
+def _cell(value):
+    # Table cells are single lines.
+    return "" if value is None else " ".join(str(value).split())
@@ -0,0 +1,146 @@
+# lib/search.py
+from sqlalchemy import text
+
+FTS_TABLE = 'snippets_fts'
+FTS_CONTENT_VIEW = 'snippet_documents'
+FTS_TRIGGERS = ['snippets_fts_ai', 'snippets_fts_ad', 'snippets_fts_au']
+
+# The code of a snippet lives in its code blob, so the index reads its text through a view
+# that joins the two, and the triggers look the body up by hash. code_text() decompresses
+# bodies that are stored compressed (see compression.register_sql_functions).
+FTS_SCHEMA = [
+    f"""
+    CREATE VIEW IF NOT EXISTS {FTS_CONTENT_VIEW} AS
+    SELECT s.id AS id, s.title AS title, s.description AS description, code_text(b.body, b.codec) AS code
+    FROM snippets s JOIN code_blobs b ON b.hash = s.code_hash
+    """,
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, description, code,
+        content='{FTS_CONTENT_VIEW}', content_rowid='id',
+        tokenize='unicode61'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_fts_ai AFTER INSERT ON snippets BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description, code)
+        VALUES (new.id, new.title, new.description,
+                (SELECT code_text(body, codec) FROM code_blobs WHERE hash = new.code_hash));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_fts_ad AFTER DELETE ON snippets BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, code)
+        VALUES ('delete', old.id, old.title, old.description,
+                (SELECT code_text(body, codec) FROM code_blobs WHERE hash = old.code_hash));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippets_fts_au AFTER UPDATE OF title, description, code_hash ON snippets BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, code)
+        VALUES ('delete', old.id, old.title, old.description,
+                (SELECT code_text(body, codec) FROM code_blobs WHERE hash = old.code_hash));
+        INSERT INTO {FTS_TABLE}(rowid, title, description, code)
+        VALUES (new.id, new.title, new.description,
+                (SELECT code_text(body, codec) FROM code_blobs WHERE hash = new.code_hash));
+    END
+    """,
+]
+
+# bm25() column weights for title, description and code.
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+def create_search_index(connection):
+    """
+    Creates the full-text index and the triggers that keep it in sync with the snippets table.
+
+    The index uses the snippets and their code blobs as external content, so the text is not
+    stored twice. If the index is created on a database that already holds snippets, it is
+    rebuilt from them.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    existed = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": FTS_TABLE}).first() is not None
+    for statement in FTS_SCHEMA:
+        connection.execute(text(statement))
+    if not existed:
+        connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+def drop_search_index(connection):
+    """
+    Drops the full-text index, its content view and its triggers, so they can be recreated.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    drop_search_triggers(connection)
+    connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+
+def drop_search_triggers(connection):
+    """
+    Drops the content view and triggers of the full-text index but keeps the indexed data.
+
+    Used when the way the indexed text is read changes but the text itself does not.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    for trigger in FTS_TRIGGERS:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    connection.execute(text(f"DROP VIEW IF EXISTS {FTS_CONTENT_VIEW}"))
+
+def build_match_query(terms):
+    """
+    Builds an FTS5 MATCH expression from the given search terms.
+
+    Every term is quoted so that punctuation in code (dots, parentheses, operators) is
+    treated as text rather than query syntax. A trailing '*' keeps its prefix meaning.
+
+    Args:
+        terms (list): The search terms.
+
+    Returns:
+        str: The MATCH expression matching snippets that contain all of the terms.
+
+    Raises:
+        ValueError: If no usable search terms are given.
+    """
+    parts = []
+    for term in terms:
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if not term:
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        parts.append(quoted + "*" if prefix else quoted)
+    if not parts:
+        raise ValueError("Search terms cannot be empty.")
+    return " ".join(parts)
+
+def full_text_search(session, terms, limit=20):
+    """
+    Searches snippet titles, descriptions and code using the full-text index.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        terms (list): The search terms. All of them must match.
+        limit (int): The maximum number of results to return (default: 20).
+
+    Returns:
+        list: Rows of (id, title, language, excerpt), best matches first. The excerpt
+        marks the matched terms with square brackets.
+    """
+    weights = ", ".join(str(weight) for weight in RANK_WEIGHTS)
+    query = text(f"""
+        SELECT s.id, s.title, s.language,
+               snippet({FTS_TABLE}, -1, '[', ']', '...', 12) AS excerpt
+        FROM {FTS_TABLE}
+        JOIN snippets s ON s.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH :query
+        ORDER BY bm25({FTS_TABLE}, {weights})
+        LIMIT :limit
+    """)
+    return session.execute(query, {"query": build_match_query(terms), "limit": limit}).fetchall()
@@ -0,0 +1,434 @@
+# lib/server.py
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+from sqlalchemy.exc import IntegrityError
+from config import LIST_BATCH_SIZE, SERVER_MAX_BODY, SERVER_MAX_PAGE_SIZE, SERVER_PAGE_SIZE, SERVER_WORKERS
+from database import Session, write_with_retry
+from models import Collection, Snippet
+from compression import decompress_code
+from queries import snippet_details, snippet_summary_query, iter_keyset
+from search import full_text_search
+from store import SnippetNotFoundError, create_user, create_snippet, update_snippet, delete_snippet
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+SNIPPET_FIELDS = ["title", "description", "language", "code", "collection", "user"]
+UPDATABLE_FIELDS = ["title", "description", "language", "code"]
+
+class HTTPError(Exception):
+    """
+    An error that is sent to the client as a JSON response with the given status.
+
+    Attributes:
+        status (int): The HTTP status code.
+        message (str): The error message.
+    """
+
+    def __init__(self, status, message):
+        """
+        Initializes a new HTTPError.
+
+        Args:
+            status (int): The HTTP status code.
+            message (str): The error message.
+        """
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class Request:
+    """
+    A parsed HTTP request.
+
+    Attributes:
+        method (str): The request method, in upper case.
+        path (str): The decoded request path.
+        query (dict): The query string parameters, each with its last value.
+        headers (dict): The request headers, with lower-case names.
+        body (bytes): The request body.
+    """
+
+    def __init__(self, method, target, headers, body):
+        """
+        Initializes a new Request.
+
+        Args:
+            method (str): The request method.
+            target (str): The request target, i.e. the path and query string.
+            headers (dict): The request headers, with lower-case names.
+            body (bytes): The request body.
+        """
+        url = urlsplit(target)
+        self.method = method.upper()
+        self.path = unquote(url.path)
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """
+        Decodes the body as a JSON object.
+
+        Returns:
+            dict: The decoded object.
+
+        Raises:
+            HTTPError: If the body is not a JSON object.
+        """
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {str(e)}")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Expected a JSON object.")
+        return data
+
+    def int_param(self, name, default=None, maximum=None):
+        """
+        Reads an integer query string parameter.
+
+        Raises:
+            HTTPError: If the parameter is not a non-negative integer.
+        """
+        value = self.query.get(name)
+        if value is None:
+            return default
+        if not value.isdigit():
+            raise HTTPError(400, f"Parameter '{name}' must be a non-negative integer.")
+        return min(int(value), maximum) if maximum is not None else int(value)
+
+class SnippetServer:
+    """
+    A local HTTP/JSON API over the snippet store, served by asyncio.
+
+    Requests are parsed and answered on the event loop; every database call runs on a bounded
+    pool of worker threads, each with its own session, so slow queries never block other
+    clients. Connections are kept alive between requests. Snippet listings are fetched in
+    keyset-paginated batches and streamed to the client with chunked transfer encoding.
+
+    Attributes:
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+        workers (int): The number of database worker threads.
+    """
+
+    def __init__(self, host, port, workers=SERVER_WORKERS):
+        """
+        Initializes a new SnippetServer.
+
+        Args:
+            host (str): The interface to listen on.
+            port (int): The port to listen on.
+            workers (int): The number of database worker threads (default: SERVER_WORKERS).
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        self.routes = [
+            ("GET", r"/health", self.health),
+            ("GET", r"/snippets", self.list_snippets),
+            ("POST", r"/snippets", self.create_snippet),
+            ("GET", r"/snippets/(\d+)", self.view_snippet),
+            ("PATCH", r"/snippets/(\d+)", self.update_snippet),
+            ("DELETE", r"/snippets/(\d+)", self.delete_snippet),
+            ("GET", r"/search", self.search),
+            ("GET", r"/collections", self.list_collections),
+            ("POST", r"/users", self.create_user),
+        ]
+
+    async def serve_forever(self, on_ready=None):
+        """
+        Listens for connections until the task is cancelled.
+
+        Args:
+            on_ready (callable, optional): Called with the (host, port) the server listens on.
+        """
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+            limit=SERVER_MAX_BODY)
+        if on_ready:
+            on_ready(server.sockets[0].getsockname()[:2])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    async def run_db(self, func, *args):
+        """
+        Runs a database function on a worker thread.
+
+        The worker's session is removed afterwards, so its connection goes back to the pool.
+        """
+        def call():
+            try:
+                return func(*args)
+            finally:
+                Session.remove()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers the requests sent on one connection, until the client closes it.
+        """
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self.dispatch(request, writer, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            write_json(writer, e.status, {"error": e.message}, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def dispatch(self, request, writer, keep_alive):
+        """
+        Routes a request to its handler and writes the response.
+
+        Handlers return a (status, payload) pair or write a streamed response themselves and
+        return None. Missing snippets become 404 responses, other ValueErrors raised by the
+        store 400, and constraint violations (such as a taken username) 409.
+        """
+        try:
+            handler, args = self.route(request)
+            result = await handler(request, writer, keep_alive, *args)
+            if result is not None:
+                write_json(writer, *result, keep_alive=keep_alive)
+        except HTTPError as e:
+            write_json(writer, e.status, {"error": e.message}, keep_alive=keep_alive)
+        except SnippetNotFoundError as e:
+            write_json(writer, 404, {"error": str(e)}, keep_alive=keep_alive)
+        except ValueError as e:
+            write_json(writer, 400, {"error": str(e)}, keep_alive=keep_alive)
+        except IntegrityError as e:
+            write_json(writer, 409, {"error": f"Conflicts with stored data: {str(e.orig)}"}, keep_alive=keep_alive)
+        except Exception as e:
+            write_json(writer, 500, {"error": f"An error occurred: {str(e)}"}, keep_alive=keep_alive)
+
+    def route(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, request.path.rstrip("/") or "/")
+            if match:
+                if method == request.method:
+                    return handler, match.groups()
+                allowed = True
+        if allowed:
+            raise HTTPError(405, f"Method {request.method} is not allowed on {request.path}.")
+        raise HTTPError(404, f"No such resource: {request.path}")
+
+    async def health(self, request, writer, keep_alive):
+        return 200, {"status": "ok"}
+
+    async def view_snippet(self, request, writer, keep_alive, snippet_id):
+        return 200, await self.run_db(_view_snippet, int(snippet_id))
+
+    async def create_snippet(self, request, writer, keep_alive):
+        data = request.json()
+        return 201, await self.run_db(_create_snippet, *(data.get(field) for field in SNIPPET_FIELDS))
+
+    async def update_snippet(self, request, writer, keep_alive, snippet_id):
+        data = request.json()
+        unknown = set(data) - set(UPDATABLE_FIELDS)
+        if unknown:
+            raise HTTPError(400, f"Fields that cannot be updated: {', '.join(sorted(unknown))}")
+        return 200, await self.run_db(_update_snippet, int(snippet_id), *(data.get(field) for field in UPDATABLE_FIELDS))
+
+    async def delete_snippet(self, request, writer, keep_alive, snippet_id):
+        await self.run_db(_delete_snippet, int(snippet_id))
+        write_response(writer, 204, b"", keep_alive=keep_alive)
+
+    async def create_user(self, request, writer, keep_alive):
+        return 201, await self.run_db(_create_user, request.json().get("username"))
+
+    async def list_collections(self, request, writer, keep_alive):
+        return 200, {"collections": await self.run_db(_list_collections)}
+
+    async def search(self, request, writer, keep_alive):
+        terms = request.query.get("q", "").split()
+        limit = request.int_param("limit", SERVER_PAGE_SIZE, SERVER_MAX_PAGE_SIZE)
+        return 200, {"results": await self.run_db(_search, terms, limit)}
+
+    async def list_snippets(self, request, writer, keep_alive):
+        """
+        Streams a page of snippet summaries: {"snippets": [...], "next_after": id or null}.
+
+        The page is read in batches of at most LIST_BATCH_SIZE rows, each in its own short
+        worker call, and every batch is sent as soon as it is read. next_after is the value to
+        pass as 'after' for the following page, or null after the last page.
+        """
+        filters = (request.query.get("language"), request.query.get("collection"), request.query.get("user"))
+        limit = request.int_param("limit", SERVER_PAGE_SIZE, SERVER_MAX_PAGE_SIZE)
+        after = request.int_param("after")
+        rows = await self.run_db(_snippet_page, filters, after, min(limit, LIST_BATCH_SIZE))
+        start_chunked(writer, 200, keep_alive)
+        write_chunk(writer, b'{"snippets": [')
+        remaining = limit
+        sent = 0
+        last_id = None
+        try:
+            while True:
+                if rows:
+                    items = ", ".join(json.dumps({"id": snippet_id, "title": title, "language": language})
+                        for snippet_id, title, language in rows)
+                    write_chunk(writer, ((", " if sent else "") + items).encode("utf-8"))
+                    await writer.drain()
+                    sent += len(rows)
+                    last_id = after = rows[-1][0]
+                if len(rows) < min(remaining, LIST_BATCH_SIZE):
+                    last_id = None
+                    break
+                remaining -= len(rows)
+                if remaining == 0:
+                    break
+                rows = await self.run_db(_snippet_page, filters, after, min(remaining, LIST_BATCH_SIZE))
+        except Exception:
+            # The status line is already sent; all that can be done is to cut the response short.
+            writer.transport.abort()
+            raise ConnectionAbortedError("Listing failed after the response started.")
+        write_chunk(writer, f'], "next_after": {json.dumps(last_id if sent else None)}}}'.encode("utf-8"))
+        write_chunk(writer, b"")
+
+async def read_request(reader):
+    """
+    Reads one HTTP/1.1 request from a connection.
+
+    Returns:
+        Request: The request, or None if the client closed the connection.
+
+    Raises:
+        HTTPError: If the request is malformed or its body is too large.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HTTPError(400, "Incomplete request.")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(413, "Request headers are too large.")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line.")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "Chunked request bodies are not supported; send Content-Length.")
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise HTTPError(400, "Invalid Content-Length.")
+    if int(length) > SERVER_MAX_BODY:
+        raise HTTPError(413, f"Request bodies are limited to {SERVER_MAX_BODY} bytes.")
+    body = await reader.readexactly(int(length)) if int(length) else b""
+    return Request(method, target, headers, body)
+
+def write_response(writer, status, body, content_type="application/json", keep_alive=True):
+    """
+    Writes a complete response with a Content-Length.
+    """
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+def write_json(writer, status, payload, keep_alive=True):
+    write_response(writer, status, json.dumps(payload).encode("utf-8"), keep_alive=keep_alive)
+
+def start_chunked(writer, status, keep_alive=True):
+    writer.write((f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        "Content-Type: application/json\r\n"
+        "Transfer-Encoding: chunked\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1"))
+
+def write_chunk(writer, data):
+    """
+    Writes one chunk of a chunked response. An empty chunk ends the response.
+    """
+    writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+
+def _view_snippet(snippet_id):
+    row = snippet_details(Session(), snippet_id)
+    if not row:
+        raise SnippetNotFoundError(f"Snippet with ID {snippet_id} not found.")
+    title, description, language, data, codec, collection_name, username = row
+    return {"id": snippet_id, "title": title, "description": description, "language": language,
+        "code": decompress_code(data, codec), "collection": collection_name, "user": username}
+
+def _create_snippet(title, description, language, code, collection_name, username):
+    def work(session):
+        snippet = create_snippet(session, title, description, language, code, collection_name, username)
+        session.flush()
+        return {"id": snippet.id}
+    return write_with_retry(work)
+
+def _update_snippet(snippet_id, title, description, language, code):
+    write_with_retry(lambda session: update_snippet(session, snippet_id, title, description, language, code))
+    return {"id": snippet_id}
+
+def _delete_snippet(snippet_id):
+    write_with_retry(lambda session: delete_snippet(session, snippet_id))
+
+def _create_user(username):
+    def work(session):
+        user = create_user(session, username)
+        session.flush()
+        return {"id": user.id, "username": user.username}
+    return write_with_retry(work)
+
+def _list_collections():
+    return [{"id": collection_id, "name": name}
+        for collection_id, name in Session().query(Collection.id, Collection.name).order_by(Collection.id)]
+
+def _search(terms, limit):
+    return [{"id": snippet_id, "title": title, "language": language, "excerpt": excerpt}
+        for snippet_id, title, language, excerpt in full_text_search(Session(), terms, limit=limit)]
+
+def _snippet_page(filters, after, size):
+    query = snippet_summary_query(Session(), *filters)
+    return [tuple(row) for row in iter_keyset(query, Snippet.id, after=after, limit=size, batch_size=size)]
+
+def serve(host, port, workers=SERVER_WORKERS, on_ready=None):
+    """
+    Runs the API server until it is interrupted.
+
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+        workers (int): The number of database worker threads (default: SERVER_WORKERS).
+        on_ready (callable, optional): Called with the (host, port) the server listens on.
+    """
+    try:
+        asyncio.run(SnippetServer(host, port, workers).serve_forever(on_ready))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,376 @@
+# lib/shards.py
+import itertools
+from collections import OrderedDict, deque
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.dialects.sqlite import insert as upsert
+from sqlalchemy.orm import scoped_session
+from config import SHARD_DIRECTORY, SHARD_ID_STRIDE, SHARD_WORKERS, SHARD_OPEN_LIMIT, IMPORT_BATCH_SIZE
+from database import (Session, SessionFactory, SCHEMA_VERSION, create_engine_with_retry, create_tables,
+    write_with_retry)
+from models import User, Collection, Snippet
+from queries import iter_keyset
+from store import SnippetNotFoundError, get_user, get_or_create_collection
+
+# In the sharded layout, the database at DATABASE_URL is the catalog: it holds the users and
+# collections, and nothing else. Every user's snippets live in a shard of their own, a database
+# file with the full schema, so that writers of different users never wait for each other's
+# locks and every shard keeps its own indexes, triggers and statistics. The user and the
+# collections a shard's snippets refer to are copied into it under their catalog IDs.
+SHARD_FILE = re.compile(r'^user-(\d+)\.db$')
+
+# The session registries of the shards in use, and the engines of the shards that are open, the
+# least recently used first.
+_sessions = {}
+_engines = OrderedDict()
+_lock = threading.Lock()
+_engine_lock = threading.Lock()
+_executor = None
+
+def shard_path(user_id):
+    """
+    Returns the path of a user's shard.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        str: The path, in SHARD_DIRECTORY.
+    """
+    return os.path.join(SHARD_DIRECTORY, f"user-{user_id}.db")
+
+def shard_ids():
+    """
+    Lists the users that have a shard, that is, that have ever had a snippet.
+
+    Returns:
+        list: The user IDs, in ascending order.
+    """
+    if not os.path.isdir(SHARD_DIRECTORY):
+        return []
+    return sorted(int(match.group(1)) for match in map(SHARD_FILE.match, os.listdir(SHARD_DIRECTORY)) if match)
+
+def global_id(user_id, local_id):
+    """
+    Returns the ID a snippet is known by outside its shard.
+
+    Args:
+        user_id (int): The ID of the user whose shard holds the snippet.
+        local_id (int): The ID of the snippet within the shard.
+
+    Returns:
+        int: The global ID. Global IDs sort by user first, then by shard ID.
+    """
+    return user_id * SHARD_ID_STRIDE + local_id
+
+def split_id(snippet_id):
+    """
+    Splits a global snippet ID into the ID of its user and its ID within the user's shard.
+
+    Args:
+        snippet_id (int): The global ID.
+
+    Returns:
+        tuple: The user ID and the ID within the shard.
+    """
+    return divmod(int(snippet_id), SHARD_ID_STRIDE)
+
+def shard_sessions(user_id, create=False):
+    """
+    Returns the session registry of a user's shard.
+
+    A new shard is a copy of an empty database with the schema, which is built once per schema
+    version. Every session of a shard opens the shard if it is closed. A shard keeps a single
+    connection open between uses, so that writes do not reconnect, and at most SHARD_OPEN_LIMIT
+    shards do, so that fanning out over many shards does not run out of file descriptors.
+
+    Args:
+        user_id (int): The ID of the user.
+        create (bool): Create the shard if the user does not have one yet (default: False).
+
+    Returns:
+        sqlalchemy.orm.scoped_session: The thread-local sessions of the shard, or None if the
+        user has no shard and create is False. Their snippet IDs are local to the shard.
+    """
+    with _lock:
+        if user_id not in _sessions:
+            path = shard_path(user_id)
+            if not os.path.exists(path):
+                if not create:
+                    return None
+                _create_shard(path)
+            # Brings shards of an older schema version up to date.
+            create_tables(_open_engine(user_id))
+            # The ID offset lets the snippet cache translate the shard's IDs into global ones.
+            _sessions[user_id] = scoped_session(lambda: SessionFactory(bind=_open_engine(user_id),
+                info={'id_offset': global_id(user_id, 0)}))
+        return _sessions[user_id]
+
+def _create_shard(path):
+    # Copies the schema template to a file of this process, then links it into place, so that no
+    # one opens a shard that is only partly copied and a shard created meanwhile is kept.
+    os.makedirs(SHARD_DIRECTORY, exist_ok=True)
+    template = os.path.join(SHARD_DIRECTORY, f"schema-{SCHEMA_VERSION}.db")
+    if not os.path.exists(template):
+        partial = f"{template}.{os.getpid()}"
+        engine = create_engine_with_retry(f"sqlite:///{os.path.abspath(partial)}", pool_size=1)
+        try:
+            create_tables(engine)
+        finally:
+            engine.dispose()
+        os.replace(partial, template)
+    partial = f"{path}.{os.getpid()}"
+    shutil.copyfile(template, partial)
+    try:
+        os.link(partial, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(partial)
+
+def _open_engine(user_id):
+    # Returns the engine of an open shard, or opens it, closing the least recently used shards
+    # whose connection is not in use beyond SHARD_OPEN_LIMIT. The shards used last are kept, so
+    # that one about to be queried by a fan-out thread is not closed under it. Closing checkpoints
+    # the shard's write-ahead log, so it happens after the lock is released.
+    with _engine_lock:
+        if user_id in _engines:
+            _engines.move_to_end(user_id)
+            return _engines[user_id]
+        engine = create_engine_with_retry(f"sqlite:///{os.path.abspath(shard_path(user_id))}", pool_size=1)
+        _engines[user_id] = engine
+        idle = [other for other, open_engine in itertools.islice(_engines.items(), len(_engines) - 1)
+            if not open_engine.pool.checkedout()]
+        closed = [_engines.pop(other) for other in idle[:len(_engines) - max(SHARD_OPEN_LIMIT, SHARD_WORKERS + 1)]]
+    for other in closed:
+        other.dispose()
+    return engine
+
+def close_shards():
+    """
+    Releases the sessions of every open shard, disposes their engines and stops the fan-out
+    threads.
+    """
+    global _executor
+    # Fetches still queued open their shard's session, so they finish before the shards close.
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    with _lock, _engine_lock:
+        for sessions in _sessions.values():
+            sessions.remove()
+        for engine in _engines.values():
+            engine.dispose()
+        _sessions.clear()
+        _engines.clear()
+
+def route_snippet(snippet_id):
+    """
+    Works out where a snippet is stored.
+
+    Args:
+        snippet_id (int): The ID of the snippet, global in the sharded layout.
+
+    Returns:
+        tuple: The session registry to use and the snippet's ID there. Without sharding, these
+        are Session and the ID itself.
+
+    Raises:
+        SnippetNotFoundError: If the snippet's user has no shard.
+    """
+    if not SHARD_DIRECTORY:
+        return Session, int(snippet_id)
+    user_id, local_id = split_id(snippet_id)
+    sessions = shard_sessions(user_id) if local_id else None
+    if sessions is None:
+        raise SnippetNotFoundError(f"Snippet with ID {snippet_id} not found.")
+    return sessions, local_id
+
+def route_user(username, collection_names=()):
+    """
+    Prepares a user's shard for new snippets.
+
+    The user is looked up and the collections are created in the catalog, and both are copied
+    into the user's shard, which is created if needed. Empty collection names are skipped;
+    adding a snippet to them fails in the shard as it would anywhere else.
+
+    Args:
+        username (str): The username.
+        collection_names (iterable, optional): The collections the snippets will be added to.
+
+    Returns:
+        sqlalchemy.orm.scoped_session: The sessions to add the user's snippets with. Without
+        sharding, this is Session, and nothing is looked up.
+
+    Raises:
+        ValueError: If the user is not found.
+    """
+    if not SHARD_DIRECTORY:
+        return Session
+    user, collections = write_with_retry(lambda session: _resolve_user(session, username, collection_names))
+    sessions = shard_sessions(user['id'], create=True)
+    write_with_retry(lambda session: _copy_catalog_rows(session, user, collections), session_factory=sessions)
+    return sessions
+
+def _resolve_user(session, username, collection_names):
+    # Looks the user up and creates the collections in the catalog, as rows to copy into a shard.
+    user = get_user(session, username)
+    collections = [get_or_create_collection(session, name) for name in set(collection_names) if name]
+    return {'id': user.id, 'username': user.username}, [{'id': c.id, 'name': c.name} for c in collections]
+
+def _copy_catalog_rows(session, user, collections):
+    session.execute(upsert(User.__table__).values(user).on_conflict_do_nothing())
+    if collections:
+        session.execute(upsert(Collection.__table__).values(collections).on_conflict_do_nothing())
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(SHARD_WORKERS, thread_name_prefix='shard')
+        return _executor
+
+def _run(sessions, work):
+    # Runs work in the calling thread's session of a shard, and hands the connection back after.
+    try:
+        return work(sessions())
+    finally:
+        sessions.remove()
+
+def iter_sharded(build_query, after=None, limit=None, batch_size=500, user_ids=None):
+    """
+    Iterates over the rows of a snippet query on every shard, in global ID order.
+
+    Global IDs sort by user first, so the shards are read one after the other, in user order,
+    each paged through with iter_keyset. Reads run ahead on the thread pool: while a shard's
+    rows are yielded, its next batch is already being fetched, and every time a shard runs out
+    the first batches of twice as many following shards are fetched in parallel, up to
+    SHARD_WORKERS. A page that one shard can fill only queries that shard, and a search that
+    matches few snippets per shard still reads many shards at once.
+
+    Args:
+        build_query (callable): Called with a session to build the query. The query must select
+            from the snippets table, with the snippet ID as its first column.
+        after (int, optional): Only yield rows with a global ID greater than this one.
+        limit (int, optional): The maximum number of rows to yield.
+        batch_size (int): The number of rows fetched from a shard at a time (default: 500).
+        user_ids (list, optional): Only query the shards of these users (default: all shards).
+
+    Returns:
+        iterator: The rows, with global snippet IDs, in ascending ID order.
+    """
+    if limit is not None:
+        batch_size = max(1, min(batch_size, limit))
+    after_user, after_local = split_id(after) if after is not None else (None, None)
+    streams = (_shard_rows(sessions, user_id, build_query, after_local if user_id == after_user else None, batch_size)
+        for user_id in sorted(shard_ids() if user_ids is None else user_ids)
+        if after is None or user_id >= after_user
+        for sessions in [shard_sessions(user_id)] if sessions is not None)
+
+    def rows():
+        # Creating a stream starts its first fetch, so the window holds the shards read ahead.
+        window = deque(itertools.islice(streams, 1))
+        width = 1
+        while window:
+            yield from window.popleft()
+            width = min(width * 2, SHARD_WORKERS)
+            window.extend(itertools.islice(streams, width - len(window)))
+    return itertools.islice(rows(), limit)
+
+def _shard_rows(sessions, user_id, build_query, after, batch_size):
+    offset = global_id(user_id, 0)
+
+    def fetch(after):
+        return _run(sessions, lambda session: [tuple(row) for row in
+            iter_keyset(build_query(session), Snippet.id, after=after, limit=batch_size, batch_size=batch_size)])
+
+    # Submitted before the first row is asked for, so that shards read ahead start at once.
+    future = _pool().submit(fetch, after)
+
+    def rows(future):
+        while True:
+            batch = future.result()
+            if len(batch) == batch_size:
+                future = _pool().submit(fetch, batch[-1][0])
+            for row in batch:
+                yield (row[0] + offset,) + row[1:]
+            if len(batch) < batch_size:
+                return
+    return rows(future)
+
+def import_sharded(records, batch_size=IMPORT_BATCH_SIZE, on_progress=None, on_reject=None):
+    """
+    Imports snippet records into the shards of their users.
+
+    Records are read in batches and split by user. The users of a batch are looked up and their
+    collections created in the catalog in one transaction. Then every user's shard is created
+    if needed, the user and collections are copied into it, and the user's records are imported
+    into it by importer.import_snippets, the shards in parallel.
+
+    Args:
+        records (iterable): (source, record) pairs as yielded by read_jsonl or read_directory.
+        batch_size (int): The number of records read per batch (default: IMPORT_BATCH_SIZE).
+        on_progress (callable, optional): Called as on_progress(imported, rejected, elapsed)
+            after every batch.
+        on_reject (callable, optional): Called as on_reject(source, error) for every rejected
+            record, from one thread at a time.
+
+    Returns:
+        tuple: The number of imported and rejected records.
+    """
+    from importer import import_snippets
+    counts = {'imported': 0, 'rejected': 0}
+    reject_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def reject(source, error):
+        with reject_lock:
+            counts['rejected'] += 1
+            if on_reject:
+                on_reject(source, error)
+
+    def resolve(session, by_user):
+        resolved = {}
+        for username, items in by_user.items():
+            try:
+                resolved[username] = _resolve_user(session, username, [record.get('collection') for _, record in items])
+            except ValueError as e:
+                resolved[username] = e
+        return resolved
+
+    def import_user(sessions, user, collections, items):
+        write_with_retry(lambda session: _copy_catalog_rows(session, user, collections), session_factory=sessions)
+        return _run(sessions, lambda session: import_snippets(session, items, batch_size=len(items), on_reject=reject))
+
+    def import_batch(batch):
+        by_user = {}
+        for source, record in batch:
+            if isinstance(record, Exception):
+                reject(source, str(record))
+            else:
+                by_user.setdefault(record.get('user'), []).append((source, record))
+        resolved = write_with_retry(lambda session: resolve(session, by_user))
+        futures = []
+        for username, items in by_user.items():
+            if isinstance(resolved[username], ValueError):
+                for source, _ in items:
+                    reject(source, str(resolved[username]))
+                continue
+            user, collections = resolved[username]
+            futures.append(_pool().submit(import_user, shard_sessions(user['id'], create=True), user, collections, items))
+        counts['imported'] += sum(future.result()[0] for future in futures)
+        if on_progress:
+            on_progress(counts['imported'], counts['rejected'], time.perf_counter() - start)
+
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        import_batch(batch)
+    return counts['imported'], counts['rejected']
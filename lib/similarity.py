@@ -0,0 +1,420 @@
+# lib/similarity.py
+import hashlib
+import re
+import struct
+from sqlalchemy import event, insert, select, text
+from config import SIMILARITY_SHINGLE_SIZE, SIMILARITY_BANDS, SIMILARITY_ROWS, SIMILARITY_THRESHOLD
+from models import CodeBlob, CodeSignature, SignatureBucket, Snippet
+from compression import decompress_code
+from store import SnippetNotFoundError
+
+SIGNATURE_SIZE = SIMILARITY_BANDS * SIMILARITY_ROWS
+
+# Identifiers, numbers, quoted strings and single punctuation characters. Whitespace separates
+# tokens but is not one, so reformatting code does not change its tokens.
+TOKEN_PATTERN = re.compile(r"""[A-Za-z_]\w*|\d[\w.]*|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|\S""")
+
+# Keywords of the common languages. Other identifiers are treated as names (see features).
+KEYWORDS = frozenset("""
+    and as async await break case catch class const continue def default defer del delete do elif else
+    enum except export extends false final finally fn for from func function go if impl import in
+    interface is let lambda match mod mut new nil none not null or package pass private protected pub
+    public raise return self select static struct super switch this throw throws true try type typeof
+    use var void while with yield
+    create from group by having index insert into join limit on order set table update values where
+""".split())
+
+# Buckets with more members than this are linked to their first member only when clustering,
+# instead of comparing every pair.
+CLUSTER_PAIRWISE_LIMIT = 16
+
+# Removes the signature and buckets of a code blob when the blob is deleted.
+SIGNATURE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS code_signatures_ad AFTER DELETE ON code_blobs BEGIN
+        DELETE FROM signature_buckets
+        WHERE signature_id IN (SELECT id FROM code_signatures WHERE code_hash = old.hash);
+        DELETE FROM code_signatures WHERE code_hash = old.hash;
+    END
+"""
+
+def tokenize(code):
+    """
+    Splits code into tokens, replacing every number with 0 and every string literal with "".
+
+    Args:
+        code (str): The code.
+
+    Returns:
+        list: The tokens.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(code):
+        if token[0].isdigit():
+            token = '0'
+        elif token[0] in '"\'' and len(token) > 1:
+            token = '""'
+        tokens.append(token)
+    return tokens
+
+def features(code, shingle_size=SIMILARITY_SHINGLE_SIZE):
+    """
+    Turns code into the set of features whose overlap measures how alike two codes are.
+
+    The features are the shingles (runs of shingle_size tokens) of the code with every name
+    replaced by the same placeholder, which capture its structure, plus each distinct name used.
+    Renaming a variable changes only one name and none of the shingles; reformatting changes
+    nothing.
+
+    Args:
+        code (str): The code.
+        shingle_size (int): The number of consecutive tokens per shingle (default: SIMILARITY_SHINGLE_SIZE).
+
+    Returns:
+        set: The features, as strings.
+    """
+    tokens = tokenize(code)
+    names = {token for token in tokens if (token[0].isalpha() or token[0] == '_') and token.lower() not in KEYWORDS}
+    structure = ['\x00' if token in names else token for token in tokens]
+    shingles = {'\x1f'.join(structure[i:i + shingle_size])
+        for i in range(max(1, len(structure) - shingle_size + 1))} if structure else set()
+    return shingles | {'\x1e' + name for name in names}
+
+def minhash(code, shingle_size=SIMILARITY_SHINGLE_SIZE, size=SIGNATURE_SIZE):
+    """
+    Computes the MinHash signature of the features of a code body (see features).
+
+    Uses one-permutation hashing: every shingle is hashed once, the hash picks one of size bins,
+    and each bin keeps the smallest value that falls into it. Empty bins borrow the value of the
+    next bin that is not empty, so short code still gets a full signature. The fraction of equal
+    values in two signatures estimates the Jaccard similarity of the two sets of features.
+
+    Args:
+        code (str): The code.
+        shingle_size (int): The number of consecutive tokens per shingle (default: SIMILARITY_SHINGLE_SIZE).
+        size (int): The number of values in the signature (default: SIGNATURE_SIZE).
+
+    Returns:
+        list: The signature, or None if the code has no tokens.
+    """
+    shingles = features(code, shingle_size)
+    if not shingles:
+        return None
+    bins = [None] * size
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        index = (value & 0xFFFFFFFF) % size
+        value >>= 32
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    signature = []
+    for index in range(size):
+        distance = 0
+        while bins[(index + distance) % size] is None:
+            distance += 1
+        # The offset keeps a borrowed value apart from the value it was borrowed from.
+        signature.append((bins[(index + distance) % size] + distance * 0x9E3779B1) & 0xFFFFFFFF)
+    return signature
+
+def pack_signature(signature):
+    return struct.pack(f'<{len(signature)}I', *signature)
+
+def unpack_signature(data):
+    return struct.unpack(f'<{len(data) // 4}I', data)
+
+def band_buckets(signature, rows=SIMILARITY_ROWS):
+    """
+    Hashes every band of rows consecutive signature values into a bucket.
+
+    Args:
+        signature (list): The signature.
+        rows (int): The number of values per band (default: SIMILARITY_ROWS).
+
+    Returns:
+        list: One signed 64-bit bucket per band. The band's number is part of the hash, so
+        equal values in different bands do not share a bucket.
+    """
+    buckets = []
+    for band in range(len(signature) // rows):
+        data = struct.pack(f'<H{rows}I', band, *signature[band * rows:(band + 1) * rows])
+        buckets.append(int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True))
+    return buckets
+
+def estimate_similarity(first, second):
+    """
+    Estimates the Jaccard similarity of two codes from their signatures.
+
+    Returns:
+        float: The fraction of positions at which the signatures agree.
+    """
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+def store_signatures(connection, bodies):
+    """
+    Computes and stores the signatures and LSH buckets of code bodies that do not have one yet.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+        bodies (dict): Code by blob hash.
+
+    Returns:
+        int: The number of signatures stored.
+    """
+    hashes = list(bodies)
+    existing = set()
+    for start in range(0, len(hashes), 500):
+        existing.update(connection.execute(select(CodeSignature.code_hash)
+            .where(CodeSignature.code_hash.in_(hashes[start:start + 500]))).scalars())
+    signatures = {}
+    for blob_hash in hashes:
+        if blob_hash not in existing:
+            signature = minhash(bodies[blob_hash])
+            if signature is not None:
+                signatures[blob_hash] = signature
+    if not signatures:
+        return 0
+    connection.execute(insert(CodeSignature.__table__), [
+        {'code_hash': blob_hash, 'signature': pack_signature(signature)} for blob_hash, signature in signatures.items()])
+    hashes = list(signatures)
+    buckets = []
+    for start in range(0, len(hashes), 500):
+        for signature_id, blob_hash in connection.execute(select(CodeSignature.id, CodeSignature.code_hash)
+                .where(CodeSignature.code_hash.in_(hashes[start:start + 500]))):
+            buckets.extend({'bucket': bucket, 'signature_id': signature_id}
+                for bucket in band_buckets(signatures[blob_hash]))
+    connection.execute(insert(SignatureBucket.__table__), buckets)
+    return len(signatures)
+
+def create_signature_index(connection):
+    """
+    Creates the trigger that drops the signature of a deleted code blob.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    connection.execute(text(SIGNATURE_TRIGGER))
+
+def backfill_signatures(connection, batch_size=1000):
+    """
+    Stores the signatures of all code blobs that do not have one, in hash order.
+
+    Used when upgrading a database created before signatures existed.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+        batch_size (int): The number of blobs read at a time (default: 1000).
+
+    Returns:
+        int: The number of signatures stored.
+    """
+    stored = 0
+    last_hash = ''
+    table = CodeBlob.__table__
+    while True:
+        rows = connection.execute(select(table.c.hash, table.c.body, table.c.codec)
+            .where(table.c.hash > last_hash).order_by(table.c.hash).limit(batch_size)).all()
+        if not rows:
+            return stored
+        stored += store_signatures(connection, {blob_hash: decompress_code(body, codec)
+            for blob_hash, body, codec in rows})
+        last_hash = rows[-1][0]
+
+def register_signature_events(session_factory):
+    """
+    Registers the flush hook that stores the signatures of new code blobs.
+
+    Args:
+        session_factory (sqlalchemy.orm.sessionmaker): The factory whose sessions get the hook.
+    """
+    event.listen(session_factory, 'after_flush', sign_new_blobs)
+
+def sign_new_blobs(session, flush_context):
+    """
+    Stores the signatures of the code blobs inserted by a flush, so a snippet whose code is
+    added or changed can be found by 'similar' right away.
+    """
+    bodies = {blob.hash: blob.body for blob in session.new if isinstance(blob, CodeBlob)}
+    if bodies:
+        store_signatures(session.connection(), bodies)
+
+def _signatures(session, signature_ids):
+    signatures = {}
+    signature_ids = list(signature_ids)
+    for start in range(0, len(signature_ids), 500):
+        for signature_id, code_hash, data in session.execute(
+                select(CodeSignature.id, CodeSignature.code_hash, CodeSignature.signature)
+                .where(CodeSignature.id.in_(signature_ids[start:start + 500]))):
+            signatures[signature_id] = (code_hash, unpack_signature(data))
+    return signatures
+
+def _snippets_by_hash(session, hashes):
+    snippets = {}
+    hashes = list(hashes)
+    for start in range(0, len(hashes), 500):
+        for snippet_id, title, language, code_hash in session.query(
+                Snippet.id, Snippet.title, Snippet.language, Snippet.code_hash) \
+                .filter(Snippet.code_hash.in_(hashes[start:start + 500])).order_by(Snippet.id):
+            snippets.setdefault(code_hash, []).append((snippet_id, title, language))
+    return snippets
+
+def similar_snippets(session, snippet_id, threshold=SIMILARITY_THRESHOLD, limit=20):
+    """
+    Finds the snippets whose code is nearly the same as the code of a snippet.
+
+    Only signatures that share an LSH bucket with the snippet's signature are compared, so the
+    cost depends on the number of near-duplicates rather than on the size of the store.
+    Snippets with exactly the same code have a similarity of 1.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+        threshold (float): The lowest estimated similarity reported (default: SIMILARITY_THRESHOLD).
+        limit (int): The maximum number of snippets to return (default: 20).
+
+    Returns:
+        list: (similarity, id, title, language) tuples, most similar first.
+
+    Raises:
+        ValueError: If the snippet is not found or its code has no signature.
+    """
+    code_hash = session.query(Snippet.code_hash).filter(Snippet.id == snippet_id).scalar()
+    if code_hash is None:
+        raise SnippetNotFoundError(f"Snippet with ID {snippet_id} not found.")
+    own = session.execute(select(CodeSignature.id, CodeSignature.signature)
+        .where(CodeSignature.code_hash == code_hash)).first()
+    if own is None:
+        raise ValueError(f"Snippet with ID {snippet_id} has no code to compare.")
+    signature = unpack_signature(own.signature)
+    candidates = session.execute(select(SignatureBucket.signature_id).distinct()
+        .where(SignatureBucket.bucket.in_(band_buckets(signature)))).scalars().all()
+    scores = {}
+    for code_hash_, other in _signatures(session, candidates).values():
+        similarity = estimate_similarity(signature, other)
+        if similarity >= threshold:
+            scores[code_hash_] = similarity
+    results = []
+    for code_hash_, members in _snippets_by_hash(session, scores).items():
+        results.extend((scores[code_hash_], member_id, title, language)
+            for member_id, title, language in members if member_id != int(snippet_id))
+    results.sort(key=lambda result: (-result[0], result[1]))
+    return results[:limit]
+
+def near_duplicate_clusters(session, threshold=SIMILARITY_THRESHOLD, limit=20, members_limit=10):
+    """
+    Groups the code of the whole store into clusters of near-duplicates, largest first.
+
+    Signatures that share an LSH bucket are compared, and pairs at least threshold similar are
+    joined into clusters. Signatures alone in all of their buckets are never compared, and
+    neither are two signatures already in the same cluster. A body shared by several snippets
+    is a cluster of exact duplicates even if no other body is near it.
+
+    Buckets are streamed in order, holding at most CLUSTER_PAIRWISE_LIMIT + 1 members of one
+    bucket at a time, and only the clusters' sizes are counted for the whole store; snippets are
+    only read for the clusters returned.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        threshold (float): The lowest estimated similarity that links two bodies
+            (default: SIMILARITY_THRESHOLD).
+        limit (int): The maximum number of clusters to return (default: 20).
+        members_limit (int): The maximum number of snippets listed per cluster (default: 10).
+
+    Returns:
+        tuple: The list of (snippet count, body count, snippets) clusters, where snippets lists
+        the (id, title, language) of the first members, and the total number of clusters.
+    """
+    parents = {}
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    def signature(member):
+        # Members are [signature ID, packed signature], unpacked the first time they are compared.
+        if isinstance(member[1], bytes):
+            member[1] = unpack_signature(member[1])
+        return member[1]
+
+    def link(first, second):
+        # Compares two members of a bucket unless they are already in the same cluster.
+        first_root, second_root = find(first[0]), find(second[0])
+        if first_root != second_root and estimate_similarity(signature(first), signature(second)) >= threshold:
+            parents[first_root] = second_root
+
+    def link_pairs(members):
+        for i, first in enumerate(members):
+            for second in members[i + 1:]:
+                link(first, second)
+
+    # Bodies with several snippets start as clusters of their own, so that exact duplicates are
+    # reported whether or not they share a bucket with another body.
+    for signature_id, in session.execute(text("""
+        SELECT s.id FROM code_signatures s
+        JOIN (SELECT code_hash FROM snippets GROUP BY code_hash HAVING count(*) > 1) d
+            ON d.code_hash = s.code_hash
+    """)):
+        parents[signature_id] = signature_id
+
+    # Buckets with a single member are skipped in SQL; the rest arrive in bucket order. The
+    # members of a bucket are held until it turns out to be larger than CLUSTER_PAIRWISE_LIMIT;
+    # from then on, only its first member is kept and every other member is linked to it.
+    rows = session.execute(text("""
+        SELECT b.bucket, s.id, s.signature
+        FROM signature_buckets b JOIN code_signatures s ON s.id = b.signature_id
+        WHERE b.bucket IN (SELECT bucket FROM signature_buckets GROUP BY bucket HAVING count(*) > 1)
+        ORDER BY b.bucket, b.signature_id
+    """))
+    held = []
+    large = False
+    last_bucket = None
+    for bucket, signature_id, data in rows:
+        if bucket != last_bucket:
+            if not large:
+                link_pairs(held)
+            held, large, last_bucket = [], False, bucket
+        member = [signature_id, data]
+        parents.setdefault(signature_id, signature_id)
+        if large:
+            link(held[0], member)
+            continue
+        held.append(member)
+        if len(held) > CLUSTER_PAIRWISE_LIMIT:
+            for other in held[1:]:
+                link(held[0], other)
+            del held[1:]
+            large = True
+    if not large:
+        link_pairs(held)
+
+    # Snippets and bodies per cluster, and its first snippet ID, which orders clusters of one size.
+    sizes = {}
+    for signature_id, count, first_id in session.execute(text("""
+        SELECT s.id, count(*), min(n.id) FROM code_signatures s JOIN snippets n ON n.code_hash = s.code_hash
+        GROUP BY s.id
+    """)):
+        if signature_id in parents:
+            size = sizes.setdefault(find(signature_id), [0, 0, first_id])
+            size[0] += count
+            size[1] += 1
+            size[2] = min(size[2], first_id)
+    ranked = sorted(((snippets, bodies, first_id, root) for root, (snippets, bodies, first_id) in sizes.items()
+        if snippets > 1), key=lambda cluster: (-cluster[0], cluster[2]))
+    shown = ranked[:limit]
+    signature_ids = {root: [] for _, _, _, root in shown}
+    for node in parents:
+        root = find(node)
+        if root in signature_ids:
+            signature_ids[root].append(node)
+    clusters = [(snippets, bodies, _first_members(session, signature_ids[root], members_limit))
+        for snippets, bodies, _, root in shown]
+    return clusters, len(ranked)
+
+def _first_members(session, signature_ids, limit):
+    # The snippets with the lowest IDs among those whose code has one of the signatures.
+    members = []
+    for start in range(0, len(signature_ids), 500):
+        members.extend(session.query(Snippet.id, Snippet.title, Snippet.language)
+            .join(CodeSignature, CodeSignature.code_hash == Snippet.code_hash)
+            .filter(CodeSignature.id.in_(signature_ids[start:start + 500])).order_by(Snippet.id).limit(limit))
+    return sorted(tuple(member) for member in members)[:limit]
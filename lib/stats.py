@@ -0,0 +1,153 @@
+# lib/stats.py
+from sqlalchemy import cast, func, text, Integer
+from models import Collection, SnippetStat, User
+
+# What snippets are counted by, and the snippets column holding each.
+STATS_DIMENSIONS = {
+    'language': 'language',
+    'collection': 'collection_id',
+    'user': 'user_id',
+}
+STATS_TRIGGERS = ['snippet_stats_ai', 'snippet_stats_ad', 'snippet_stats_au']
+
+def _adjust(row, sign):
+    # Adds (sign 1) or removes (sign -1) one snippet of the old or new row to every dimension.
+    size = f"coalesce((SELECT size FROM code_blobs WHERE hash = {row}.code_hash), 0)"
+    return "".join(f"""
+        INSERT INTO snippet_stats (dimension, value, snippets, code_bytes)
+        VALUES ('{dimension}', coalesce({row}.{column}, ''), {sign}, {sign} * {size})
+        ON CONFLICT (dimension, value) DO UPDATE
+        SET snippets = snippets + excluded.snippets, code_bytes = code_bytes + excluded.code_bytes;"""
+        for dimension, column in STATS_DIMENSIONS.items())
+
+def _drop_empty(row):
+    # Removes the rows of the old row's groups that no snippet is left in.
+    return "".join(f"""
+        DELETE FROM snippet_stats
+        WHERE dimension = '{dimension}' AND value = coalesce({row}.{column}, '') AND snippets = 0;"""
+        for dimension, column in STATS_DIMENSIONS.items())
+
+_CHANGED = " OR ".join(f"old.{column} IS NOT new.{column}" for column in list(STATS_DIMENSIONS.values()) + ['code_hash'])
+
+# The per-language, per-collection and per-user counts, kept up to date by triggers so that
+# every way of writing snippets (the ORM, bulk imports, set-based updates and deletes) keeps
+# them right. Code blobs are inserted before and pruned after the snippets that use them, so
+# the size of a snippet's code can always be read from its blob.
+STATS_SCHEMA = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippet_stats_ai AFTER INSERT ON snippets BEGIN{_adjust('new', 1)}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippet_stats_ad AFTER DELETE ON snippets BEGIN{_adjust('old', -1)}{_drop_empty('old')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS snippet_stats_au AFTER UPDATE OF {', '.join(STATS_DIMENSIONS.values())}, code_hash
+    ON snippets WHEN {_CHANGED} BEGIN{_adjust('old', -1)}{_adjust('new', 1)}{_drop_empty('old')}
+    END
+    """,
+]
+
+def create_stats_index(connection):
+    """
+    Creates the triggers that keep the snippet statistics up to date.
+
+    If the triggers are created on a database that already holds snippets, the statistics are
+    computed from them.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    existed = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"),
+        {"name": STATS_TRIGGERS[0]}).first() is not None
+    for statement in STATS_SCHEMA:
+        connection.execute(text(statement))
+    if not existed:
+        rebuild_stats(connection)
+
+def compute_stats(connection):
+    """
+    Computes the snippet statistics from the snippets table, with one GROUP BY per dimension.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        dict: (snippets, code bytes) pairs by (dimension, value).
+    """
+    stats = {}
+    for dimension, column in STATS_DIMENSIONS.items():
+        rows = connection.execute(text(f"""
+            SELECT coalesce(s.{column}, ''), count(*), coalesce(sum(b.size), 0)
+            FROM snippets s JOIN code_blobs b ON b.hash = s.code_hash
+            GROUP BY coalesce(s.{column}, '')
+        """))
+        for value, snippets, code_bytes in rows:
+            stats[(dimension, str(value))] = (snippets, code_bytes)
+    return stats
+
+def rebuild_stats(connection):
+    """
+    Recomputes the snippet statistics and replaces the stored ones.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+
+    Returns:
+        list: (dimension, value, stored, actual) tuples for every group whose stored
+        statistics were wrong, where stored and actual are (snippets, code bytes) pairs and
+        either may be None for a group that was missing or should not exist.
+    """
+    table = SnippetStat.__table__
+    stored = {(dimension, value): (snippets, code_bytes)
+        for dimension, value, snippets, code_bytes in connection.execute(
+            table.select().with_only_columns(table.c.dimension, table.c.value, table.c.snippets, table.c.code_bytes))}
+    actual = compute_stats(connection)
+    drift = [(dimension, value, stored.get((dimension, value)), actual.get((dimension, value)))
+        for dimension, value in sorted(stored.keys() | actual.keys())
+        if stored.get((dimension, value)) != actual.get((dimension, value))]
+    connection.execute(table.delete())
+    if actual:
+        connection.execute(table.insert(), [
+            {'dimension': dimension, 'value': value, 'snippets': snippets, 'code_bytes': code_bytes}
+            for (dimension, value), (snippets, code_bytes) in actual.items()])
+    return drift
+
+def snippet_stats(session, limit=None):
+    """
+    Reads the snippet statistics, largest groups first.
+
+    Only the summary table and the names of the listed collections and users are read, so this
+    takes the same time however many snippets there are.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        limit (int, optional): The maximum number of groups listed per dimension.
+
+    Returns:
+        tuple: The total number of snippets and code bytes, and a dict of (name, snippets,
+        code bytes) lists by dimension. Names are None for snippets without a collection or user.
+    """
+    names = {
+        'language': None,
+        'collection': (Collection, Collection.name),
+        'user': (User, User.username),
+    }
+    groups = {}
+    for dimension, joined in names.items():
+        if joined is None:
+            query = session.query(SnippetStat.value, SnippetStat.snippets, SnippetStat.code_bytes)
+        else:
+            model, name = joined
+            query = session.query(name, SnippetStat.snippets, SnippetStat.code_bytes) \
+                .select_from(SnippetStat).outerjoin(model, model.id == cast(SnippetStat.value, Integer))
+        query = query.filter(SnippetStat.dimension == dimension) \
+            .order_by(SnippetStat.snippets.desc(), SnippetStat.value)
+        if limit:
+            query = query.limit(limit)
+        groups[dimension] = query.all()
+    total = session.query(func.coalesce(func.sum(SnippetStat.snippets), 0),
+        func.coalesce(func.sum(SnippetStat.code_bytes), 0)).filter(SnippetStat.dimension == 'language').one()
+    return tuple(total), groups
@@ -0,0 +1,305 @@
+# lib/store.py
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from models import User, Collection, Snippet
+from queries import snippet_conditions
+from blobs import release_code_blobs, prune_released_blobs
+from utils import validate_collection_name, validate_snippet_language
+
+class SnippetNotFoundError(ValueError):
+    """
+    Raised when there is no snippet with the requested ID.
+    """
+
+def create_user(session, username):
+    """
+    Adds a new user to the session.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        username (str): The username of the new user.
+
+    Returns:
+        User: The new user. It gets its ID when the session is flushed.
+
+    Raises:
+        ValueError: If the username is empty or invalid.
+    """
+    user = User(username=username)
+    session.add(user)
+    return user
+
+def get_user(session, username, users=None):
+    """
+    Looks up a user by username.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        username (str): The username.
+        users (dict, optional): A cache of users by username, consulted and filled in.
+
+    Returns:
+        User: The user.
+
+    Raises:
+        ValueError: If the user is not found.
+    """
+    if users is not None and username in users:
+        return users[username]
+    user = session.query(User).filter_by(username=username).first()
+    if not user:
+        raise ValueError(f"User '{username}' not found.")
+    if users is not None:
+        users[username] = user
+    return user
+
+def get_or_create_user(session, username, users=None):
+    """
+    Looks up a user by username, creating the user if it does not exist.
+
+    The user is created with INSERT ... ON CONFLICT DO NOTHING, so two connections creating
+    the same user at once both end up with the one stored row instead of a unique constraint
+    error. Only a new user is checked, by the same rule as create_user; an existing one is used
+    whatever its username.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        username (str): The username.
+        users (dict, optional): A cache of users by username, consulted and filled in.
+
+    Returns:
+        User: The user.
+
+    Raises:
+        ValueError: If the user does not exist and the username is not valid for a new one.
+    """
+    if users is not None and username in users:
+        return users[username]
+    user = _upsert(session, User, 'username', username)
+    if users is not None:
+        users[username] = user
+    return user
+
+def get_or_create_collection(session, name, collections=None):
+    """
+    Looks up a collection by name, creating it if it does not exist.
+
+    The collection is created with INSERT ... ON CONFLICT DO NOTHING, so concurrent writers
+    adding to the same new collection do not fail on its unique name. Only a new collection is
+    checked, by the same rule as Collection itself; an existing one is used whatever its name.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        name (str): The name of the collection.
+        collections (dict, optional): A cache of collections by name, consulted and filled in.
+
+    Returns:
+        Collection: The collection.
+
+    Raises:
+        ValueError: If the collection does not exist and its name is not valid for a new one.
+    """
+    if collections is not None and name in collections:
+        return collections[name]
+    collection = _upsert(session, Collection, 'name', name)
+    if collections is not None:
+        collections[name] = collection
+    return collection
+
+def _upsert(session, model, column, value):
+    # Looks the row up first, so that the common case of an existing row does not write. The
+    # row is inserted bypassing the unit of work, so a concurrent insert of the same value is
+    # skipped by the database rather than failing on flush. Only a new row is checked, by
+    # building it the way create_user and Collection(name) do, so the model's rule applies.
+    query = session.query(model).filter(model.__table__.c[column] == value)
+    row = query.first()
+    if row is None:
+        model(value)
+        session.execute(insert(model.__table__).values({column: value}).on_conflict_do_nothing(index_elements=[column]))
+        row = query.one()
+    return row
+
+def create_snippet(session, title, description, language, code, collection_name, username, users=None,
+        collections=None):
+    """
+    Adds a new code snippet to the session.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        title (str): The title of the snippet.
+        description (str): The description of the snippet.
+        language (str): The programming language of the snippet.
+        code (str): The code content of the snippet.
+        collection_name (str): The name of the collection to which the snippet belongs. It is
+            created if it does not exist.
+        username (str): The username of the user who owns the snippet.
+        users (dict, optional): A cache of users by username (see get_user).
+        collections (dict, optional): A cache of collections by name (see get_or_create_collection).
+
+    Returns:
+        Snippet: The new snippet. It gets its ID when the session is flushed.
+
+    Raises:
+        ValueError: If the user is not found or any of the input values are invalid.
+    """
+    user = get_user(session, username, users)
+    snippet = Snippet(title=title, description=description, language=language, code=code,
+        collection=get_or_create_collection(session, collection_name, collections), user=user)
+    session.add(snippet)
+    return snippet
+
+def get_snippet(session, snippet_id):
+    """
+    Looks up a snippet by ID.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+
+    Returns:
+        Snippet: The snippet.
+
+    Raises:
+        SnippetNotFoundError: If the snippet with the given ID is not found.
+    """
+    snippet = session.query(Snippet).filter_by(id=snippet_id).first()
+    if not snippet:
+        raise SnippetNotFoundError(f"Snippet with ID {snippet_id} not found.")
+    return snippet
+
+def update_snippet(session, snippet_id, title=None, description=None, language=None, code=None):
+    """
+    Changes the given fields of a snippet. Fields that are not given are left as they are.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet to update.
+        title (str, optional): The new title of the snippet.
+        description (str, optional): The new description of the snippet.
+        language (str, optional): The new programming language of the snippet.
+        code (str, optional): The new code content of the snippet.
+
+    Returns:
+        Snippet: The updated snippet.
+
+    Raises:
+        ValueError: If the snippet is not found or any of the new values are invalid.
+    """
+    snippet = get_snippet(session, snippet_id)
+    if title:
+        snippet.title = title
+    if description:
+        snippet.description = description
+    if language:
+        snippet.language = language
+    if code:
+        snippet.code = code
+    return snippet
+
+def delete_snippet(session, snippet_id):
+    """
+    Deletes a snippet.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet to delete.
+
+    Raises:
+        ValueError: If the snippet with the given ID is not found.
+    """
+    session.delete(get_snippet(session, snippet_id))
+
+def _required_conditions(language, collection_name, username):
+    conditions = snippet_conditions(language, collection_name, username)
+    if not conditions:
+        raise ValueError("At least one filter (language, collection or user) is required.")
+    return conditions
+
+def count_snippets_where(session, language=None, collection_name=None, username=None):
+    """
+    Counts the snippets that match the search filters, in one query.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        language (str, optional): Only count snippets in this programming language.
+        collection_name (str, optional): Only count snippets in the collection with this name.
+        username (str, optional): Only count snippets owned by the user with this username.
+
+    Returns:
+        int: The number of matching snippets.
+
+    Raises:
+        ValueError: If no filter is given.
+    """
+    conditions = _required_conditions(language, collection_name, username)
+    return session.execute(select(func.count()).select_from(Snippet).where(*conditions)).scalar()
+
+def delete_snippets_where(session, language=None, collection_name=None, username=None):
+    """
+    Deletes every snippet that matches the search filters with a single DELETE statement.
+
+    The snippets are not loaded. The code blobs they leave unused are deleted by one more
+    statement, and the search indexes are kept in sync by their triggers.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        language (str, optional): Only delete snippets in this programming language.
+        collection_name (str, optional): Only delete snippets in the collection with this name.
+        username (str, optional): Only delete snippets owned by the user with this username.
+
+    Returns:
+        int: The number of deleted snippets.
+
+    Raises:
+        ValueError: If no filter is given.
+    """
+    conditions = _required_conditions(language, collection_name, username)
+    connection = session.connection()
+    release_code_blobs(connection, select(Snippet.code_hash).where(*conditions))
+    deleted = session.execute(delete(Snippet).where(*conditions),
+        execution_options={'synchronize_session': False}).rowcount
+    prune_released_blobs(connection)
+    return deleted
+
+def update_snippets_where(session, language=None, collection_name=None, username=None, new_language=None,
+        new_collection_name=None, new_username=None, new_description=None):
+    """
+    Changes fields of every snippet that matches the search filters with a single UPDATE statement.
+
+    The snippets are not loaded. Moving snippets to a collection that does not exist creates it.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        language (str, optional): Only update snippets in this programming language.
+        collection_name (str, optional): Only update snippets in the collection with this name.
+        username (str, optional): Only update snippets owned by the user with this username.
+        new_language (str, optional): The new programming language.
+        new_collection_name (str, optional): The name of the collection to move the snippets to.
+        new_username (str, optional): The username of the user who becomes the owner.
+        new_description (str, optional): The new description.
+
+    Returns:
+        int: The number of updated snippets.
+
+    Raises:
+        ValueError: If no filter or no change is given, a new value is invalid, or the new owner
+            is not found.
+    """
+    conditions = _required_conditions(language, collection_name, username)
+    values = {}
+    if new_language:
+        validate_snippet_language(new_language)
+        values[Snippet.language] = new_language
+    if new_collection_name:
+        validate_collection_name(new_collection_name)
+        collection = get_or_create_collection(session, new_collection_name)
+        session.flush()
+        values[Snippet.collection_id] = collection.id
+    if new_username:
+        values[Snippet.user_id] = get_user(session, new_username).id
+    if new_description:
+        values[Snippet.description] = new_description
+    if not values:
+        raise ValueError("At least one field (language, collection, user or description) must be set.")
+    return session.execute(update(Snippet).where(*conditions).values(values),
+        execution_options={'synchronize_session': False}).rowcount
@@ -0,0 +1,342 @@
+# lib/sync.py
+import hashlib
+import itertools
+import json
+import sys
+from sqlalchemy import func, text
+from config import SYNC_FLUSH_SIZE
+from models import Change, Snippet, StoreInfo, SyncPeer, hash_code, new_uid
+from compression import decompress_code
+from store import create_snippet, get_or_create_collection, get_or_create_user
+
+SYNC_FORMAT = 1
+CHANGE_TRIGGERS = ['change_log_ai', 'change_log_au', 'change_log_ad']
+CHANGE_COLUMNS = ['title', 'description', 'language', 'code_hash', 'collection_id', 'user_id']
+
+# Every insert, update and delete of a snippet appends the snippet's new state to the change
+# log, however it is written, so the log is complete without help from the commands.
+CHANGE_SCHEMA = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS change_log_ai AFTER INSERT ON snippets BEGIN
+        INSERT INTO change_log (uid, deleted, {', '.join(CHANGE_COLUMNS)})
+        VALUES (new.uid, 0, {', '.join('new.' + column for column in CHANGE_COLUMNS)});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS change_log_au AFTER UPDATE OF {', '.join(CHANGE_COLUMNS)} ON snippets
+    WHEN {' OR '.join(f'old.{column} IS NOT new.{column}' for column in CHANGE_COLUMNS)} BEGIN
+        INSERT INTO change_log (uid, deleted, {', '.join(CHANGE_COLUMNS)})
+        VALUES (new.uid, 0, {', '.join('new.' + column for column in CHANGE_COLUMNS)});
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS change_log_ad AFTER DELETE ON snippets BEGIN
+        INSERT INTO change_log (uid, deleted) VALUES (old.uid, 1);
+    END
+    """,
+]
+
+# The latest change of every snippet changed after :since, with the snippet's current state
+# and its state as of :since (the base the receiving store is expected to have).
+CHANGES_SINCE = """
+    WITH latest AS (
+        SELECT uid, max(revision) AS revision FROM change_log WHERE revision > :since GROUP BY uid
+    )
+    SELECT latest.revision, latest.uid,
+        s.title, s.description, s.language, s.code_hash, b.body, b.codec, c.name, u.username,
+        base.deleted, base.title, base.description, base.language, base.code_hash, bc.name, bu.username
+    FROM latest
+    LEFT JOIN snippets s ON s.uid = latest.uid
+    LEFT JOIN code_blobs b ON b.hash = s.code_hash
+    LEFT JOIN collections c ON c.id = s.collection_id
+    LEFT JOIN users u ON u.id = s.user_id
+    LEFT JOIN change_log base ON base.revision = (
+        SELECT max(revision) FROM change_log WHERE uid = latest.uid AND revision <= :since)
+    LEFT JOIN collections bc ON bc.id = base.collection_id
+    LEFT JOIN users bu ON bu.id = base.user_id
+    ORDER BY latest.revision
+"""
+
+def add_snippet_uids(connection):
+    """
+    Adds the uid column to a snippets table created before stores could be synced, and gives
+    every existing snippet a random one.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection, inside a transaction.
+    """
+    columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(snippets)")]
+    if 'uid' not in columns:
+        connection.exec_driver_sql("ALTER TABLE snippets ADD COLUMN uid VARCHAR")
+    connection.exec_driver_sql("UPDATE snippets SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+
+def create_change_log(connection):
+    """
+    Creates the triggers that write the change log and gives the store its sync identifier.
+
+    If the triggers are created on a database that already holds snippets, every snippet is
+    logged once, so that a full export (--since 0) includes it.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    existed = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"),
+        {"name": CHANGE_TRIGGERS[0]}).first() is not None
+    for statement in CHANGE_SCHEMA:
+        connection.execute(text(statement))
+    if not existed:
+        connection.execute(text(f"INSERT INTO change_log (uid, deleted, {', '.join(CHANGE_COLUMNS)}) "
+            f"SELECT uid, 0, {', '.join(CHANGE_COLUMNS)} FROM snippets ORDER BY id"))
+    connection.execute(text("INSERT OR IGNORE INTO store_info (name, value) VALUES ('store_id', :value)"),
+        {"value": new_uid()})
+
+def store_id(session):
+    """
+    Returns the identifier this store's changes are exported under.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        str: The identifier.
+    """
+    return session.query(StoreInfo.value).filter(StoreInfo.name == 'store_id').scalar()
+
+def renew_store_id(session):
+    """
+    Gives the store a new identifier and forgets which changes of other stores it has applied.
+
+    A copy of a database file starts out with the identifier of the original; renewing it lets
+    the two be synced with each other.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        str: The new identifier.
+    """
+    value = new_uid()
+    session.query(StoreInfo).filter(StoreInfo.name == 'store_id').update({StoreInfo.value: value})
+    session.query(SyncPeer).delete()
+    return value
+
+def current_revision(session):
+    """
+    Returns the revision of the latest change made to this store, or 0 if there is none.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+    """
+    return session.query(func.coalesce(func.max(Change.revision), 0)).scalar()
+
+def sync_peers(session):
+    """
+    Lists the stores whose changes have been applied to this one.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        list: (store id, revision, applied at) rows.
+    """
+    return session.query(SyncPeer.store_id, SyncPeer.revision, SyncPeer.applied_at) \
+        .order_by(SyncPeer.applied_at.desc()).all()
+
+def state_hash(title, description, language, code_hash, collection_name, username):
+    """
+    Fingerprints the state of a snippet, so that two stores can tell whether they hold the
+    same version of it without comparing the code.
+
+    Returns:
+        str: The SHA-256 hex digest of the fields.
+    """
+    fields = [title, description, language, code_hash, collection_name, username]
+    return hashlib.sha256(json.dumps(fields).encode('utf-8')).hexdigest()
+
+def export_changes(session, path, since=0):
+    """
+    Writes the snippets changed after a revision to a change set file.
+
+    The first line is a header naming this store, the revision the change set starts after and
+    the revision it goes up to. Each following line is the current state of one changed
+    snippet, or a tombstone if it was deleted, with the fingerprint of its state as of since
+    (its base). Snippets that were both created and deleted after since are left out. Only the
+    log entries after since and the snippets they name are read.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        path (str): The output file, or '-' for standard output.
+        since (int): Only include changes made after this revision (default: 0, everything).
+
+    Returns:
+        tuple: The number of changes written and the revision the change set goes up to.
+
+    Raises:
+        ValueError: If since is negative or beyond this store's latest revision.
+    """
+    revision = current_revision(session)
+    if since < 0 or since > revision:
+        raise ValueError(f"Revision {since} does not exist; this store is at revision {revision}.")
+    header = {"sync": SYNC_FORMAT, "store": store_id(session), "since": since, "revision": revision}
+    rows = session.connection().execute(text(CHANGES_SINCE), {"since": since})
+    file = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+    count = 0
+    try:
+        file.write(json.dumps(header) + "\n")
+        for row in rows:
+            change_revision, uid, title, description, language, code_hash, data, codec, collection_name, username = row[:10]
+            base_deleted, *base_fields = row[10:]
+            base = None if base_deleted is None or base_deleted else state_hash(*base_fields)
+            if title is None:
+                if base is None:
+                    continue
+                record = {"uid": uid, "revision": change_revision, "deleted": True, "base": base}
+            else:
+                record = {"uid": uid, "revision": change_revision, "title": title, "description": description,
+                    "language": language, "code": decompress_code(data, codec), "collection": collection_name,
+                    "user": username, "base": base}
+            file.write(json.dumps(record) + "\n")
+            count += 1
+    finally:
+        if file is not sys.stdout:
+            file.close()
+    return count, revision
+
+def _read_change_set(file):
+    header = None
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number} is not valid JSON: {str(e)}")
+        if header is None:
+            if not isinstance(record, dict) or record.get("sync") != SYNC_FORMAT:
+                raise ValueError("Not a change set written by 'sync export'.")
+            header = record
+            yield header
+        else:
+            yield record
+    if header is None:
+        raise ValueError("The change set is empty.")
+
+def apply_changes(session, path, theirs=False, force=False):
+    """
+    Applies a change set written by export_changes to this store, in one transaction.
+
+    For every changed snippet, this store's version is compared with the base the change was
+    made from. If they match, the change is applied; if this store already has the new version,
+    nothing is done. Otherwise the snippet was changed here too since the stores were last in
+    sync: that is a conflict, and this store's version is kept unless theirs is set. Users and
+    collections are created as needed. The revision the change set goes up to is recorded for
+    the store it came from, so that a later change set that leaves a gap is refused. A change
+    set that starts after revision 0 from a store never applied here is refused too, unless
+    force is set: this store may be missing the changes before it.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        path (str or file): The change set file, '-' for standard input, or an open text file,
+            which is read from its start and left open.
+        theirs (bool): Resolve conflicts by applying the incoming version (default: False).
+        force (bool): Accept a change set that starts after revision 0 from a store never
+            applied here, such as the store this one was copied from (default: False).
+
+    Returns:
+        tuple: The change set header, a dict of counts ('created', 'updated', 'deleted',
+        'unchanged', 'conflicts') and the (uid, title) of every conflicting snippet.
+
+    Raises:
+        ValueError: If the file is not a change set, comes from this store, leaves a gap after
+            the changes already applied from its store, starts after revision 0 from an unknown
+            store without force, or holds an invalid snippet.
+    """
+    counts = {'created': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'conflicts': 0}
+    conflicts = []
+    users = {}
+    collections = {}
+    if not isinstance(path, str):
+        file = path
+        file.seek(0)
+    else:
+        file = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        records = _read_change_set(file)
+        header = next(records)
+        if header.get("store") == store_id(session):
+            raise ValueError("This change set was exported from this store, or from a copy of it. "
+                "Give a copied database its own identity with 'sync new-id'.")
+        peer = session.get(SyncPeer, header["store"])
+        if peer is not None and header["since"] > peer.revision:
+            raise ValueError(f"Changes {peer.revision + 1} to {header['since']} of store {header['store']} "
+                f"have not been applied here. Export them with --since {peer.revision}.")
+        if peer is None and header["since"] > 0 and not force:
+            raise ValueError(f"No changes of store {header['store']} have been applied here, and this change set "
+                f"starts after revision {header['since']}. Export from that store with --since 0, or rerun with "
+                "--force if this store already holds its changes up to that revision.")
+        for chunk in iter(lambda: list(itertools.islice(records, SYNC_FLUSH_SIZE)), []):
+            # The chunk's snippets are looked up at once, and its changes flushed together.
+            local = {snippet.uid: snippet for snippet in
+                session.query(Snippet).filter(Snippet.uid.in_([record.get("uid") for record in chunk]))}
+            with session.no_autoflush:
+                for record in chunk:
+                    try:
+                        action, conflict = _apply_change(session, record, local.get(record.get("uid")), theirs,
+                            users, collections)
+                    except (KeyError, ValueError) as e:
+                        raise ValueError(f"Change of snippet {record.get('uid')}: {str(e)}")
+                    if conflict:
+                        counts['conflicts'] += 1
+                        conflicts.append((record["uid"], record.get("title")))
+                    if action:
+                        counts[action] += 1
+            session.flush()
+        if peer is None:
+            session.add(SyncPeer(store_id=header["store"], revision=header["revision"]))
+        else:
+            peer.revision = max(peer.revision, header["revision"])
+    finally:
+        if file is not sys.stdin and isinstance(path, str):
+            file.close()
+    return header, counts, conflicts
+
+def _apply_change(session, record, snippet, theirs, users, collections):
+    """
+    Applies one change to the snippet with its uid, if this store has it.
+
+    Returns:
+        tuple: What was done ('created', 'updated', 'deleted', 'unchanged', or None if the
+        change was skipped) and whether it conflicted with a change made in this store.
+    """
+    local = None
+    if snippet is not None:
+        local = state_hash(snippet.title, snippet.description, snippet.language, snippet.code_hash,
+            snippet.collection.name if snippet.collection else None, snippet.user.username if snippet.user else None)
+    incoming = None
+    if not record.get("deleted"):
+        incoming = state_hash(record["title"], record["description"], record["language"], hash_code(record["code"]),
+            record["collection"], record["user"])
+    if local == incoming:
+        return 'unchanged', False
+    conflict = local != record.get("base")
+    if conflict and not theirs:
+        return None, True
+    if incoming is None:
+        session.delete(snippet)
+        return 'deleted', conflict
+    user = get_or_create_user(session, record["user"], users)
+    collection = get_or_create_collection(session, record["collection"], collections)
+    if snippet is None:
+        snippet = create_snippet(session, record["title"], record["description"], record["language"], record["code"],
+            collection.name, user.username, users, collections)
+        snippet.uid = record["uid"]
+        return 'created', conflict
+    snippet.title = record["title"]
+    snippet.description = record["description"]
+    snippet.language = record["language"]
+    if snippet.code_hash != hash_code(record["code"]):
+        snippet.code = record["code"]
+    snippet.collection = collection
+    snippet.user = user
+    return 'updated', conflict
@@ -0,0 +1,331 @@
+# lib/tags.py
+import re
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert as upsert
+from models import Snippet, SnippetTag, Tag, TagBitmap
+from queries import iter_keyset
+from store import get_snippet
+from utils import validate_tag_name
+
+TAG_TRIGGERS = ['snippet_tags_ai', 'snippet_tags_ad', 'snippets_tags_ad']
+
+# Every change to the snippets of a tag raises the tag's revision, whichever statement made it,
+# and the tags of a deleted snippet go with it (including set-based deletes and synced
+# tombstones). A stored bitmap built at an older revision is out of date.
+TAG_SCHEMA = [
+    """
+    CREATE TRIGGER IF NOT EXISTS snippet_tags_ai AFTER INSERT ON snippet_tags BEGIN
+        UPDATE tags SET revision = revision + 1 WHERE id = new.tag_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippet_tags_ad AFTER DELETE ON snippet_tags BEGIN
+        UPDATE tags SET revision = revision + 1 WHERE id = old.tag_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_tags_ad AFTER DELETE ON snippets BEGIN
+        DELETE FROM snippet_tags WHERE snippet_id = old.id;
+    END
+    """,
+]
+
+def create_tag_index(connection):
+    """
+    Creates the triggers that keep the tags of snippets and their revisions up to date.
+
+    Bitmaps are built the first time a tag is searched for, so nothing has to be backfilled.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): An open connection to the database.
+    """
+    for statement in TAG_SCHEMA:
+        connection.execute(text(statement))
+
+# The positions of the set bits of every byte value, lowest first.
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+_NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+def bitmap_from_ids(snippet_ids):
+    """
+    Builds a bitmap of snippet IDs.
+
+    Bitmaps are Python integers with bit i set for snippet i, so intersecting and excluding
+    tags are single '&' and '& ~' operations that run in C over machine words.
+
+    Args:
+        snippet_ids (iterable): The snippet IDs.
+
+    Returns:
+        int: The bitmap.
+    """
+    snippet_ids = list(snippet_ids)
+    if not snippet_ids:
+        return 0
+    buffer = bytearray((max(snippet_ids) >> 3) + 1)
+    for snippet_id in snippet_ids:
+        buffer[snippet_id >> 3] |= 1 << (snippet_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+def bitmap_ids(bitmap, after=None):
+    """
+    Yields the snippet IDs in a bitmap in ascending order.
+
+    Runs of zero bytes are skipped by a regular expression scan rather than in Python, so a
+    sparse bitmap costs little more than a dense one.
+
+    Args:
+        bitmap (int): The bitmap.
+        after (int, optional): Only yield IDs greater than this one.
+
+    Yields:
+        int: The snippet IDs.
+    """
+    start = 0 if after is None else after + 1
+    bitmap >>= start
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for match in _NONZERO_BYTE.finditer(data):
+        offset = start + match.start() * 8
+        for bit in _BYTE_BITS[data[match.start()]]:
+            yield offset + bit
+
+def _pack(bitmap):
+    # Stores the bitmap from its lowest set byte on, so a tag of a few recent snippets does
+    # not take a bit for every older one.
+    if not bitmap:
+        return 0, b''
+    base = ((bitmap & -bitmap).bit_length() - 1) & ~7
+    bitmap >>= base
+    return base, bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+def _unpack(base, data):
+    return int.from_bytes(data, 'little') << base
+
+def _store_bitmap(session, tag_id, revision, bitmap):
+    base, data = _pack(bitmap)
+    values = {'revision': revision, 'base': base, 'bitmap': data}
+    session.execute(upsert(TagBitmap.__table__).values(tag_id=tag_id, **values)
+        .on_conflict_do_update(index_elements=['tag_id'], set_=values))
+
+def _build_bitmap(session, tag_id, revision):
+    # The (tag_id, snippet_id) index holds the tag's snippets in order, so this reads one
+    # contiguous range of it.
+    bitmap = bitmap_from_ids(snippet_id for (snippet_id,) in
+        session.query(SnippetTag.snippet_id).filter(SnippetTag.tag_id == tag_id))
+    _store_bitmap(session, tag_id, revision, bitmap)
+    return bitmap
+
+def _stored_bitmaps(session, tag_ids):
+    return {tag_id: (revision, _unpack(base, data)) for tag_id, revision, base, data in
+        session.query(TagBitmap.tag_id, TagBitmap.revision, TagBitmap.base, TagBitmap.bitmap)
+            .filter(TagBitmap.tag_id.in_(tag_ids))}
+
+def tag_bitmaps(session, names):
+    """
+    Gets the bitmaps of the snippets with each of the given tags.
+
+    Stored bitmaps are used as long as they were built at the tag's current revision. Those
+    that are out of date, because the tag's snippets were changed by a statement that does not
+    update bitmaps (such as 'delete where'), are rebuilt and stored in the session's
+    transaction; commit it to keep them.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        names (list): The tag names.
+
+    Returns:
+        dict: The bitmap of each tag, by name. Tags that do not exist are left out.
+    """
+    tags = session.query(Tag.id, Tag.name, Tag.revision).filter(Tag.name.in_(set(names))).all()
+    stored = _stored_bitmaps(session, [tag_id for tag_id, _, _ in tags])
+    bitmaps = {}
+    for tag_id, name, revision in tags:
+        stored_revision, bitmap = stored.get(tag_id, (None, 0))
+        if stored_revision != revision:
+            bitmap = _build_bitmap(session, tag_id, revision)
+        bitmaps[name] = bitmap
+    return bitmaps
+
+def match_tags(session, tags=(), excluded=()):
+    """
+    Works out which snippets have all of the given tags and none of the excluded ones.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        tags (list, optional): The tags a snippet must have.
+        excluded (list, optional): The tags a snippet must not have.
+
+    Returns:
+        tuple: The bitmap of the snippets with all the tags (None if no tags are required, which
+        matches every snippet) and the bitmap of the snippets with any excluded tag.
+
+    Raises:
+        ValueError: If a tag name is invalid.
+    """
+    tags, excluded = normalize_tags(tags), normalize_tags(excluded)
+    bitmaps = tag_bitmaps(session, list(tags) + list(excluded))
+    included = None
+    for name in tags:
+        included = bitmaps.get(name, 0) if included is None else included & bitmaps.get(name, 0)
+    without = 0
+    for name in excluded:
+        without |= bitmaps.get(name, 0)
+    if included is not None:
+        included &= ~without
+    return included, without
+
+def iter_tagged(query, included, excluded=0, after=None, limit=None, batch_size=500):
+    """
+    Iterates over the rows of a snippet query that match a tag search, in ID order.
+
+    With required tags, the matching IDs are read from the bitmap one batch at a time and
+    only those snippets are fetched, so the query's own filters are applied to tagged snippets
+    alone. Otherwise the query is paged through with iter_keyset and snippets with an excluded
+    tag are skipped.
+
+    Args:
+        query (sqlalchemy.orm.Query): A query selecting from the snippets table whose first
+            column is the snippet ID.
+        included (int): The bitmap of the snippets to include, or None to include any snippet.
+        excluded (int, optional): The bitmap of the snippets to leave out.
+        after (int, optional): Only yield rows with an ID greater than this one.
+        limit (int, optional): The maximum number of rows to yield.
+        batch_size (int): The number of snippets fetched per round trip (default: 500).
+
+    Yields:
+        Row: The matching rows, in ascending ID order.
+    """
+    if limit is not None and limit <= 0:
+        return
+    count = 0
+    if included is None:
+        for row in iter_keyset(query, Snippet.id, after=after, batch_size=batch_size):
+            if not excluded >> row[0] & 1:
+                yield row
+                count += 1
+                if count == limit:
+                    return
+        return
+    snippet_ids = bitmap_ids(included, after)
+    while True:
+        size = batch_size if limit is None else min(batch_size, limit - count)
+        batch = [snippet_id for _, snippet_id in zip(range(size), snippet_ids)]
+        if not batch:
+            return
+        for row in query.filter(Snippet.id.in_(batch)).order_by(Snippet.id):
+            yield row
+            count += 1
+            if count == limit:
+                return
+
+def _tag_ids(session, names):
+    return dict(session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+
+def _change_tags(session, snippet_id, tag_ids, statement, set_bit):
+    # Bitmaps that were current before the change are patched with the snippet's bit rather
+    # than rebuilt, so tagging a snippet costs the same however many snippets share the tag.
+    before = dict(session.query(Tag.id, Tag.revision).filter(Tag.id.in_(tag_ids)))
+    stored = _stored_bitmaps(session, tag_ids)
+    session.execute(statement)
+    after = dict(session.query(Tag.id, Tag.revision).filter(Tag.id.in_(tag_ids)))
+    changed = [tag_id for tag_id in tag_ids if after[tag_id] != before[tag_id]]
+    for tag_id in changed:
+        revision, bitmap = stored.get(tag_id, (None, None))
+        if revision == before[tag_id]:
+            bit = 1 << snippet_id
+            _store_bitmap(session, tag_id, after[tag_id], bitmap | bit if set_bit else bitmap & ~bit)
+    return changed
+
+def normalize_tags(names):
+    """
+    Lowercases and validates tag names, dropping repeats.
+
+    Args:
+        names (list): The tag names.
+
+    Returns:
+        list: The normalized names, in their first order.
+
+    Raises:
+        ValueError: If a tag name is invalid.
+    """
+    normalized = list(dict.fromkeys(name.strip().lower() for name in names))
+    for name in normalized:
+        validate_tag_name(name)
+    return normalized
+
+def tag_snippet(session, snippet_id, names):
+    """
+    Adds tags to a snippet, creating the tags that do not exist yet.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+        names (list): The tag names.
+
+    Returns:
+        int: The number of tags the snippet did not have before.
+
+    Raises:
+        ValueError: If the snippet is not found or a tag name is invalid.
+    """
+    names = normalize_tags(names)
+    snippet_id = get_snippet(session, snippet_id).id
+    session.execute(upsert(Tag.__table__).on_conflict_do_nothing(index_elements=['name']),
+        [{'name': name, 'revision': 0} for name in names])
+    tag_ids = list(_tag_ids(session, names).values())
+    statement = upsert(SnippetTag.__table__).values([{'snippet_id': snippet_id, 'tag_id': tag_id}
+        for tag_id in tag_ids]).on_conflict_do_nothing()
+    return len(_change_tags(session, snippet_id, tag_ids, statement, True))
+
+def untag_snippet(session, snippet_id, names):
+    """
+    Removes tags from a snippet.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+        names (list): The tag names.
+
+    Returns:
+        int: The number of tags that were removed.
+
+    Raises:
+        ValueError: If the snippet is not found or a tag name is invalid.
+    """
+    names = normalize_tags(names)
+    snippet_id = get_snippet(session, snippet_id).id
+    tag_ids = list(_tag_ids(session, names).values())
+    if not tag_ids:
+        return 0
+    table = SnippetTag.__table__
+    statement = table.delete().where(table.c.snippet_id == snippet_id, table.c.tag_id.in_(tag_ids))
+    return len(_change_tags(session, snippet_id, tag_ids, statement, False))
+
+def snippet_tags(session, snippet_id):
+    """
+    Gets the names of a snippet's tags.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+        snippet_id (int): The ID of the snippet.
+
+    Returns:
+        list: The tag names, in alphabetical order.
+    """
+    return [name for (name,) in session.query(Tag.name).join(SnippetTag, SnippetTag.tag_id == Tag.id)
+        .filter(SnippetTag.snippet_id == snippet_id).order_by(Tag.name)]
+
+def tag_counts(session):
+    """
+    Counts the snippets with each tag, most used first. Tags without snippets are left out.
+
+    Args:
+        session (sqlalchemy.orm.Session): The database session.
+
+    Returns:
+        sqlalchemy.orm.Query: The query, yielding (name, snippets) rows.
+    """
+    return session.query(Tag.name, func.count(SnippetTag.snippet_id)) \
+        .join(SnippetTag, SnippetTag.tag_id == Tag.id) \
+        .group_by(Tag.id).order_by(func.count(SnippetTag.snippet_id).desc(), Tag.name)
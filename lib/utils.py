@@ -1,5 +1,7 @@
 # lib/utils.py
+import itertools
 import re
+from config import MAX_SNIPPET_CODE_LENGTH, MAX_TAG_NAME_LENGTH
 
 def validate_username(username):
     """
@@ -35,6 +37,24 @@ def validate_collection_name(name):
     if len(name) < 3 or len(name) > 50:
         raise ValueError("Collection name must be between 3 and 50 characters long.")
 
+def validate_tag_name(name):
+    """
+    Validates a tag name.
+
+    Args:
+        name (str): The tag name to validate.
+
+    Raises:
+        ValueError: If the tag name is empty, contains invalid characters, or is too long.
+    """
+    if not name:
+        raise ValueError("Tag name cannot be empty.")
+    if not re.match(r'^[a-z0-9][a-z0-9_.+#-]*$', name):
+        raise ValueError(f"Invalid tag name '{name}'. Tags are lowercase letters, digits and _ . + # -, "
+            "and start with a letter or digit.")
+    if len(name) > MAX_TAG_NAME_LENGTH:
+        raise ValueError(f"Tag name must be at most {MAX_TAG_NAME_LENGTH} characters long.")
+
 def validate_snippet_title(title):
     """
     Validates the snippet title.
@@ -73,10 +93,12 @@ def validate_snippet_code(code):
         code (str): The snippet code to validate.
 
     Raises:
-        ValueError: If the snippet code is empty.
+        ValueError: If the snippet code is empty or too long.
     """
     if not code:
         raise ValueError("Snippet code cannot be empty.")
+    if len(code) > MAX_SNIPPET_CODE_LENGTH:
+        raise ValueError(f"Snippet code cannot be longer than {MAX_SNIPPET_CODE_LENGTH} characters.")
 
 def format_snippet(snippet):
     """
@@ -88,14 +110,43 @@ def format_snippet(snippet):
     Returns:
         str: The formatted snippet details.
     """
-    formatted_snippet = f"ID: {snippet.id}\n"
-    formatted_snippet += f"Title: {snippet.title}\n"
-    formatted_snippet += f"Description: {snippet.description}\n"
-    formatted_snippet += f"Language: {snippet.language}\n"
-    formatted_snippet += f"Code:\n{snippet.code}\n"
-    formatted_snippet += f"Collection: {snippet.collection.name}\n"
-    formatted_snippet += f"User: {snippet.user.username}\n"
-    return formatted_snippet
+    return "".join([
+        f"ID: {snippet.id}\n",
+        f"Title: {snippet.title}\n",
+        f"Description: {snippet.description}\n",
+        f"Language: {snippet.language}\n",
+        f"Code:\n{snippet.code}\n",
+        f"Collection: {snippet.collection.name}\n",
+        f"User: {snippet.user.username}\n",
+    ])
+
+def format_snippet_details(title, description, language, code, collection_name, username, tags=None):
+    """
+    Formats the snippet details shown by the view command.
+
+    Args:
+        title (str): The title of the snippet.
+        description (str): The description of the snippet.
+        language (str): The programming language of the snippet.
+        code (str): The code of the snippet.
+        collection_name (str): The name of the snippet's collection.
+        username (str): The username of the snippet's owner.
+        tags (list, optional): The names of the snippet's tags.
+
+    Returns:
+        str: The formatted snippet details.
+    """
+    lines = [
+        f"Title: {title}",
+        f"Description: {description}",
+        f"Language: {language}",
+        f"Code:\n{code}",
+        f"Collection: {collection_name}",
+        f"User: {username}",
+    ]
+    if tags:
+        lines.append(f"Tags: {', '.join(tags)}")
+    return "\n".join(lines)
 
 def format_snippet_list(snippets):
     """
@@ -107,10 +158,8 @@ def format_snippet_list(snippets):
     Returns:
         str: The formatted list of snippets.
     """
-    formatted_list = "Snippets:\n"
-    for snippet in snippets:
-        formatted_list += f"ID: {snippet.id}, Title: {snippet.title}, Language: {snippet.language}\n"
-    return formatted_list
+    return "".join(itertools.chain(["Snippets:\n"],
+        (f"ID: {snippet.id}, Title: {snippet.title}, Language: {snippet.language}\n" for snippet in snippets)))
 
 def format_collection_list(collections):
     """
@@ -122,7 +171,5 @@ def format_collection_list(collections):
     Returns:
         str: The formatted list of collections.
     """
-    formatted_list = "Collections:\n"
-    for collection in collections:
-        formatted_list += f"ID: {collection.id}, Name: {collection.name}\n"
-    return formatted_list
\ No newline at end of file
+    return "".join(itertools.chain(["Collections:\n"],
+        (f"ID: {collection.id}, Name: {collection.name}\n" for collection in collections)))
\ No newline at end of file
@@ -0,0 +1,45 @@
+# tests/support.py
+"""
+Helpers for the tests, which run main.py in one-shot mode against scratch databases.
+
+Configuration is read from the environment when lib/config.py is imported, so every command
+runs in a process of its own, as it would from the command line.
+"""
+import os
+import subprocess
+import sys
+
+LIB_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+
+def environment(database, shard_directory=None):
+    """
+    Returns the environment that points main.py at a scratch database.
+
+    Args:
+        database (str): The path of the database file.
+        shard_directory (str, optional): Use the sharded layout with this directory.
+
+    Returns:
+        dict: The environment.
+    """
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.abspath(database)}")
+    env.pop("SHARD_DIRECTORY", None)
+    if shard_directory:
+        env["SHARD_DIRECTORY"] = os.path.abspath(shard_directory)
+    return env
+
+def run_main(env, *args, stdin=None, preexec_fn=None):
+    """
+    Runs a one-shot command.
+
+    Args:
+        env (dict): The environment (see environment).
+        *args (str): The command and its arguments.
+        stdin (str, optional): Text written to the command's standard input.
+        preexec_fn (callable, optional): Called in the child process before main.py starts.
+
+    Returns:
+        subprocess.CompletedProcess: The exit status and the captured output, as text.
+    """
+    return subprocess.run([sys.executable, "main.py", *args], cwd=LIB_DIRECTORY, env=env, input=stdin,
+        capture_output=True, text=True, preexec_fn=preexec_fn)
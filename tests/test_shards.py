@@ -0,0 +1,61 @@
+# tests/test_shards.py
+import json
+import os
+import tempfile
+import unittest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from support import environment, run_main
+
+SHARDS = 40
+FILE_LIMIT = 64
+
+def limit_open_files():
+    # Three files per open shard would need twice this many descriptors for all of them.
+    resource.setrlimit(resource.RLIMIT_NOFILE, (FILE_LIMIT, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+
+@unittest.skipIf(resource is None, "needs the resource module to limit open files")
+class ShardFanOutTest(unittest.TestCase):
+    """
+    Imports snippets of more users than there are file descriptors for, one shard each, and
+    reads them back, with the number of open files limited.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        catalog = os.path.join(self.directory.name, "catalog.db")
+        self.env = environment(catalog, shard_directory=os.path.join(self.directory.name, "shards"))
+        self.env.update(SHARD_WORKERS="4", SHARD_OPEN_LIMIT="8")
+        batch = os.path.join(self.directory.name, "users.txt")
+        records = os.path.join(self.directory.name, "snippets.jsonl")
+        with open(batch, "w", encoding="utf-8") as users, open(records, "w", encoding="utf-8") as snippets:
+            for number in range(SHARDS):
+                users.write(f"user user{number:02d}\n")
+                snippets.write(json.dumps({"user": f"user{number:02d}", "collection": "things",
+                    "title": f"snippet {number:02d}", "language": "python", "code": f"print({number})\n"}) + "\n")
+        self.check(environment(catalog), "--batch", batch)
+        self.check(self.env, "import", records)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check(self, env, *args):
+        result = run_main(env, *args, preexec_fn=limit_open_files)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def test_lists_snippets_of_every_shard(self):
+        titles = [line.split("Title: ")[1].split(",")[0] for line in self.check(self.env, "list", "snippets").splitlines()
+            if "Title: " in line]
+        self.assertEqual(titles, [f"snippet {number:02d}" for number in range(SHARDS)])
+
+    def test_searches_every_shard(self):
+        output = self.check(self.env, "search", "language", "python")
+        self.assertEqual(output.count("Title: snippet"), SHARDS)
+
+if __name__ == "__main__":
+    unittest.main()
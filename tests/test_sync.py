@@ -0,0 +1,63 @@
+# tests/test_sync.py
+import os
+import tempfile
+import unittest
+
+from support import environment, run_main
+
+class SyncApplyTest(unittest.TestCase):
+    """
+    Applies change sets between two scratch stores with 'sync export' and 'sync apply'.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = environment(os.path.join(self.directory.name, "source.db"))
+        self.target = environment(os.path.join(self.directory.name, "target.db"))
+        self.change_set = os.path.join(self.directory.name, "changes.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check(self, env, *args):
+        result = run_main(env, *args)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def test_applies_snippets_of_users_and_collections_with_short_names(self):
+        # The 'user' command and 'add' accept names that the import rules would reject; their
+        # snippets must still sync, whether or not the receiving store has the user already.
+        self.check(self.source, "user", "ab")
+        self.check(self.source, "add", "short names", "python", "print('ab')", "--user", "ab", "--collection", "c1")
+        self.check(self.source, "sync", "export", self.change_set)
+        self.check(self.target, "user", "ab")
+        self.check(self.target, "sync", "apply", self.change_set)
+        other = environment(os.path.join(self.directory.name, "other.db"))
+        self.check(other, "sync", "apply", self.change_set)
+        for env in (self.target, other):
+            view = self.check(env, "view", "1")
+            self.assertIn("User: ab", view)
+            self.assertIn("Collection: c1", view)
+
+    def test_refuses_unknown_peer_after_revision_zero_without_force(self):
+        self.check(self.source, "user", "alice")
+        self.check(self.source, "add", "first", "python", "print(1)", "--user", "alice", "--collection", "things")
+        self.check(self.source, "add", "second", "python", "print(2)", "--user", "alice", "--collection", "things")
+        self.check(self.source, "sync", "export", self.change_set, "--since", "1")
+        result = run_main(self.target, "sync", "apply", self.change_set)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("--force", result.stdout)
+        self.check(self.target, "sync", "apply", self.change_set, "--force")
+        self.assertIn("second", self.check(self.target, "list", "snippets"))
+
+    def test_applies_change_set_from_standard_input(self):
+        self.check(self.source, "user", "alice")
+        self.check(self.source, "add", "piped", "python", "print(1)", "--user", "alice", "--collection", "things")
+        self.check(self.source, "sync", "export", self.change_set)
+        with open(self.change_set, encoding="utf-8") as file:
+            result = run_main(self.target, "sync", "apply", "-", stdin=file.read())
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn("piped", self.check(self.target, "list", "snippets"))
+
+if __name__ == "__main__":
+    unittest.main()